@@ -1,49 +1,72 @@
 from src.strava import (
-    add_playlist_to_latest_run,
+    add_playlist_to_latest_run_async,
     build_strava_auth_url,
     exchange_strava_code_for_access_token,
     get_latest_run,
+    list_recent_activities,
+    MAX_ACTIVITIES_PER_PAGE,
+    ACTIVITIES_PER_PAGE,
 )
 from src.helpers import decode_state
 import logging
-from fastapi import FastAPI, Request, Depends
-from fastapi.responses import JSONResponse, RedirectResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from src.db_ops import find_or_create_user, store_token
-import os
-from requests import get
-from dotenv import load_dotenv
+from src.db_ops import find_or_create_user_async, store_token_async
+from src.http_client import close_async_client, get_async
 from sqlalchemy.orm import Session
-from src.db import get_db, User
-from src.auth import create_access_token, get_current_user
+from src.config import CRON_SECRET, FRONTEND_URL, METRICS_TOKEN, SPOTIFY_API_URL
+from src.db import get_async_db, get_db
+from src import metrics, tracing
+from src.auth import create_access_token, get_current_user, get_current_user_async
+from src.user_cache import CurrentUser, invalidate_user
 from datetime import datetime, timedelta
 from src.spotify import (
     build_spotify_login_url,
     exchange_code_for_access_token,
 )
+from src.token_sweeper import sweep
+from src.strava_models import StravaWebhookEvent
+from src.strava_webook import (
+    is_our_subscription,
+    record_event,
+    verify_subscription,
+)
 
-load_dotenv()
-FRONTEND_URL = os.getenv("FRONTEND_URL")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_async_client()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 @app.exception_handler(Exception)
 async def _log_unhandled(request: Request, exc: Exception):
-    logging.exception("Unhandled error on %s %s", request.method, request.url.path)
+    logging.exception(
+        "Unhandled error on %s %s (request %s)",
+        request.method,
+        request.url.path,
+        getattr(request.state, "request_id", "-"),
+    )
     return JSONResponse(status_code=500, content={"detail": "Internal server error"})
 
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[os.getenv("FRONTEND_URL", "*")],
+    allow_origins=[FRONTEND_URL or "*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.RequestTracer)
+# Added last, so outermost: a route's time includes everything the app does
+# for it, tracing included.
+app.add_middleware(metrics.RouteTimer)
+tracing.install_log_context()
 
 
 def redirect_with_error(error: str):
@@ -59,7 +82,9 @@ async def root():
 # Protected endpoint to test authentication
 # Returns the current authenticated user from the JWT token present in the request
 @app.get("/api/me")
-def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(
+    current_user: CurrentUser = Depends(get_current_user_async),
+):
     return current_user
 
 
@@ -76,7 +101,7 @@ def spotify_login(request: Request):
 
 # Receives the code and state from spotify, and then exchanges the code for an access token
 @app.get("/api/spotify/callback")
-async def spotify_callback(request: Request, db: Session = Depends(get_db)):
+async def spotify_callback(request: Request, db=Depends(get_async_db)):
     code: str | None = request.query_params.get("code")
     state: str | None = request.query_params.get("state")
     error: str | None = request.query_params.get("error")
@@ -92,7 +117,7 @@ async def spotify_callback(request: Request, db: Session = Depends(get_db)):
     rebeat_jwt = decoded_state.get("token")
 
     # Exchange the code for spotify tokens
-    token_response = exchange_code_for_access_token(code)
+    token_response = await exchange_code_for_access_token(code)
 
     if "error" in token_response or "access_token" not in token_response:
         return redirect_with_error("token_exchange_failed")
@@ -105,10 +130,10 @@ async def spotify_callback(request: Request, db: Session = Depends(get_db)):
     )  # Default to 1 hour if not provided
 
     # Get Spotify user profile
-    user_profile_url = "https://api.spotify.com/v1/me"
+    user_profile_url = f"{SPOTIFY_API_URL}/me"
     headers = {"Authorization": f"Bearer {spotify_access_token}"}
 
-    user_response = get(user_profile_url, headers=headers)
+    user_response = await get_async(user_profile_url, headers=headers, name="spotify.me")
     if user_response.status_code != 200:
         return redirect_with_error("profile_fetch_failed")
 
@@ -122,23 +147,27 @@ async def spotify_callback(request: Request, db: Session = Depends(get_db)):
     # Calculate token expiration time
     expires_at = datetime.now() + timedelta(seconds=expires_in)
 
-    user = find_or_create_user(db, "spotify", spotify_id, rebeat_jwt)
+    user = await find_or_create_user_async(db, "spotify", spotify_id, rebeat_jwt)
+    # Read before store_token_async commits.
+    user_id = user.id
     if not user.name and spotify_name:
         user.name = spotify_name
 
     # Store/update token in database
-    store_token(
+    await store_token_async(
         db=db,
-        user_id=user.id,
+        user_id=user_id,
         provider="spotify",
         access_token=spotify_access_token,
         refresh_token=refresh_token,
         expires_at=expires_at,
     )
+    # store_token_async committed any name set above; drop the cached copy of them.
+    invalidate_user(user_id)
 
     # Either this a new login with spotify, or the linking of a new spotify account to an existing rebeat user
     # In both cases, we can call this a new session and generate a JWT for it
-    rebeat_jwt = create_access_token(user.id)
+    rebeat_jwt = create_access_token(user_id)
     return RedirectResponse(url=f"{FRONTEND_URL}?token={rebeat_jwt}")
 
 
@@ -155,7 +184,7 @@ def strava_login(request: Request):
 # We can exchange the code for an access token and do what we will with it.
 # We can then either create or update a user, store their strava tokens, and redirect to the frontend with a JWT
 @app.get("/api/strava/callback")
-def strava_callback(request: Request, db: Session = Depends(get_db)):
+async def strava_callback(request: Request, db=Depends(get_async_db)):
     code = request.query_params.get("code")
     state = request.query_params.get("state")
     if not code:
@@ -168,7 +197,7 @@ def strava_callback(request: Request, db: Session = Depends(get_db)):
     rebeat_jwt = decoded_state.get("token")
 
     # Exchange the code for strava tokens
-    strava_auth = exchange_strava_code_for_access_token(code)
+    strava_auth = await exchange_strava_code_for_access_token(code)
     # TODO: Check we got the requested scopes
 
     # Extract Strava user ID from token response
@@ -178,40 +207,107 @@ def strava_callback(request: Request, db: Session = Depends(get_db)):
     refresh_token = strava_auth.refresh_token
     expires_at = datetime.fromtimestamp(strava_auth.expires_at)
 
-    user = find_or_create_user(db, "strava", strava_id, rebeat_jwt)
+    user = await find_or_create_user_async(db, "strava", strava_id, rebeat_jwt)
+    user_id = user.id
     if not user.name and strava_name:
         user.name = strava_name
 
     # Store/update token
-    store_token(
+    await store_token_async(
         db=db,
-        user_id=user.id,
+        user_id=user_id,
         provider="strava",
         access_token=access_token,
         refresh_token=refresh_token,
         expires_at=expires_at,
     )
+    # store_token_async committed any name set above; drop the cached copy of them.
+    invalidate_user(user_id)
 
     # Either this a new login with strava, or the linking of a new strava account to an existing rebeat user
     # In both cases, we can call this a new session and generate a JWT for it
-    rebeat_jwt = create_access_token(user.id)
+    rebeat_jwt = create_access_token(user_id)
     return RedirectResponse(url=f"{FRONTEND_URL}?token={rebeat_jwt}")
 
 
+# Strava checks the callback URL when subscribing by asking us to echo a challenge.
+@app.get("/api/strava/webhook")
+def strava_webhook_verify(request: Request):
+    challenge = verify_subscription(
+        request.query_params.get("hub.mode"),
+        request.query_params.get("hub.verify_token"),
+        request.query_params.get("hub.challenge"),
+    )
+    if challenge is None:
+        raise HTTPException(status_code=403, detail="Invalid verification request")
+    return {"hub.challenge": challenge}
+
+
+# Strava posts every activity and athlete event here and wants a 200 within 2s.
+# Store it and answer; a worker (src/worker.py) does the enhancement.
+@app.post("/api/strava/webhook")
+def strava_webhook_event(event: StravaWebhookEvent, db: Session = Depends(get_db)):
+    if not is_our_subscription(event):
+        raise HTTPException(status_code=403, detail="Unknown subscription")
+    record_event(db, event)
+    return {"received": True}
+
+
+# Routes that go on to the provider code, which takes a Session, authenticate
+# with the sync get_current_user. It shares the request's one Session, so the
+# request checks out a connection from one pool only, not one from each.
 @app.get("/api/latest")
 def latest_run(
-    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+    current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)
 ):
     return get_latest_run(current_user.id, db)
 
 
+# Recent activities, newest first, with whether each has a playlist yet. Page
+# with the `next_before` / `prev_after` cursors from the previous response.
+@app.get("/api/activities")
+def recent_activities(
+    before: int | None = None,
+    after: int | None = None,
+    per_page: int = Query(ACTIVITIES_PER_PAGE, ge=1, le=MAX_ACTIVITIES_PER_PAGE),
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    return list_recent_activities(current_user.id, db, before, after, per_page)
+
+
 @app.post("/api/latest")
-def add_to_latest_run(
-    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+async def add_to_latest_run(
+    current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)
 ):
-    return add_playlist_to_latest_run(current_user.id, current_user.spotify_id, db)
+    return await add_playlist_to_latest_run_async(
+        current_user.id, current_user.spotify_id, db
+    )
+
+
+# Refreshes tokens that are about to expire, so requests don't have to.
+# Called by a scheduler (e.g. Vercel Cron), which sends CRON_SECRET as a bearer token.
+@app.get("/api/cron/refresh-tokens")
+def refresh_tokens(request: Request, db: Session = Depends(get_db)):
+    if not CRON_SECRET or request.headers.get("authorization") != f"Bearer {CRON_SECRET}":
+        raise HTTPException(status_code=401, detail="Invalid cron secret")
+    result = sweep(db)
+    return {"refreshed": result.refreshed, "failed": len(result.failed)}
+
+
+# Scraped by Prometheus. Per process: each serverless instance reports its own.
+@app.get("/api/metrics")
+def get_metrics(request: Request):
+    if not METRICS_TOKEN or request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 # Run the app
 if __name__ == "__main__":
+    # Only needed here; the serverless runtime brings its own server.
+    import uvicorn
+
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
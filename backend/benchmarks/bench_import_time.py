@@ -0,0 +1,75 @@
+"""Where the time goes when `import app` runs in a fresh interpreter.
+
+Runs it under `python -X importtime` and totals the time spent in each
+top-level package's own modules, which is what a cold start pays before it
+can answer.
+
+    python benchmarks/bench_import_time.py --top 15
+
+Prints one JSON object: the total, and the most expensive packages.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+
+
+def importtime(statement: str) -> list[tuple[str, int, int, int]]:
+    """(module, self us, cumulative us, depth) for each import, in order."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=BACKEND,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    rows = importtime("import sys; sys.path[:0] = ['src', '.']; import app")
+
+    # -X importtime lists a module's imports before the module itself, so
+    # app's are the deeper rows just above it. Anything before that was the
+    # interpreter starting up.
+    end = next(i for i, row in enumerate(rows) if row[0] == "app" and row[3] == 0)
+    start = end
+    while start > 0 and rows[start - 1][3] > 0:
+        start -= 1
+    total_us = rows[end][2]
+
+    # Self times don't overlap, so per-package sums add up to the total.
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in rows[start : end + 1]:
+        by_package[name.split(".")[0]] += self_us
+
+    top = sorted(by_package.items(), key=lambda item: item[1], reverse=True)
+    print(
+        json.dumps(
+            {
+                "benchmark": "import_time",
+                "total_ms": round(total_us / 1000, 1),
+                "top_ms": {name: round(us / 1000, 1) for name, us in top[: args.top]},
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
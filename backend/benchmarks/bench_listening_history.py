@@ -0,0 +1,152 @@
+"""Per-call cost of matching an activity against listening history.
+
+Pure CPU, no database or network: `iso_to_unix` on Spotify's `played_at`
+format (and on dateutil, for comparison), and `select_tracks_in_window` for
+a 50-item recently-played buffer on its own and merged with archives of up
+to 100k plays -- what a backlog of activities against a long-lived archive
+looks like. The batch cases match BATCH_WINDOWS activities against one
+archive, which should cost barely more than matching one.
+
+    python benchmarks/bench_listening_history.py --archive-sizes 1000 100000
+
+Prints one JSON object per case, with the best of --repeat timings. The same
+cases, at the default sizes, run in tests/test_perf.py against the budgets in
+pyproject.toml.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+sys.path[:0] = [os.path.join(BACKEND, "src")]
+
+from listening_history import (  # noqa: E402
+    HISTORY_CAPACITY,
+    Archive,
+    select_tracks_in_window,
+    select_tracks_in_windows,
+)
+from time_utils import iso_to_unix  # noqa: E402
+
+ARCHIVE_SIZES = [1_000, 10_000, 100_000]
+# Windows matched per history in the batch cases.
+BATCH_WINDOWS = 20
+# One play every 3m20s, about what a steady listener manages.
+PLAY_SPACING_MS = 200_000
+# Where the newest play sits; any fixed point will do.
+NOW = datetime(2026, 8, 19, 10, 0, tzinfo=timezone.utc)
+
+
+def played_at(dt: datetime) -> str:
+    """Spotify's format: always UTC, always milliseconds."""
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def buffer_items() -> list:
+    """A full recently-played buffer, newest first."""
+    return [
+        {
+            "played_at": played_at(NOW - timedelta(milliseconds=i * PLAY_SPACING_MS)),
+            "track": {"id": f"track{i:06d}"},
+        }
+        for i in range(HISTORY_CAPACITY)
+    ]
+
+
+def archive_of(size: int) -> Archive:
+    """`size` archived plays, oldest first, ending where the buffer does.
+
+    The last HISTORY_CAPACITY of them are the buffer's own plays, as they are
+    once the poller has caught up.
+    """
+    newest_ms = int(NOW.timestamp() * 1000)
+    plays = [
+        (newest_ms - i * PLAY_SPACING_MS, f"track{i:06d}")
+        for i in reversed(range(size))
+    ]
+    return Archive(plays=plays, covered_since_ms=plays[0][0], cursor_ms=newest_ms)
+
+
+def run_window(archive: Archive | None) -> tuple[int, int]:
+    """An hour's run, two hours before NOW: just older than the buffer alone covers."""
+    end_ms = int((NOW - timedelta(hours=2)).timestamp() * 1000)
+    if archive is not None:
+        # Halfway back, so the window is in the middle of the archive.
+        end_ms = (archive.plays[0][0] + archive.plays[-1][0]) // 2
+    return end_ms - 3_600_000, end_ms
+
+
+def best_per_call(fn, number: int, repeat: int) -> float:
+    """Seconds per call of `fn()`, the best of `repeat` runs of `number` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def cases(archive_sizes=ARCHIVE_SIZES) -> dict:
+    """Case name -> (zero-argument callable, calls per timing run)."""
+    from dateutil import parser
+
+    sample = buffer_items()[0]["played_at"]
+    items = buffer_items()
+    start_ms, end_ms = run_window(None)
+    found = {
+        "iso_to_unix": (lambda: iso_to_unix(sample), 20_000),
+        "dateutil_isoparse": (lambda: parser.isoparse(sample).timestamp(), 2_000),
+        "select_buffer": (
+            lambda: select_tracks_in_window(items, start_ms, end_ms),
+            500,
+        ),
+    }
+    for size in archive_sizes:
+        archive = archive_of(size)
+        window = run_window(archive)
+        found[f"select_archive_{size}"] = (
+            lambda archive=archive, window=window: select_tracks_in_window(
+                items, *window, archive=archive
+            ),
+            max(1, 200_000 // size),
+        )
+        # A backlog: BATCH_WINDOWS runs spread across the archive, one history.
+        step = (archive.plays[-1][0] - archive.plays[0][0]) // BATCH_WINDOWS
+        windows = [
+            (archive.plays[0][0] + i * step, archive.plays[0][0] + i * step + 3_600_000)
+            for i in range(BATCH_WINDOWS)
+        ]
+        found[f"select_batch_{BATCH_WINDOWS}_archive_{size}"] = (
+            lambda archive=archive, windows=windows: select_tracks_in_windows(
+                items, windows, archive=archive
+            ),
+            max(1, 200_000 // size),
+        )
+    return found
+
+
+def measure(archive_sizes=ARCHIVE_SIZES, repeat: int = 5) -> dict:
+    """Case name -> best microseconds per call."""
+    return {
+        name: best_per_call(fn, number, repeat) * 1e6
+        for name, (fn, number) in cases(archive_sizes).items()
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--archive-sizes", nargs="+", type=int, default=ARCHIVE_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, us in measure(args.archive_sizes, args.repeat).items():
+        print(json.dumps({"benchmark": "listening_history", "case": name, "us_per_call": round(us, 2)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Writing long playlists with spotify.add_songs, against a local stand-in.
+
+Creates --playlists playlists of --tracks tracks each on the fake Spotify in
+benchmarks/fake_providers.py, which enforces the real 100-URI cap per call
+and keeps each playlist's tracks, so order and completeness can be checked.
+With --error-rate, that share of provider calls fail with a 503 and the
+writer's chunk retries are what's being measured.
+
+    python benchmarks/bench_playlist_writer.py --tracks 1000 --latency-ms 80 --error-rate 0.05
+
+Prints one JSON object: time per playlist, provider calls per playlist, and
+how many playlists came out complete and in order.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from fake_providers import Behaviour, FakeSpotify
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--playlists", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(Behaviour(args.latency_ms, args.jitter_ms, args.error_rate))
+    fake.start()
+    # Read by src.config when spotify is imported, so set first.
+    os.environ["SPOTIFY_API_URL"] = fake.api_url
+    sys.path[:0] = [BACKEND, os.path.join(BACKEND, "src")]
+    import spotify
+
+    track_ids = [f"track{i:06d}" for i in range(args.tracks)]
+    expected = [f"spotify:track:{tid}" for tid in track_ids]
+
+    timings, in_order, complete = [], 0, 0
+    calls_before = fake.requests
+    for _ in range(args.playlists):
+        playlist_id = spotify.create_playlist(
+            user_id="bench", token="bench", playlist_name="Bench",
+            playlist_description="", public=False,
+        )
+        started = time.perf_counter()
+        written = spotify.add_songs(track_ids, playlist_id, token="bench")
+        timings.append(time.perf_counter() - started)
+        complete += written.complete
+        in_order += fake.playlists[playlist_id] == expected
+    calls = fake.requests - calls_before - args.playlists  # less the creates
+
+    timings.sort()
+    print(
+        json.dumps(
+            {
+                "benchmark": "playlist_writer",
+                "playlists": args.playlists,
+                "tracks": args.tracks,
+                "provider_latency_ms": args.latency_ms,
+                "provider_jitter_ms": args.jitter_ms,
+                "provider_error_rate": args.error_rate,
+                "p50_ms": round(percentile(timings, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(timings, 0.95) * 1000, 1),
+                "provider_calls_per_playlist": round(calls / args.playlists, 2),
+                "complete": complete,
+                "in_order": in_order,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
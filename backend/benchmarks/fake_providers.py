@@ -0,0 +1,283 @@
+"""Local stand-ins for Spotify and Strava, for benchmarks.
+
+Each serves just enough of its provider's API for rebeat's flows to run end
+to end: the OAuth token exchange and refresh, the profile, recently-played,
+playlist creation and track adds on Spotify, and activities on Strava. The
+responses have the shapes the real APIs document. Nothing is stored but the
+tracks added to each playlist, so any number of benchmark users can share
+one server.
+
+Every response waits `latency_ms` plus or minus up to `jitter_ms` first, and
+`error_rate` of them are a 503 instead. Both are there to make the numbers
+look like a real provider's, not to test the error paths.
+
+An OAuth code of the form "<run>-<n>" maps to the same user every time: the
+Spotify id "bench-<run>-<n>" and the Strava athlete <run> * 10000 + <n>.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+HISTORY_SIZE = 50
+# Spotify's cap on URIs per add-items call.
+MAX_URIS_PER_ADD = 100
+# Plays are this far apart, so the buffer reaches back nearly three hours.
+PLAY_SPACING = timedelta(minutes=3, seconds=20)
+# The latest activity is a half-hour run that ended twenty minutes ago.
+RUN_ENDED_AGO = timedelta(minutes=20)
+RUN_DURATION = timedelta(minutes=30)
+
+
+@dataclass
+class Behaviour:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+
+    def delay(self) -> float:
+        jitter = random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def iso(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def code_parts(code: str) -> tuple[int, int]:
+    run, n = code.rsplit("-", 1)
+    return int(run), int(n)
+
+
+class FakeProvider(ThreadingHTTPServer):
+    daemon_threads = True
+    # Subclasses list (method, path pattern, handler name).
+    routes: list = []
+
+    def __init__(self, behaviour: Behaviour, extra_headers: dict | None = None):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.behaviour = behaviour
+        self.extra_headers = extra_headers or {}
+        self.requests = 0
+        self._count_lock = threading.Lock()
+        self._routes = [
+            (method, re.compile(pattern + "$"), getattr(self, name))
+            for method, pattern, name in self.routes
+        ]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeProvider":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def dispatch(self, method, path, headers, query: dict, form: dict, body):
+        with self._count_lock:
+            self.requests += 1
+        time.sleep(self.behaviour.delay())
+        if self.behaviour.fails():
+            return 503, {"error": "fake outage"}
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                return handler(
+                    *match.groups(), headers=headers, query=query, form=form, body=body
+                )
+        return 404, {"error": f"no fake for {method} {path}"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, the body
+    # waits out the client's delayed ACK, adding ~40ms to every response.
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        form, body = {}, None
+        if "json" in self.headers.get("Content-Type", ""):
+            body = json.loads(raw or b"null")
+        elif raw:
+            form = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+
+        status, payload = self.server.dispatch(
+            self.command, parts.path, self.headers, query, form, body
+        )
+        encoded = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        for name, value in self.server.extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    do_GET = do_POST = do_PUT = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSpotify(FakeProvider):
+    """Serves both accounts.spotify.com (at /) and api.spotify.com (at /v1)."""
+
+    routes = [
+        ("POST", r"/api/token", "token"),
+        ("GET", r"/v1/me", "me"),
+        ("GET", r"/v1/me/player/recently-played", "recently_played"),
+        ("POST", r"/v1/users/([^/]+)/playlists", "create_playlist"),
+        ("POST", r"/v1/playlists/([^/]+)/tracks", "add_tracks"),
+        ("GET", r"/v1/playlists/([^/]+)", "playlist"),
+    ]
+
+    def __init__(self, behaviour: Behaviour):
+        super().__init__(behaviour)
+        self.playlists: dict[str, list] = {}
+        self._playlists_lock = threading.Lock()
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/v1"
+
+    def token(self, form, **_):
+        if form.get("grant_type") == "authorization_code":
+            access_token = f"spotify-{form['code']}"
+        else:
+            access_token = f"spotify-refreshed-{random.getrandbits(32)}"
+        return 200, {
+            "access_token": access_token,
+            "token_type": "Bearer",
+            "scope": "user-read-recently-played playlist-modify-public",
+            "expires_in": 3600,
+            "refresh_token": f"refresh-{access_token}",
+        }
+
+    def me(self, headers, **_):
+        # Tokens from a code exchange embed the code, which names the user.
+        code = headers.get("Authorization", "").removeprefix("Bearer spotify-")
+        return 200, {"id": f"bench-{code}", "display_name": "Bench Runner"}
+
+    def recently_played(self, query, **_):
+        now = datetime.now(timezone.utc)
+        after = int(query["after"]) if "after" in query else None
+        items = []
+        for i in range(HISTORY_SIZE):
+            played_at = now - i * PLAY_SPACING
+            if after is not None and played_at.timestamp() * 1000 <= after:
+                break
+            items.append(
+                {
+                    "played_at": iso(played_at),
+                    "track": {"id": f"track{i:04d}", "name": f"Track {i}"},
+                }
+            )
+        return 200, {"items": items, "next": None}
+
+    def create_playlist(self, user_id, body, **_):
+        playlist_id = f"playlist{random.getrandbits(40):x}"
+        with self._playlists_lock:
+            self.playlists[playlist_id] = []
+        return 201, {"id": playlist_id, "name": body["name"]}
+
+    def add_tracks(self, playlist_id, body, **_):
+        uris = body["uris"]
+        if len(uris) > MAX_URIS_PER_ADD:
+            return 400, {"error": {"status": 400, "message": "Too many ids requested"}}
+        with self._playlists_lock:
+            tracks = self.playlists.setdefault(playlist_id, [])
+            position = body.get("position", len(tracks))
+            if position > len(tracks):
+                return 400, {"error": {"status": 400, "message": "Index out of bounds"}}
+            tracks[position:position] = uris
+            return 201, {"snapshot_id": f"{playlist_id}-{len(tracks)}"}
+
+    def playlist(self, playlist_id, **_):
+        with self._playlists_lock:
+            tracks = self.playlists.get(playlist_id, [])
+            return 200, {
+                "id": playlist_id,
+                "snapshot_id": f"{playlist_id}-{len(tracks)}",
+                "tracks": {"total": len(tracks)},
+            }
+
+
+class FakeStrava(FakeProvider):
+    routes = [
+        ("POST", r"/oauth/token", "token"),
+        ("GET", r"/api/v3/athlete/activities", "activities"),
+        ("GET", r"/api/v3/activities/(\d+)", "activity"),
+        ("PUT", r"/api/v3/activities/(\d+)", "update_activity"),
+    ]
+
+    def __init__(self, behaviour: Behaviour):
+        # Far below any limit, so the rate limit budget never gets in the way.
+        super().__init__(
+            behaviour,
+            {"X-RateLimit-Limit": "100000,1000000", "X-RateLimit-Usage": "1,1"},
+        )
+
+    def token(self, form, **_):
+        expires_at = int(time.time()) + 6 * 3600
+        tokens = {
+            "token_type": "Bearer",
+            "expires_at": expires_at,
+            "expires_in": 6 * 3600,
+            "refresh_token": f"refresh-{random.getrandbits(32)}",
+            "access_token": f"strava-{random.getrandbits(32)}",
+        }
+        if form.get("grant_type") != "authorization_code":
+            return 200, tokens
+        run, n = code_parts(form["code"])
+        now = iso(datetime.now(timezone.utc))
+        tokens["athlete"] = {
+            "id": run * 10000 + n,
+            "username": f"bench{n}",
+            "resource_state": 2,
+            "firstname": "Bench",
+            "lastname": "Runner",
+            "city": "Boulder",
+            "state": "CO",
+            "country": "US",
+            "sex": "F",
+            "premium": False,
+            "summit": False,
+            "created_at": now,
+            "updated_at": now,
+            "badge_type_id": 0,
+            "profile_medium": "https://example.test/medium.jpg",
+            "profile": "https://example.test/large.jpg",
+        }
+        return 200, tokens
+
+    def activities(self, **_):
+        return 200, [{"id": 9000000001, "type": "Run"}]
+
+    def activity(self, activity_id, **_):
+        start = datetime.now(timezone.utc) - RUN_ENDED_AGO - RUN_DURATION
+        return 200, {
+            "id": int(activity_id),
+            "name": "Morning Run",
+            "distance": 5000.0,
+            "moving_time": int(RUN_DURATION.total_seconds()) - 60,
+            "elapsed_time": int(RUN_DURATION.total_seconds()),
+            "start_date": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "description": "",
+        }
+
+    def update_activity(self, activity_id, form, **_):
+        status, activity = self.activity(activity_id)
+        activity["description"] = form.get("description", "")
+        return status, activity
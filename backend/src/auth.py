@@ -1,13 +1,14 @@
 import jwt
 from datetime import datetime, timedelta
-import os
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from .db import User, get_db
+from .config import JWT_SECRET_KEY
+from .db import get_async_db, get_db
+from .user_cache import CurrentUser, decoded_tokens, get_user, get_user_async
 
 # JWT configuration
-SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-for-development")
+SECRET_KEY = JWT_SECRET_KEY
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 7
 
@@ -27,6 +28,12 @@ def verify_token(token: str):
     """
     Verify and decode a JWT token
     """
+    # A token's signature and expiry can't change, so once checked it is
+    # good until it expires.
+    user_id = decoded_tokens.get(token)
+    if user_id is not None:
+        return user_id
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = int(payload.get("sub"))
@@ -35,6 +42,7 @@ def verify_token(token: str):
         if expiration < datetime.now():
             return None
 
+        decoded_tokens.put(token, user_id, expiration.timestamp())
         return user_id
     except:
         return None
@@ -42,9 +50,12 @@ def verify_token(token: str):
 
 def get_current_user(
     token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
-):
+) -> CurrentUser:
     """
     Get the current user from a JWT token
+
+    Usually from the user cache, in which case the session is never used and
+    no connection is checked out.
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -56,8 +67,28 @@ def get_current_user(
     if user_id is None:
         raise credentials_exception
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = get_user(db, user_id)
     if user is None:
         raise credentials_exception
 
     return user
+
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme), db=Depends(get_async_db)
+) -> CurrentUser:
+    """
+    get_current_user, for async routes
+
+    Runs on the event loop rather than in the threadpool, and a cache miss
+    reads the user through asyncpg.
+    """
+    user_id = verify_token(token)
+    user = await get_user_async(db, user_id) if user_id is not None else None
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
@@ -0,0 +1,32 @@
+"""Create the database schema: any missing tables and indexes.
+
+    python -m src.bootstrap
+
+Run it once against a new database, and again whenever a change adds a table
+or an index (on deploy, before the new code serves traffic). It only ever
+adds what's missing, so running it again is harmless. Changes to existing
+columns still need doing by hand.
+"""
+
+import argparse
+import logging
+from typing import List
+
+from src.db import create_schema, get_engine
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    engine = get_engine()
+    create_schema(engine)
+    logger.info("Schema is up to date on %s", engine.url.render_as_string())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,52 @@
+"""Settings from the environment, loaded once per process.
+
+The process environment wins; for local work, anything it doesn't set is
+read from backend/.env.local and then backend/.env (what `vercel env pull`
+writes), so a personal override can sit in .env.local without being
+clobbered by the next pull. On Vercel neither file exists, and python-dotenv
+isn't even imported.
+
+Module-specific tuning (HTTP_*, USER_CACHE_*, STRAVA_QUOTA_* and the like)
+is still read where it's used, documented alongside it; those reads happen
+after this module has loaded the files, since src.db imports it.
+"""
+
+import os
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_FILES = (".env.local", ".env")
+
+
+def load_env_files() -> None:
+    for name in ENV_FILES:
+        path = os.path.join(BACKEND_DIR, name)
+        if os.path.exists(path):
+            from dotenv import load_dotenv
+
+            # Never overrides, so earlier files and the real environment win.
+            load_dotenv(path, override=False)
+
+
+load_env_files()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+BASE_URL = os.getenv("BASE_URL")
+FRONTEND_URL = os.getenv("FRONTEND_URL")
+CRON_SECRET = os.getenv("CRON_SECRET")
+# /api/metrics wants it as a bearer token; unset, the endpoint refuses everyone.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-for-development")
+
+# Where the providers are. Only ever changed to point at local stand-ins, as
+# benchmarks/bench_e2e.py does.
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+STRAVA_URL = os.getenv("STRAVA_URL", "https://www.strava.com")
+
+SPOTIFY_CLIENT_ID = os.getenv("CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+
+STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
+STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
+STRAVA_WEBHOOK_VERIFY_TOKEN = os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN")
+STRAVA_SUBSCRIPTION_ID = os.getenv("STRAVA_SUBSCRIPTION_ID")
@@ -0,0 +1,84 @@
+"""A user and both their provider tokens, in one query.
+
+Adding a playlist needs the user, their Strava token and their Spotify
+token. Read separately that's three round trips. Read together it's one
+query: the user row joined to its tokens.
+
+`load_credentials` is what the user cache and the token cache run when they
+miss. Whatever it reads, it puts in both caches. A cold request pays that one
+query for all three, and the lookups after it are hits.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+
+from src.db import User
+from src.token_cache import token_cache
+from src.user_cache import USER_CACHE_TTL_SECONDS, CurrentUser, users
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+PROVIDERS = ("spotify", "strava")
+
+
+@dataclass(frozen=True)
+class ProviderToken:
+    access_token: str
+    expires_at: float  # Unix seconds
+
+
+@dataclass(frozen=True)
+class Credentials:
+    user: CurrentUser
+    spotify: ProviderToken | None = None
+    strava: ProviderToken | None = None
+
+    def token(self, provider: str) -> ProviderToken | None:
+        """The provider's token, or None if that account isn't connected."""
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider {provider!r}")
+        return getattr(self, provider)
+
+
+def load_credentials(db: Session, user_id: int) -> Credentials | None:
+    """The user and their tokens, read in one query and cached.
+
+    Returns None if there's no such user. A token with no expiry counts as
+    not connected. Only fresh tokens are cached; a stale one is left for
+    `get_access_token` to refresh.
+    """
+    row = db.execute(_user_with_tokens(user_id)).unique().scalar_one_or_none()
+    return _remember(user_id, row)
+
+
+async def load_credentials_async(db: "AsyncSession", user_id: int) -> Credentials | None:
+    """load_credentials, on an AsyncSession."""
+    row = (await db.execute(_user_with_tokens(user_id))).unique().scalar_one_or_none()
+    return _remember(user_id, row)
+
+
+def _user_with_tokens(user_id: int):
+    return select(User).options(joinedload(User.tokens)).where(User.id == user_id)
+
+
+def _remember(user_id: int, row: User | None) -> Credentials | None:
+    if row is None:
+        return None
+
+    tokens = {
+        token.provider: ProviderToken(token.access_token, token.expires_at.timestamp())
+        for token in row.tokens
+        if token.provider in PROVIDERS and token.expires_at is not None
+    }
+    credentials = Credentials(user=CurrentUser.from_row(row), **tokens)
+
+    users.put(user_id, credentials.user, time.time() + USER_CACHE_TTL_SECONDS)
+    for provider, token in tokens.items():
+        if token_cache.is_fresh(token.expires_at):
+            token_cache.put((user_id, provider), token.access_token, token.expires_at)
+    return credentials
@@ -1,7 +1,17 @@
 from datetime import datetime
+from sqlalchemy import exists, func, literal, select, union_all, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
+from typing import TYPE_CHECKING
 from src.db import Token, User
 from src.auth import verify_token
+from src.token_cache import token_cache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+# Both statements are kept as builders shared by the sync functions and their
+# async twins below, so the two can't drift apart.
 
 
 def store_token(
@@ -13,53 +23,115 @@ def store_token(
     expires_at: datetime = None,
 ):
     """
-    Store or update a token in the database
+    Store or update a token in the database, in one statement, and commit
+
+    A user has at most one token per provider (the uq_token_user_provider
+    index), so this is an INSERT ... ON CONFLICT DO UPDATE on that pair: two
+    callbacks racing can't leave two rows behind.
 
     Args:
         db: Database session
         user_id: ID of the user to associate the token with
         provider: Service provider name (e.g., 'spotify', 'strava')
         access_token: OAuth access token
-        refresh_token: OAuth refresh token
-        expires_at: Token expiration datetime
+        refresh_token: OAuth refresh token; the stored one is kept if not given
+        expires_at: Token expiration datetime; the stored one is kept if not given
 
     Returns:
-        The new or updated Token object
+        The stored Token, detached from the session with every column loaded,
+        so reading it costs no further query
+    """
+    token = db.scalars(
+        _token_upsert(user_id, provider, access_token, refresh_token, expires_at),
+        # The row may already be in the session, read FOR UPDATE by a refresh.
+        execution_options={"populate_existing": True},
+    ).one()
+    # Detached, the commit doesn't expire it, so callers can read it for free.
+    db.expunge(token)
+    # Also commits anything else pending, such as a name set on the user.
+    db.commit()
+    _cache_token(user_id, provider, token)
+    return token
+
+
+async def store_token_async(
+    db: "AsyncSession",
+    user_id: int,
+    provider: str,
+    access_token: str,
+    refresh_token: str = None,
+    expires_at: datetime = None,
+):
+    """
+    store_token, on an AsyncSession
     """
-    # Check if token already exists
     token = (
-        db.query(Token)
-        .filter(Token.user_id == user_id, Token.provider == provider)
-        .first()
+        await db.scalars(
+            _token_upsert(user_id, provider, access_token, refresh_token, expires_at),
+            execution_options={"populate_existing": True},
+        )
+    ).one()
+    db.expunge(token)
+    await db.commit()
+    _cache_token(user_id, provider, token)
+    return token
+
+
+def _token_upsert(user_id, provider, access_token, refresh_token, expires_at):
+    now = datetime.now()
+    stored = insert(Token).values(
+        user_id=user_id,
+        provider=provider,
+        access_token=access_token,
+        refresh_token=refresh_token or None,
+        expires_at=expires_at,
+        created_at=now,
+        updated_at=now,
+    )
+    return (
+        stored.on_conflict_do_update(
+            index_elements=[Token.user_id, Token.provider],
+            set_={
+                "access_token": stored.excluded.access_token,
+                "refresh_token": func.coalesce(
+                    stored.excluded.refresh_token, Token.refresh_token
+                ),
+                "expires_at": func.coalesce(stored.excluded.expires_at, Token.expires_at),
+                "updated_at": now,
+            },
+        ).returning(Token)
     )
 
-    if token:
-        # Update existing token
-        token.access_token = access_token
-        if refresh_token:
-            token.refresh_token = refresh_token
-        if expires_at:
-            token.expires_at = expires_at
-    else:
-        # Create new token
-        token = Token(
-            user_id=user_id,
-            provider=provider,
-            access_token=access_token,
-            refresh_token=refresh_token,
-            expires_at=expires_at,
-        )
-        db.add(token)
 
-    db.commit()
-    return token
+def _cache_token(user_id: int, provider: str, token: Token) -> None:
+    # Whatever this process had cached for the user is now stale: a reconnect
+    # may have revoked it, and a refresh has just replaced it.
+    if token.expires_at:
+        token_cache.put(
+            (user_id, provider), token.access_token, token.expires_at.timestamp()
+        )
+    else:
+        token_cache.invalidate((user_id, provider))
 
 
 def find_or_create_user(
     db: Session, provider: str, provider_id: str, rebeat_jwt: str = None
 ):
     """
-    Find or create a user based on a provider ID and JWT token
+    Find or create a user based on a provider ID and JWT token, in one statement
+
+    In order of preference, the user is:
+    - whoever already has this provider ID;
+    - the user the JWT names, now linked to it, if they have no account with
+      this provider yet;
+    - the user the JWT names, unchanged, if they're already linked to another
+      account with this provider;
+    - a new user with just this provider ID.
+
+    One INSERT ... ON CONFLICT DO UPDATE with the other two as CTEs, so two
+    sign-ins racing with the same provider ID end up with the same user.
+    Doesn't commit: the callback's store_token commits the user together
+    with their token, and the callback then drops them from the user cache.
 
     Args:
         db: Database session
@@ -70,31 +142,61 @@ def find_or_create_user(
     Returns:
         User object
     """
-    # Check provider field name based on provider type
+    return db.scalars(
+        _user_lookup(provider, provider_id, rebeat_jwt),
+        execution_options={"populate_existing": True},
+    ).first()
+
+
+async def find_or_create_user_async(
+    db: "AsyncSession", provider: str, provider_id: str, rebeat_jwt: str = None
+):
+    """
+    find_or_create_user, on an AsyncSession
+    """
+    return (
+        await db.scalars(
+            _user_lookup(provider, provider_id, rebeat_jwt),
+            execution_options={"populate_existing": True},
+        )
+    ).first()
+
+
+def _user_lookup(provider: str, provider_id: str, rebeat_jwt: str = None):
     provider_field = f"{provider}_id"
+    column = getattr(User, provider_field)
+    users = User.__table__
+    jwt_user_id = verify_token(rebeat_jwt) if rebeat_jwt else None
+
+    existing = select(users).where(column == provider_id).cte("existing")
+    found = [~exists(select(existing.c.id))]
+    ctes = [existing]
+    if jwt_user_id:
+        linked = (
+            update(users)
+            .where(User.id == jwt_user_id, column.is_(None), *found)
+            .values({provider_field: provider_id})
+            .returning(*users.c)
+            .cte("linked")
+        )
+        found.append(~exists(select(linked.c.id)))
+        # Linked to another account with this provider already: left as it is.
+        kept = select(users).where(User.id == jwt_user_id, *found).cte("kept")
+        found.append(~exists(select(kept.c.id)))
+        ctes.extend([linked, kept])
+    new_user = insert(users).from_select(
+        [provider_field, "created_at"],
+        select(literal(provider_id), literal(datetime.now())).where(*found),
+    )
+    created = (
+        # On a conflict, someone signed in with this ID since `existing` looked:
+        # a no-op update hands back their row.
+        new_user.on_conflict_do_update(
+            index_elements=[column], set_={provider_field: new_user.excluded[provider_field]}
+        )
+        .returning(*users.c)
+        .cte("created")
+    )
+    ctes.append(created)
 
-    # Check if user exists with this provider ID
-    filter_args = {provider_field: provider_id}
-    user = db.query(User).filter_by(**filter_args).first()
-
-    # If no user with this provider ID, try to get from JWT if provided
-    if not user and rebeat_jwt:
-        user_id = verify_token(rebeat_jwt)
-        if user_id:
-            user = db.query(User).filter(User.id == user_id).first()
-
-            # Link provider account to existing user
-            if user and not getattr(user, provider_field):
-                setattr(user, provider_field, provider_id)
-                db.commit()
-
-    # If still no user, create new account
-    if not user:
-        # Create new user with provider ID
-        new_user_args = {provider_field: provider_id}
-        user = User(**new_user_args)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-
-    return user
+    return select(User).from_statement(union_all(*(select(cte) for cte in ctes)))
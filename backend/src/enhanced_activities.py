@@ -0,0 +1,170 @@
+"""Which activities have a playlist, so that each gets exactly one.
+
+Clicking "add" twice, or Strava delivering a webhook twice, used to make a
+second playlist and append a second link to the description. Now every
+enhancement starts by claiming its (user, activity) row:
+
+- No row yet: one is inserted as "pending" and leased to the caller.
+- "done": the caller gets the existing playlist back and makes no calls.
+- "pending" and still leased: another request is on it right now.
+- "failed", or "pending" with a lapsed lease: leased to the caller again. Any
+  playlist already made is kept, so a retry finishes the job instead of
+  starting over with a second playlist.
+
+A claim is one INSERT ... ON CONFLICT DO UPDATE ... WHERE, so two requests
+racing for the same activity can't both win it.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from src.db import EnhancedActivity
+from src.tracing import traced
+
+# Longer than an enhancement takes, retries included.
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+@dataclass(frozen=True)
+class Enhancement:
+    activity_id: int
+    status: str
+    playlist_id: str | None = None
+    playlist_url: str | None = None
+
+    @property
+    def result(self) -> dict:
+        """What a duplicate request gets back instead of a second playlist."""
+        return {
+            "id": self.activity_id,
+            "status": self.status,
+            "playlist_url": self.playlist_url,
+        }
+
+
+@traced
+def claim(
+    db: Session, user_id: int, activity_id: int, lease: timedelta = CLAIM_LEASE
+) -> tuple[bool, Enhancement]:
+    """Try to take on enhancing an activity. Commits.
+
+    Returns whether the caller won the claim, and the row as it now stands.
+    A winner may find a playlist already on it, left by an attempt that
+    failed after making one.
+    """
+    now = datetime.now()
+    row = EnhancedActivity
+    claimed = db.execute(
+        insert(row)
+        .values(
+            user_id=user_id,
+            strava_activity_id=activity_id,
+            status="pending",
+            claimed_until=now + lease,
+            created_at=now,
+            updated_at=now,
+        )
+        .on_conflict_do_update(
+            index_elements=[row.user_id, row.strava_activity_id],
+            set_={
+                "status": "pending",
+                "claimed_until": now + lease,
+                "error": None,
+                "updated_at": now,
+            },
+            where=or_(
+                row.status == "failed",
+                and_(row.status == "pending", row.claimed_until < now),
+            ),
+        )
+        .returning(row.status, row.playlist_id, row.playlist_url)
+    ).first()
+    if claimed is None:
+        # The conflict's WHERE didn't match: it's done, or someone holds it.
+        existing = db.execute(
+            select(row.status, row.playlist_id, row.playlist_url).where(
+                row.user_id == user_id, row.strava_activity_id == activity_id
+            )
+        ).one()
+        db.commit()
+        return False, Enhancement(activity_id, *existing)
+    db.commit()
+    return True, Enhancement(activity_id, *claimed)
+
+
+def _set(db: Session, user_id: int, activity_id: int, **values) -> None:
+    db.execute(
+        update(EnhancedActivity)
+        .where(
+            EnhancedActivity.user_id == user_id,
+            EnhancedActivity.strava_activity_id == activity_id,
+        )
+        .values(updated_at=datetime.now(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+@traced
+def record_playlist(
+    db: Session,
+    user_id: int,
+    activity_id: int,
+    playlist_url: str,
+    shortfall: str | None = None,
+) -> None:
+    """Note the playlist as soon as it exists, before the description is written.
+
+    `shortfall` says which tracks didn't make it into a partial playlist. It
+    goes in `error`, and stays there once the enhancement is done.
+    """
+    playlist_id = playlist_url.rstrip("/").rsplit("/", 1)[-1]
+    _set(
+        db,
+        user_id,
+        activity_id,
+        playlist_id=playlist_id,
+        playlist_url=playlist_url,
+        error=shortfall,
+    )
+
+
+@traced
+def finish(db: Session, user_id: int, activity_id: int) -> None:
+    _set(
+        db,
+        user_id,
+        activity_id,
+        status="done",
+        claimed_until=None,
+        enhanced_at=datetime.now(),
+    )
+
+
+@traced
+def release(db: Session, user_id: int, activity_id: int, error: str) -> None:
+    """Give up a claim after a failure, leaving the activity free to retry."""
+    _set(
+        db, user_id, activity_id, status="failed", claimed_until=None, error=error[:2000]
+    )
+
+
+@traced
+def lookup(
+    db: Session, user_id: int, activity_ids: Iterable[int]
+) -> Dict[int, Enhancement]:
+    """The enhancement rows for any of `activity_ids` that have one. One query."""
+    activity_ids = list(activity_ids)
+    if not activity_ids:
+        return {}
+    row = EnhancedActivity
+    rows = db.execute(
+        select(row.strava_activity_id, row.status, row.playlist_id, row.playlist_url)
+        .where(row.user_id == user_id, row.strava_activity_id.in_(activity_ids))
+    ).all()
+    return {r[0]: Enhancement(*r) for r in rows}
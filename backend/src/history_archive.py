@@ -0,0 +1,192 @@
+"""A persistent archive of each user's plays, kept ahead of Spotify's eviction.
+
+recently-played only ever holds the last HISTORY_CAPACITY plays, which is why
+older or longer runs end in `horizon_exceeded`. The poller (src/history_poller.py)
+copies new plays into `listening_plays` using the `after` cursor, so each poll
+only returns what is new. As long as it polls before the buffer wraps, the
+archive is gap-free and `select_tracks_in_window` can see as far back as it
+goes.
+
+How often to poll is per user: each poll measures how fast they've been
+listening, and the next one is scheduled for when about half the buffer will
+have turned over. Heavy listeners get polled every quarter hour or so; someone
+who plays an album a week costs one call every twelve hours.
+
+If a poll finds the buffer turned over completely, some plays may have been
+evicted unseen, and the archive's coverage restarts from that poll.
+"""
+
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from listening_history import DEFAULT_PAD_MS, HISTORY_CAPACITY, Archive
+from src.db import ListeningArchiveState, ListeningPlay, Token
+from src.tracing import traced
+from time_utils import iso_to_unix
+
+MIN_POLL_INTERVAL = timedelta(minutes=15)
+MAX_POLL_INTERVAL = timedelta(hours=12)
+# Poll when this much of the buffer is expected to have been replaced, which
+# leaves the other half as slack for a burst of listening.
+TURNOVER_FRACTION = 0.5
+# Weight of the newest observation in the smoothed listening rate.
+RATE_SMOOTHING = 0.3
+# How long a claimed user is held before another poller may take them.
+POLL_LEASE = timedelta(minutes=5)
+
+
+def observed_rate(
+    plays: List[Tuple[int, str]], new_count: int, elapsed: timedelta | None
+) -> float:
+    """Plays per hour seen by one poll.
+
+    With a previous poll to measure from, new plays over the time since. On a
+    first poll there is none, so use the span of the buffer itself.
+    """
+    if elapsed is not None:
+        hours = elapsed.total_seconds() / 3600
+        return new_count / hours if hours > 0 else 0.0
+    if len(plays) < 2:
+        return 0.0
+    span_hours = (plays[-1][0] - plays[0][0]) / 3_600_000
+    return (len(plays) - 1) / span_hours if span_hours > 0 else 0.0
+
+
+def smooth_rate(previous: float, observed: float, first: bool) -> float:
+    if first:
+        return observed
+    return RATE_SMOOTHING * observed + (1 - RATE_SMOOTHING) * previous
+
+
+def next_poll_interval(
+    plays_per_hour: float, capacity: int = HISTORY_CAPACITY
+) -> timedelta:
+    if plays_per_hour <= 0:
+        return MAX_POLL_INTERVAL
+    interval = timedelta(hours=capacity * TURNOVER_FRACTION / plays_per_hour)
+    return max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval))
+
+
+def enroll_connected_users(db: Session) -> None:
+    """Give every user with a Spotify token an archive state, due now."""
+    db.execute(
+        insert(ListeningArchiveState)
+        .from_select(
+            ["user_id", "next_poll_at", "plays_per_hour"],
+            select(Token.user_id, datetime.now(), 0.0).where(
+                Token.provider == "spotify"
+            ),
+        )
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    db.commit()
+
+
+def claim_due(db: Session, limit: int) -> List[ListeningArchiveState]:
+    """Lease up to `limit` users whose poll is due, and commit the lease.
+
+    The lease pushes next_poll_at out by POLL_LEASE, so concurrent pollers
+    skip them, and a poller that dies leaves them due again shortly after.
+    """
+    now = datetime.now()
+    due = (
+        select(ListeningArchiveState.user_id)
+        .where(ListeningArchiveState.next_poll_at <= now)
+        .order_by(ListeningArchiveState.next_poll_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    user_ids = db.execute(
+        update(ListeningArchiveState)
+        .where(ListeningArchiveState.user_id.in_(due.scalar_subquery()))
+        .values(next_poll_at=now + POLL_LEASE)
+        .returning(ListeningArchiveState.user_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.commit()
+    if not user_ids:
+        return []
+    return (
+        db.query(ListeningArchiveState)
+        .filter(ListeningArchiveState.user_id.in_(user_ids))
+        .all()
+    )
+
+
+def record_poll(
+    db: Session,
+    state: ListeningArchiveState,
+    items: list,
+    capacity: int = HISTORY_CAPACITY,
+) -> int:
+    """Archive what one poll returned and schedule the next. Doesn't commit.
+
+    Returns how many plays were new.
+    """
+    now = datetime.now()
+    plays = sorted(
+        (iso_to_unix(item["played_at"]), item["track"]["id"]) for item in items
+    )
+    first = state.cursor_ms is None
+    new = plays if first else [p for p in plays if p[0] > state.cursor_ms]
+
+    if new:
+        db.execute(
+            insert(ListeningPlay)
+            .values(
+                [
+                    {"user_id": state.user_id, "played_at": ms, "track_id": track_id}
+                    for ms, track_id in new
+                ]
+            )
+            .on_conflict_do_nothing(constraint="uq_listening_play")
+        )
+
+    if first:
+        # A buffer that isn't full has never evicted anything.
+        state.covered_since_ms = new[0][0] if len(items) >= capacity else 0
+    elif len(new) >= capacity:
+        # Nothing we'd already seen is left in the buffer, so plays between the
+        # old cursor and the oldest new one may have come and gone unseen.
+        state.covered_since_ms = new[0][0]
+    if new:
+        state.cursor_ms = new[-1][0]
+
+    elapsed = None if state.last_polled_at is None else now - state.last_polled_at
+    state.plays_per_hour = smooth_rate(
+        state.plays_per_hour or 0.0,
+        observed_rate(plays, len(new), elapsed),
+        first=state.last_polled_at is None,
+    )
+    state.last_polled_at = now
+    state.next_poll_at = now + next_poll_interval(state.plays_per_hour, capacity)
+    return len(new)
+
+
+@traced
+def load_archive(
+    db: Session, user_id: int, start_ms: int, end_ms: int
+) -> Archive | None:
+    """The user's archive around a window, or None if they have none yet."""
+    state = db.get(ListeningArchiveState, user_id)
+    if state is None or state.cursor_ms is None:
+        return None
+    plays = db.execute(
+        select(ListeningPlay.played_at, ListeningPlay.track_id)
+        .where(
+            ListeningPlay.user_id == user_id,
+            ListeningPlay.played_at.between(
+                start_ms - DEFAULT_PAD_MS, end_ms + DEFAULT_PAD_MS
+            ),
+        )
+        .order_by(ListeningPlay.played_at)
+    ).all()
+    return Archive(
+        plays=[tuple(play) for play in plays],
+        covered_since_ms=state.covered_since_ms or 0,
+        cursor_ms=state.cursor_ms,
+    )
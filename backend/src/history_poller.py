@@ -0,0 +1,144 @@
+"""Poll connected users' recently-played into the history archive.
+
+    python -m src.history_poller
+
+Each run enrolls any newly connected Spotify users, claims the users whose
+poll is due (src/history_archive.py decides when that is), fetches what they
+have played since their cursor, and archives it. Run it from cron every few
+minutes; users are only actually polled when their own schedule says so, so
+running it often costs a cheap query, not Spotify calls.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from src.db import SessionLocal
+from src.history_archive import (
+    MAX_POLL_INTERVAL,
+    claim_due,
+    enroll_connected_users,
+    record_poll,
+)
+from spotify import get_recently_played, get_spotify_access_token_from_db
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 8
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PollResult:
+    polled: int = 0
+    new_plays: int = 0
+    failed: int = 0
+
+
+def _fetch(user_id: int, token: str, after_ms: int | None) -> list | None:
+    try:
+        return get_recently_played(token, after_ms=after_ms)
+    except Exception:
+        logger.exception("Polling recently-played for user %s failed", user_id)
+        return None
+
+
+def poll_due(
+    db: Session,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> PollResult:
+    """Poll every user who is due, a batch at a time.
+
+    Tokens are looked up on this thread (they're usually in the token cache);
+    only the Spotify calls fan out. A user whose poll fails is tried again
+    after MAX_POLL_INTERVAL rather than on every run.
+
+    One user's failure is rolled back before the next user is handled, so
+    that a database error doesn't leave the session's transaction aborted for
+    the rest of the run.
+    """
+    result = PollResult()
+    enroll_connected_users(db)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            states = claim_due(db, batch_size)
+            if not states:
+                break
+
+            tokens = {}
+            for state in states:
+                try:
+                    tokens[state.user_id] = get_spotify_access_token_from_db(
+                        state.user_id, db
+                    )
+                except Exception:
+                    logger.exception("No usable Spotify token for user %s", state.user_id)
+                    # A failed refresh may have left the transaction aborted,
+                    # or still holding the token's row lock. Nothing else is
+                    # pending yet: the lease is committed, and archiving
+                    # comes after every lookup.
+                    db.rollback()
+
+            polled = [state for state in states if state.user_id in tokens]
+            responses = list(
+                pool.map(
+                    _fetch,
+                    [state.user_id for state in polled],
+                    [tokens[state.user_id] for state in polled],
+                    [state.cursor_ms for state in polled],
+                )
+            )
+
+            for state in states:
+                if state.user_id not in tokens:
+                    state.next_poll_at = datetime.now() + MAX_POLL_INTERVAL
+                    result.failed += 1
+            for state, items in zip(polled, responses):
+                if items is not None:
+                    # A savepoint each, so one user's failure undoes only
+                    # their own writes.
+                    try:
+                        with db.begin_nested():
+                            result.new_plays += record_poll(db, state, items)
+                        result.polled += 1
+                        continue
+                    except Exception:
+                        logger.exception("Archiving plays for user %s failed", state.user_id)
+                state.next_poll_at = datetime.now() + MAX_POLL_INTERVAL
+                result.failed += 1
+            db.commit()
+
+    return result
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        result = poll_due(db, batch_size=args.batch_size, concurrency=args.concurrency)
+    finally:
+        db.close()
+
+    logger.info(
+        "Polled %d users, archived %d new plays, %d failed",
+        result.polled,
+        result.new_plays,
+        result.failed,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,450 @@
+"""The one HTTP client every call to Spotify and Strava goes through.
+
+A single `POST /api/latest` makes around eight provider calls across three
+hosts (api.spotify.com, accounts.spotify.com, www.strava.com). Through bare
+`requests.get/post/put` each of those opened its own TCP connection and did its
+own TLS handshake; here they share a keep-alive pool per host, so only the
+first call to each host pays for the handshake.
+
+Every call also gets an explicit (connect, read) timeout. `requests` has no
+default, so a provider that accepts the connection and never answers would
+otherwise hold a worker until the platform kills it.
+
+Failed calls are retried, but only where a retry can't do harm:
+
+- 429 is always retried, after the response's Retry-After. A rate-limited
+  request was refused, not processed, so even creating a playlist is safe to
+  send again.
+- 5xx, read timeouts and dropped connections are retried with jittered
+  exponential backoff only for idempotent calls (GET and PUT by default). A
+  POST that timed out may well have created the playlist anyway.
+- A connect timeout never reached the server, so it is retried for anything.
+
+Retries are counted per host and reason; see `retry_counts`. Each call's
+latency and outcome is recorded under the name its caller gives it, as in
+`name="spotify.add_tracks"`, and it gets a span of that name in the
+request's trace; see src/metrics.py and src/tracing.py.
+
+Code running on the event loop, such as the OAuth callbacks, uses
+`request_async` and friends instead. They behave the same, but they're
+backed by one pooled `httpx.AsyncClient` per event loop, so waiting on a
+provider doesn't hold up the worker's other requests.
+
+`requests` and `httpx` are each imported when their client is first built,
+so a cold start that never calls a provider (the webhook ack, say) loads
+neither.
+
+Tuned through the environment, read once when the session is first built:
+
+    HTTP_POOL_CONNECTIONS  hosts to keep a pool for (default 4)
+    HTTP_POOL_MAXSIZE      keep-alive connections per host (default 10); the
+                           async client keeps the product of the two in all
+    HTTP_CONNECT_TIMEOUT   seconds to establish a connection (default 3.05)
+    HTTP_READ_TIMEOUT      seconds to wait between bytes of a response (default 15)
+    HTTP_MAX_RETRIES       retries after the first attempt (default 3)
+    HTTP_MAX_RETRY_AFTER   longest Retry-After to wait out, in seconds (default 10);
+                           past it the 429 goes back to the caller
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, suppress
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import urlsplit
+
+from src import metrics, tracing
+
+if TYPE_CHECKING:
+    import httpx
+    import requests
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+# Slightly over a multiple of 3s, the TCP retransmission window, as the
+# requests docs suggest.
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 15.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_MAX_RETRY_AFTER = 10.0
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 8.0
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRYABLE_STATUSES = frozenset({500, 502, 503, 504})
+
+_session: "requests.Session | None" = None
+# Event loop -> (its client, the async generator that closes it with the loop).
+_async_clients: dict = {}
+_timeout: tuple[float, float] = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+_max_retries = DEFAULT_MAX_RETRIES
+_max_retry_after = DEFAULT_MAX_RETRY_AFTER
+_lock = threading.Lock()
+
+_retries: Counter = Counter()
+_retries_lock = threading.Lock()
+
+
+def _build_session() -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(
+        pool_connections=int(
+            os.getenv("HTTP_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS)
+        ),
+        # Past this many concurrent calls to one host, urllib3 opens extra
+        # connections and discards them afterwards rather than blocking. Size
+        # it to the worker's concurrency, or the surplus pays the handshake.
+        pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE)),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _build_async_client() -> "httpx.AsyncClient":
+    import httpx
+
+    connect_timeout, read_timeout = _timeout
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        # httpx limits the pool as a whole rather than per host. Past the
+        # keep-alive limit, connections are opened and then discarded, as
+        # with urllib3, rather than waited for.
+        limits=httpx.Limits(
+            max_connections=None,
+            max_keepalive_connections=int(
+                os.getenv("HTTP_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS)
+            )
+            * int(os.getenv("HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE)),
+        ),
+    )
+
+
+def _read_settings() -> None:
+    global _timeout, _max_retries, _max_retry_after
+    _timeout = (
+        float(os.getenv("HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+        float(os.getenv("HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+    )
+    _max_retries = int(os.getenv("HTTP_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+    _max_retry_after = float(os.getenv("HTTP_MAX_RETRY_AFTER", DEFAULT_MAX_RETRY_AFTER))
+
+
+def get_session() -> "requests.Session":
+    """Return the process-wide session, building it on first use."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _read_settings()
+                _session = _build_session()
+    return _session
+
+
+def get_async_client() -> "httpx.AsyncClient":
+    """Return the running event loop's client, building it on first use.
+
+    An httpx connection belongs to the loop that opened it, so each loop has
+    its own client, and only that loop can close it. Under uvicorn that's one
+    client per worker, closed by the app's shutdown. A client on any other
+    loop is closed as the loop shuts down: asyncio.run finalizes the loop's
+    async generators on the way out, and one of them closes the client.
+    """
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        with _lock:
+            _read_settings()
+            client = _build_async_client()
+        lifetime = _closed_with_loop(client)
+        # Held here, or collecting it would close the client early.
+        entry = _async_clients[loop] = (client, lifetime)
+        # Runs at the client's first await, before it can hold a connection.
+        loop.create_task(_start(lifetime))
+    return entry[0]
+
+
+async def _start(lifetime) -> None:
+    with suppress(StopAsyncIteration):  # closed before it ran
+        await anext(lifetime)
+
+
+async def _closed_with_loop(client: "httpx.AsyncClient"):
+    try:
+        yield
+    finally:
+        loop = asyncio.get_running_loop()
+        if _async_clients.get(loop, (None,))[0] is client:
+            del _async_clients[loop]
+        await client.aclose()
+
+
+async def close_async_client() -> None:
+    """Close the running loop's client, for the app's shutdown."""
+    entry = _async_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, lifetime = entry
+        await lifetime.aclose()
+        # If it never got started, there's nothing open; close it all the same.
+        await client.aclose()
+
+
+def reset_session() -> None:
+    """Drop the pooled clients so the next call builds fresh ones."""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        # A client still in here belongs to a loop that is running elsewhere,
+        # or was closed without shutting down its async generators. The first
+        # is closed on its loop as its lifetime is collected; the second can't
+        # be closed at all, and its connections go when it's collected.
+        _async_clients.clear()
+
+
+def retry_counts() -> dict[tuple[str, str], int]:
+    """Retries so far, keyed by (host, reason)."""
+    with _retries_lock:
+        return dict(_retries)
+
+
+def _count_retry(url: str, reason: str) -> None:
+    with _retries_lock:
+        _retries[(urlsplit(url).hostname or "", reason)] += 1
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (from 1)."""
+    ceiling = min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+def retry_after_seconds(response: "requests.Response") -> float | None:
+    """The Retry-After header in seconds, or None if absent or unreadable."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        # The HTTP-date form; neither provider sends it.
+        return None
+
+
+def request(
+    method: str,
+    url: str,
+    idempotent: bool | None = None,
+    name: str | None = None,
+    retries: int | None = None,
+    before_attempt: Callable[[], None] | None = None,
+    **kwargs,
+) -> "requests.Response":
+    """Same signature as `requests.request`, but pooled, bounded, retried and timed.
+
+    `idempotent` overrides the method's default for whether 5xx responses and
+    timeouts mid-request are safe to retry, and `retries` the most retries
+    (HTTP_MAX_RETRIES). `name`, "<provider>.<call>", is what the call's
+    latency and errors are recorded under. `before_attempt` is called before
+    every attempt, retries included, and may raise to stop the call: that's
+    how the Strava budget counts retries (see src/strava_quota.py).
+    """
+    with _observed(method, url, name) as outcome:
+        outcome.append(
+            _request(method, url, idempotent, retries, before_attempt, **kwargs)
+        )
+    return outcome[0]
+
+
+async def request_async(
+    method: str,
+    url: str,
+    idempotent: bool | None = None,
+    name: str | None = None,
+    retries: int | None = None,
+    before_attempt: Callable[[], None] | None = None,
+    **kwargs,
+) -> "httpx.Response":
+    """`request`, for the event loop: awaits the provider instead of blocking.
+
+    Takes the same arguments, except that a (connect, read) `timeout` may
+    also be an `httpx.Timeout`.
+    """
+    with _observed(method, url, name) as outcome:
+        outcome.append(
+            await _request_async(method, url, idempotent, retries, before_attempt, **kwargs)
+        )
+    return outcome[0]
+
+
+@contextmanager
+def _observed(method: str, url: str, name: str | None):
+    """Time the call, record its outcome and give it a span.
+
+    The caller appends the response to the list it's handed.
+    """
+    name = name or f"other.{method.lower()}"
+    outcome = []
+    started = time.perf_counter()
+    try:
+        with tracing.span(
+            name,
+            kind="client",
+            **{"http.request.method": method, "url.full": url.split("?", 1)[0]},
+        ):
+            yield outcome
+            tracing.annotate(**{"http.response.status_code": outcome[0].status_code})
+    except Exception as exc:
+        metrics.record_provider_call(
+            name, time.perf_counter() - started, None, type(exc).__name__
+        )
+        raise
+    metrics.record_provider_call(
+        name, time.perf_counter() - started, outcome[0].status_code, None
+    )
+
+
+def _request(
+    method: str,
+    url: str,
+    idempotent: bool | None,
+    retries: int | None,
+    before_attempt: Callable[[], None] | None,
+    **kwargs,
+) -> "requests.Response":
+    import requests
+
+    session = get_session()
+    retries = _max_retries if retries is None else retries
+    kwargs.setdefault("timeout", _timeout)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            retry = _retry_error("connect_timeout", attempt, idempotent, retries)
+            if retry is None:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            retry = _retry_error("connection_error", attempt, idempotent, retries)
+            if retry is None:
+                raise
+        else:
+            retry = _retry_response(response, attempt, idempotent, retries)
+            if retry is None:
+                return response
+            # Hand the connection back to the pool before waiting.
+            response.close()
+
+        attempt += 1
+        reason, delay = retry
+        _count_retry(url, reason)
+        tracing.annotate(retries=attempt, last_retry_reason=reason)
+        time.sleep(delay)
+
+
+async def _request_async(
+    method: str,
+    url: str,
+    idempotent: bool | None,
+    retries: int | None,
+    before_attempt: Callable[[], None] | None,
+    **kwargs,
+) -> "httpx.Response":
+    import httpx
+
+    client = get_async_client()
+    retries = _max_retries if retries is None else retries
+    if isinstance(kwargs.get("timeout"), tuple):
+        connect_timeout, read_timeout = kwargs["timeout"]
+        kwargs["timeout"] = httpx.Timeout(read_timeout, connect=connect_timeout)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.ConnectTimeout:
+            retry = _retry_error("connect_timeout", attempt, idempotent, retries)
+            if retry is None:
+                raise
+        except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError):
+            retry = _retry_error("connection_error", attempt, idempotent, retries)
+            if retry is None:
+                raise
+        else:
+            retry = _retry_response(response, attempt, idempotent, retries)
+            if retry is None:
+                return response
+            await response.aclose()
+
+        attempt += 1
+        reason, delay = retry
+        _count_retry(url, reason)
+        tracing.annotate(retries=attempt, last_retry_reason=reason)
+        await asyncio.sleep(delay)
+
+
+def _retry_error(
+    reason: str, attempt: int, idempotent: bool, retries: int
+) -> tuple[str, float] | None:
+    """(reason, delay) to retry after a failed attempt, or None to raise."""
+    if attempt >= retries:
+        return None
+    # A connect timeout never reached the server, so is safe whatever the method.
+    if reason == "connection_error" and not idempotent:
+        return None
+    return reason, backoff_seconds(attempt + 1)
+
+
+def _retry_response(
+    response, attempt: int, idempotent: bool, retries: int
+) -> tuple[str, float] | None:
+    """(reason, delay) to retry after this response, or None to return it."""
+    if response.status_code == 429:
+        delay = retry_after_seconds(response)
+        if delay is None:
+            delay = backoff_seconds(attempt + 1)
+        if attempt >= retries or delay > _max_retry_after:
+            return None
+        return "rate_limited", delay
+    if response.status_code in RETRYABLE_STATUSES and idempotent:
+        if attempt >= retries:
+            return None
+        return "server_error", backoff_seconds(attempt + 1)
+    return None
+
+
+def get(url: str, **kwargs) -> "requests.Response":
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> "requests.Response":
+    return request("POST", url, **kwargs)
+
+
+def put(url: str, **kwargs) -> "requests.Response":
+    return request("PUT", url, **kwargs)
+
+
+async def get_async(url: str, **kwargs) -> "httpx.Response":
+    return await request_async("GET", url, **kwargs)
+
+
+async def post_async(url: str, **kwargs) -> "httpx.Response":
+    return await request_async("POST", url, **kwargs)
@@ -0,0 +1,213 @@
+"""A durable job queue in the jobs table, for work that shouldn't hold a request.
+
+Anything that can happen after a response -- enhancing an activity a webhook
+told us about, for one -- is enqueued here and run by `python -m src.worker`.
+Postgres is the only moving part, so bursts (Sunday morning long runs) queue up
+instead of tying up web workers, and nothing is lost when a process dies.
+
+- Claiming is `FOR UPDATE SKIP LOCKED`, so any number of workers in any number
+  of processes can poll the same table without handing a job out twice.
+- A claimed job is leased until `locked_until`. If its worker dies mid-job
+  the lease lapses and the job becomes claimable again, as long as it has
+  attempts left. A job that keeps killing or hanging its worker is marked
+  "failed" once they're spent, like one that keeps raising.
+- A failed job goes back in the queue with jittered exponential backoff until
+  it runs out of attempts, then stays as "failed" with its last error.
+
+Handlers register by kind with `@job_handler("kind")` and take the payload and
+a Session. Raising fails the attempt; returning completes the job. Raising
+`Deferred` puts the job back until later without counting the attempt, for
+work that can't run yet through no fault of its own.
+"""
+
+import logging
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+
+from src.db import Job
+
+DEFAULT_VISIBILITY_TIMEOUT = timedelta(minutes=5)
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_CAP_SECONDS = 60 * 60
+
+JobHandler = Callable[[dict, Session], None]
+HANDLERS: Dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    def register(fn: JobHandler) -> JobHandler:
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+class Deferred(Exception):
+    """Raised by a handler to have its job run again at `until`, attempt unspent."""
+
+    def __init__(self, until: datetime, reason: str):
+        super().__init__(reason)
+        self.until = until
+
+
+@dataclass(frozen=True)
+class ClaimedJob:
+    id: int
+    kind: str
+    payload: dict
+    attempts: int
+    max_attempts: int
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before retrying after the `attempts`th failure.
+
+    Full jitter: uniform between zero and an exponentially growing ceiling, so
+    jobs that failed together (a provider outage) don't all retry together.
+    """
+    ceiling = min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+    return random.uniform(0, ceiling)
+
+
+def enqueue(
+    db: Session,
+    kind: str,
+    payload: dict,
+    run_after: datetime | None = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> Job:
+    """Add a job. Doesn't commit: it lands with whatever the caller commits."""
+    job = Job(
+        kind=kind,
+        payload=payload,
+        status="queued",
+        run_after=run_after or datetime.now(),
+        max_attempts=max_attempts,
+    )
+    db.add(job)
+    return job
+
+
+def claim(
+    db: Session,
+    limit: int = 1,
+    visibility_timeout: timedelta = DEFAULT_VISIBILITY_TIMEOUT,
+) -> List[ClaimedJob]:
+    """Lease up to `limit` due jobs to the caller, and commit the lease."""
+    now = datetime.now()
+    lapsed = and_(Job.status == "running", Job.locked_until < now)
+    # Every attempt on these was lost with its worker: give up on them.
+    db.execute(
+        update(Job)
+        .where(lapsed, Job.attempts >= Job.max_attempts)
+        .values(
+            status="failed",
+            locked_until=None,
+            last_error="Lease lapsed on the last attempt",
+            updated_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    due = (
+        select(Job.id)
+        .where(
+            or_(
+                and_(Job.status == "queued", Job.run_after <= now),
+                # Leased by a worker that never finished it.
+                and_(lapsed, Job.attempts < Job.max_attempts),
+            )
+        )
+        .order_by(Job.run_after)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    rows = db.execute(
+        update(Job)
+        .where(Job.id.in_(due.scalar_subquery()))
+        .values(
+            status="running",
+            attempts=Job.attempts + 1,
+            locked_until=now + visibility_timeout,
+            updated_at=now,
+        )
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return [ClaimedJob(*row) for row in rows]
+
+
+def complete(db: Session, job: ClaimedJob) -> None:
+    db.execute(
+        update(Job)
+        .where(Job.id == job.id)
+        .values(
+            status="done", locked_until=None, last_error=None, updated_at=datetime.now()
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def fail(db: Session, job: ClaimedJob, error: str) -> None:
+    """Record a failed attempt: back in the queue later, or failed for good."""
+    now = datetime.now()
+    if job.attempts >= job.max_attempts:
+        values = {"status": "failed"}
+    else:
+        values = {
+            "status": "queued",
+            "run_after": now + timedelta(seconds=backoff_seconds(job.attempts)),
+        }
+    db.execute(
+        update(Job)
+        .where(Job.id == job.id)
+        .values(locked_until=None, last_error=error[:2000], updated_at=now, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def defer(db: Session, job: ClaimedJob, until: datetime, reason: str) -> None:
+    db.execute(
+        update(Job)
+        .where(Job.id == job.id)
+        .values(
+            status="queued",
+            run_after=until,
+            # Give back the attempt the claim took.
+            attempts=Job.attempts - 1,
+            locked_until=None,
+            last_error=reason[:2000],
+            updated_at=datetime.now(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def run(db: Session, job: ClaimedJob) -> bool:
+    """Run a claimed job's handler and record the outcome. True if it succeeded."""
+    handler = HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job kind {job.kind!r}")
+        handler(job.payload, db)
+    except Deferred as e:
+        logging.info("Job %s (%s) deferred until %s: %s", job.id, job.kind, e.until, e)
+        db.rollback()
+        defer(db, job, e.until, str(e))
+        return False
+    except Exception as e:
+        logging.exception("Job %s (%s) attempt %s failed", job.id, job.kind, job.attempts)
+        db.rollback()
+        fail(db, job, repr(e))
+        return False
+    complete(db, job)
+    return True
@@ -10,11 +10,17 @@ That gives us a *horizon*: the oldest play we can still see. Anything before it
 is invisible, and invisible is not the same as absent. This module keeps those
 two apart so callers can tell a user "you weren't listening" only when that is
 actually true.
+
+The history archive (src/history_archive.py) pushes the horizon back: it copies
+plays out of the buffer before they are evicted. It only helps where it is
+gap-free, so it comes with the range it is known to cover, and the same
+visible-versus-absent distinction applies to that range.
 """
 
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from time_utils import iso_to_unix
 
@@ -41,6 +47,23 @@ class Status(str, Enum):
     NO_HISTORY = "no_history"
 
 
+@dataclass
+class Archive:
+    """Plays copied out of the buffer by the poller, and the range they cover.
+
+    Every play between `covered_since_ms` and `cursor_ms` is in the archive;
+    outside that range it knows nothing. `covered_since_ms` is 0 when the
+    archive starts from a buffer that had never been full, i.e. from the very
+    beginning of the user's listening.
+    """
+
+    # (played_at in Unix ms, track id), oldest first; at least every play in
+    # the window.
+    plays: List[Tuple[int, str]]
+    covered_since_ms: int
+    cursor_ms: int
+
+
 @dataclass
 class Selection:
     status: Status
@@ -53,45 +76,131 @@ class Selection:
         return self.status in (Status.OK, Status.PARTIAL)
 
 
-def select_tracks_in_window(
-    items: list,
-    start_ms: int,
-    end_ms: int,
-    pad_ms: int = DEFAULT_PAD_MS,
-    capacity: int = HISTORY_CAPACITY,
-) -> Selection:
-    """Pick the tracks played during [start_ms, end_ms] and classify the result.
+@dataclass
+class History:
+    """Everything we can see of a user's listening, ready to match windows against.
 
-    `items` is the raw `items` array from recently-played, newest first. Pure --
-    no network, no clock, no tokens -- so it can be tested against fixtures.
+    Built once by `build_history` and then shared by every window, which is
+    what makes matching several activities cheap: the plays are parsed, merged
+    and sorted once, and each window is two binary searches.
     """
-    if not items:
-        return Selection(status=Status.NO_HISTORY)
 
+    # Parallel lists, oldest first: played_at in Unix ms, and its track id.
+    played_at: List[int]
+    track_ids: List[str]
+    # Plays before this may be missing. None: nothing is missing.
+    lost_before: Optional[int]
+    archive: Optional[Archive] = None
+
+    @property
+    def horizon_ms(self) -> Optional[int]:
+        if self.lost_before is not None:
+            return self.lost_before
+        return self.played_at[0] if self.played_at else None
+
+
+def build_history(
+    items: list, capacity: int = HISTORY_CAPACITY, archive: Optional[Archive] = None
+) -> History:
+    """Merge the recently-played `items` (newest first) with the archive, if any."""
     plays = sorted(
         (iso_to_unix(item["played_at"]), item["track"]["id"]) for item in items
     )
-    horizon_ms = plays[0][0]
-
-    window_start = start_ms - pad_ms
-    window_end = end_ms + pad_ms
-    track_ids = [tid for played_at, tid in plays if window_start <= played_at <= window_end]
 
     # Eviction only happens once the buffer is full. If Spotify returned fewer
     # than `capacity` items then nothing has been dropped, the horizon is simply
     # the start of this user's listening, and a miss is a genuine miss.
     buffer_full = len(items) >= capacity
-    lost_history = buffer_full and window_start < horizon_ms
+    lost_before = plays[0][0] if buffer_full else None
+
+    if archive is not None:
+        # Buffer and archive share plays where they overlap; keep one of each.
+        # Both are already in order, so this sort is a single merge pass --
+        # unlike sorting a set of them, which is ~10x slower on a big archive.
+        in_buffer = set(plays)
+        plays = sorted(plays + [p for p in archive.plays if p not in in_buffer])
+        if lost_before is None or archive.cursor_ms >= lost_before:
+            # The archive reaches the buffer, so together they are gap-free
+            # back to wherever the archive's coverage starts.
+            lost_before = archive.covered_since_ms or None
+
+    return History(
+        played_at=[played_at for played_at, _ in plays],
+        track_ids=[tid for _, tid in plays],
+        lost_before=lost_before,
+        archive=archive,
+    )
+
+
+def select_in_history(
+    history: History, start_ms: int, end_ms: int, pad_ms: int = DEFAULT_PAD_MS
+) -> Selection:
+    """Pick the tracks played during [start_ms, end_ms] from a built history."""
+    if not history.played_at:
+        return Selection(status=Status.NO_HISTORY)
+
+    window_start = start_ms - pad_ms
+    window_end = end_ms + pad_ms
+    # Oldest first, so the playlist reads in the order the run was run.
+    track_ids = history.track_ids[
+        bisect_left(history.played_at, window_start) : bisect_right(
+            history.played_at, window_end
+        )
+    ]
+
+    lost_before, archive = history.lost_before, history.archive
+    lost_history = lost_before is not None and window_start < lost_before
+    if lost_history and archive is not None:
+        # A window inside the archive's own range is still fully seen, even
+        # when there's a gap between the archive and the buffer.
+        lost_history = not (
+            archive.covered_since_ms <= window_start and window_end <= archive.cursor_ms
+        )
 
     if track_ids:
-        # Oldest first, so the playlist reads in the order the run was run.
         return Selection(
             status=Status.PARTIAL if lost_history else Status.OK,
             track_ids=track_ids,
-            horizon_ms=horizon_ms,
+            horizon_ms=history.horizon_ms,
         )
 
     if lost_history:
-        return Selection(status=Status.HORIZON_EXCEEDED, horizon_ms=horizon_ms)
+        return Selection(status=Status.HORIZON_EXCEEDED, horizon_ms=history.horizon_ms)
+
+    return Selection(status=Status.NO_SONGS_PLAYED, horizon_ms=history.horizon_ms)
+
+
+def select_tracks_in_windows(
+    items: list,
+    windows: List[Tuple[int, int]],
+    pad_ms: int = DEFAULT_PAD_MS,
+    capacity: int = HISTORY_CAPACITY,
+    archive: Optional[Archive] = None,
+) -> List[Selection]:
+    """`select_tracks_in_window` for many (start_ms, end_ms) windows at once.
+
+    One Selection per window, in the same order. The archive, if any, should
+    cover all of them.
+    """
+    history = build_history(items, capacity, archive)
+    return [select_in_history(history, start, end, pad_ms) for start, end in windows]
+
+
+def select_tracks_in_window(
+    items: list,
+    start_ms: int,
+    end_ms: int,
+    pad_ms: int = DEFAULT_PAD_MS,
+    capacity: int = HISTORY_CAPACITY,
+    archive: Optional[Archive] = None,
+) -> Selection:
+    """Pick the tracks played during [start_ms, end_ms] and classify the result.
 
-    return Selection(status=Status.NO_SONGS_PLAYED, horizon_ms=horizon_ms)
+    `items` is the raw `items` array from recently-played, newest first. Pure --
+    no network, no clock, no tokens -- so it can be tested against fixtures.
+    With an `archive`, its plays are merged in and its coverage counts towards
+    what we can see.
+    """
+    return select_tracks_in_windows(
+        items, [(start_ms, end_ms)], pad_ms, capacity, archive
+    )[0]
@@ -0,0 +1,372 @@
+"""Latency histograms and counters, exposed in Prometheus' text format.
+
+What's recorded, and where:
+
+- rebeat_http_request_seconds: every route, by its template, from the
+  middleware in app.py.
+- rebeat_provider_request_seconds / rebeat_provider_errors_total: every
+  Spotify and Strava call, by the name its call site gives it, from
+  src/http_client.py. The time covers retries: it's what the caller waited.
+- rebeat_provider_retries_total: http_client's retry counts, read at scrape.
+- rebeat_db_query_seconds: every SQL statement, by operation and table, from
+  SQLAlchemy's cursor events on the engine.
+- rebeat_db_checkout_seconds and rebeat_db_connections_*: how long getting a
+  connection takes, and how many this process opens and holds, by pool mode
+  (see src/db.py).
+- rebeat_selection_total: how track selection came out, by Status.
+
+Served at /api/metrics. Values are per process and start from zero when it
+does, which is what Prometheus' rate() and histogram_quantile() expect. No
+client library: the format is a few lines of text, and a cold start
+shouldn't pay to import one.
+"""
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Seconds. From a cache hit to a provider call that ran out of retries.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (not cumulative), then sum, count.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        # Le buckets: an observation equal to a bound belongs to that bucket.
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, totals = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0, 0])
+            )
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block took, however it exits."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[1][1] if entry else 0
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), list(totals)))
+                for key, (counts, totals) in self._values.items()
+            )
+        for key, (counts, (total, count)) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                yield (
+                    f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_number(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class _Collected(_Metric):
+    """A counter whose values are read from elsewhere at scrape time."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels, collect: Callable[[], Dict[LabelValues, float]]):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def reset(self) -> None:
+        pass
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}"
+
+
+REGISTRY: List[_Metric] = []
+
+
+def _retry_counts() -> Dict[LabelValues, float]:
+    from src import http_client
+
+    return dict(http_client.retry_counts())
+
+
+http_request_seconds = Histogram(
+    "rebeat_http_request_seconds",
+    "Time to handle a request, by route template and response status.",
+    ("method", "route", "status"),
+)
+provider_request_seconds = Histogram(
+    "rebeat_provider_request_seconds",
+    "Time for a Spotify or Strava call, retries included, by call and final status.",
+    ("provider", "call", "status"),
+)
+provider_errors_total = Counter(
+    "rebeat_provider_errors_total",
+    "Provider calls that failed, by call and why: an HTTP status class or an exception.",
+    ("provider", "call", "reason"),
+)
+provider_retries_total = _Collected(
+    "rebeat_provider_retries_total",
+    "Retries made by the provider client, by host and reason.",
+    ("host", "reason"),
+    _retry_counts,
+)
+db_query_seconds = Histogram(
+    "rebeat_db_query_seconds",
+    "Time to execute a SQL statement, by operation and table.",
+    ("statement",),
+)
+db_checkout_seconds = Histogram(
+    "rebeat_db_checkout_seconds",
+    "Time to get a database connection: waiting for the pool, connecting, pinging.",
+    ("mode",),
+)
+db_connections_opened_total = Counter(
+    "rebeat_db_connections_opened_total",
+    "Database connections opened. Less those closed, the ones open now.",
+    ("mode",),
+)
+db_connections_closed_total = Counter(
+    "rebeat_db_connections_closed_total",
+    "Database connections closed.",
+    ("mode",),
+)
+db_connections_checked_out = Gauge(
+    "rebeat_db_connections_checked_out",
+    "Database connections in use right now.",
+    ("mode",),
+)
+selection_total = Counter(
+    "rebeat_selection_total",
+    "Track selections for a run, by outcome.",
+    ("status",),
+)
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text exposition format (0.0.4)."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def reset() -> None:
+    """Zero everything recorded so far. For tests."""
+    for metric in REGISTRY:
+        metric.reset()
+
+
+# --- routes --------------------------------------------------------------
+
+
+class RouteTimer:
+    """ASGI middleware that times each request under its route's template.
+
+    The template ("/api/activities", not the URL actually requested) keeps
+    the label set bounded; requests no route matched share "unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500  # unless the response says otherwise
+
+        async def send_and_note_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_note_status)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=str(status),
+            )
+
+
+# --- provider calls ------------------------------------------------------
+
+
+def record_provider_call(name: str, seconds: float, status: int | None, error: str | None):
+    """Record one provider call. `name` is "<provider>.<call>"."""
+    provider, _, call = name.partition(".")
+    status_label = str(status) if status is not None else "error"
+    provider_request_seconds.observe(seconds, provider=provider, call=call, status=status_label)
+    if error is None and status is not None and status >= 400:
+        error = "429" if status == 429 else f"{status // 100}xx"
+    if error is not None:
+        provider_errors_total.inc(provider=provider, call=call, reason=error)
+
+
+# --- SQL -----------------------------------------------------------------
+
+_OPERATION = re.compile(r"^\s*(\w+)")
+# Where each operation names its table.
+_TABLE = {
+    "SELECT": re.compile(r"\bFROM\s+\"?(\w+)", re.IGNORECASE),
+    "INSERT": re.compile(r"\bINTO\s+\"?(\w+)", re.IGNORECASE),
+    "UPDATE": re.compile(r"^\s*UPDATE\s+\"?(\w+)", re.IGNORECASE),
+    "DELETE": re.compile(r"\bFROM\s+\"?(\w+)", re.IGNORECASE),
+}
+
+
+def statement_label(sql: str) -> str:
+    """"SELECT users", "INSERT enhanced_activities" and the like: low-cardinality."""
+    operation = _OPERATION.match(sql)
+    if operation is None:
+        return "OTHER"
+    operation = operation.group(1).upper()
+    table = _TABLE.get(operation)
+    match = table.search(sql) if table else None
+    return f"{operation} {match.group(1)}" if match else operation
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement `engine` executes, and count its connections."""
+    from sqlalchemy import event
+
+    mode = getattr(engine.pool, "mode", type(engine.pool).__name__)
+
+    @event.listens_for(engine, "connect")
+    def _opened(dbapi_connection, record):
+        db_connections_opened_total.inc(mode=mode)
+
+    @event.listens_for(engine, "close")
+    def _closed(dbapi_connection, record):
+        db_connections_closed_total.inc(mode=mode)
+
+    @event.listens_for(engine, "checkout")
+    def _checked_out(dbapi_connection, record, proxy):
+        db_connections_checked_out.inc(mode=mode)
+
+    @event.listens_for(engine, "checkin")
+    def _checked_in(dbapi_connection, record):
+        db_connections_checked_out.dec(mode=mode)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("rebeat_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finished(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["rebeat_query_started"].pop()
+        db_query_seconds.observe(
+            time.perf_counter() - started, statement=statement_label(statement)
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        # after_cursor_execute doesn't run for a failed statement.
+        stack = context.connection.info.get("rebeat_query_started") if context.connection else None
+        if stack:
+            stack.pop()
@@ -1,36 +1,61 @@
 from urllib.parse import urlencode
-import os
 import base64
-import requests
+from src import config, http_client, metrics
 from db_ops import store_token
 from spotify_models import RefreshSpotifyAccessTokenResponse
-from dotenv import load_dotenv
 from src.helpers import build_state
 from sqlalchemy.orm import Session
 from src.db import Token
+from src.token_cache import REFRESH_HTTP_TIMEOUT, get_access_token
+from src.tracing import traced
 from time_utils import iso_to_unix
+from src.history_archive import load_archive
 from listening_history import (
     HISTORY_CAPACITY,
+    Archive,
+    Selection,
     Status,
     select_tracks_in_window,
 )
+import logging
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-base_url = os.getenv("BASE_URL")
+base_url = config.BASE_URL
 
-spotify_client_id = os.getenv("CLIENT_ID")
-spotify_client_secret = os.getenv("CLIENT_SECRET")
+spotify_client_id = config.SPOTIFY_CLIENT_ID
+spotify_client_secret = config.SPOTIFY_CLIENT_SECRET
 spotify_redirect_uri = f"{base_url}/api/spotify/callback"
-SPOTIFY_ACCESS_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_ACCESS_TOKEN_URL = f"{config.SPOTIFY_ACCOUNTS_URL}/api/token"
 
 
 def build_headers(token: str):
     return {"Authorization": f"Bearer {token}"}
 
 
+def raise_for_spotify_status(response, what: str) -> None:
+    """Turn a failed Spotify call into a clean error instead of a bad value.
+
+    Reached only once the provider client has given up retrying, so a 429
+    here means Spotify wants us to back off for longer than a request can wait.
+    """
+    if response.status_code == 429:
+        raise HTTPException(
+            status_code=503,
+            detail="Spotify is rate limiting us right now. Try again in a minute.",
+            headers={"Retry-After": response.headers.get("Retry-After", "60")},
+        )
+    if not 200 <= response.status_code < 300:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Spotify returned {response.status_code} when {what}.",
+        )
+
+
 def _format_horizon(horizon_ms: int) -> str:
     """Render the history horizon for a user-facing message."""
     return (
@@ -40,7 +65,8 @@ def _format_horizon(horizon_ms: int) -> str:
 
 
 # Helper to exchange the code for an access token via spotify's API
-def exchange_code_for_access_token(code: str) -> str:
+# On the event loop, so a slow token endpoint doesn't hold up other requests.
+async def exchange_code_for_access_token(code: str) -> dict:
     base64_encoded_client_id_and_secret = base64.b64encode(
         f"{spotify_client_id}:{spotify_client_secret}".encode()
     ).decode()
@@ -54,12 +80,14 @@ def exchange_code_for_access_token(code: str) -> str:
         "content-type": "application/x-www-form-urlencoded",
         "Authorization": f"Basic {base64_encoded_client_id_and_secret}",
     }
-    response = requests.post(SPOTIFY_ACCESS_TOKEN_URL, data=form, headers=headers)
+    response = await http_client.post_async(
+        SPOTIFY_ACCESS_TOKEN_URL, data=form, headers=headers, name="spotify.token"
+    )
     return response.json()
 
 
 def build_spotify_login_url(token=None):
-    url = "https://accounts.spotify.com/authorize"
+    url = f"{config.SPOTIFY_ACCOUNTS_URL}/authorize"
 
     state = build_state(token)
 
@@ -76,20 +104,28 @@ def build_spotify_login_url(token=None):
 
 
 # TODO: probably combine this with exchange_code_for_access_token
-def refresh_spotify_access_token(
-    token: Token, db: Session
-) -> RefreshSpotifyAccessTokenResponse:
+def fetch_refreshed_spotify_token(refresh_token: str) -> dict:
+    """Trade a refresh token for new credentials. Network only, no DB.
+
+    Returns the fields of a tokens row: access_token, refresh_token and
+    expires_at. Spotify only sometimes rotates the refresh token, so the one
+    passed in is kept when it doesn't.
+    """
     base64_encoded_client_id_and_secret = base64.b64encode(
         f"{spotify_client_id}:{spotify_client_secret}".encode()
     ).decode()
 
     body = {
         "grant_type": "refresh_token",
-        "refresh_token": token.refresh_token,
+        "refresh_token": refresh_token,
     }
-    response = requests.post(
+    response = http_client.post(
         SPOTIFY_ACCESS_TOKEN_URL,
+        name="spotify.refresh_token",
         data=body,
+        # Runs under the token's refresh lock; see src/token_cache.py.
+        timeout=REFRESH_HTTP_TIMEOUT,
+        retries=0,
         headers={
             "Content-Type": "application/x-www-form-urlencoded",
             "Authorization": f"Basic {base64_encoded_client_id_and_secret}",
@@ -107,28 +143,25 @@ def refresh_spotify_access_token(
         RefreshSpotifyAccessTokenResponse.model_validate(response_json)
     )
 
-    expires_at = datetime.now() + timedelta(seconds=object.expires_in)
+    return {
+        "access_token": object.access_token,
+        "refresh_token": object.refresh_token or refresh_token,
+        "expires_at": datetime.now() + timedelta(seconds=object.expires_in),
+    }
+
 
-    store_token(
+def refresh_spotify_access_token(token: Token, db: Session) -> Token:
+    return store_token(
         db=db,
         user_id=token.user_id,
         provider="spotify",
-        access_token=object.access_token,
-        refresh_token=object.refresh_token or token.refresh_token,
-        expires_at=expires_at,
+        **fetch_refreshed_spotify_token(token.refresh_token),
     )
-    return object
 
 
-def get_spotify_access_token_from_db(user_id: int, db: Session):
-    token = (
-        db.query(Token)
-        .filter(Token.user_id == user_id, Token.provider == "spotify")
-        .first()
-    )
-    if token.expires_at.timestamp() < datetime.now().timestamp():
-        token = refresh_spotify_access_token(token, db)
-    return token.access_token
+@traced
+def get_spotify_access_token_from_db(user_id: int, db: Session) -> str:
+    return get_access_token(user_id, "spotify", db, refresh_spotify_access_token)
 
 
 """
@@ -163,26 +196,25 @@ def create_playlist(
     playlist_description: str,
     public: bool,
 ) -> str:
-    SPOTIFY_CREATE_PLAYLIST_URL = "https://api.spotify.com/v1/users/{user_id}/playlists"
+    SPOTIFY_CREATE_PLAYLIST_URL = config.SPOTIFY_API_URL + "/users/{user_id}/playlists"
     data = {
         "name": playlist_name,
         "description": playlist_description,
         "public": public,
     }
 
-    try:
-        response = requests.post(
-            SPOTIFY_CREATE_PLAYLIST_URL.format(user_id=user_id),
-            headers=build_headers(token),
-            json=data,
-        )
-        response.raise_for_status()
-
-        # Return ID of playlist for now.
-        return response.json()["id"]
+    # Not idempotent: a retry after a timeout could create a second playlist,
+    # so the client only retries this when Spotify refused it outright (429).
+    response = http_client.post(
+        SPOTIFY_CREATE_PLAYLIST_URL.format(user_id=user_id),
+        headers=build_headers(token),
+        json=data,
+        name="spotify.create_playlist",
+    )
+    raise_for_spotify_status(response, "creating your playlist")
 
-    except requests.exceptions.RequestException as e:
-        return {"error": str(e)}
+    # Return ID of playlist for now.
+    return response.json()["id"]
 
 
 """
@@ -212,102 +244,201 @@ Returns:
 """
 
 
-def get_recently_played(token: str) -> list:
+def get_recently_played(token: str, after_ms: int | None = None) -> list:
     """Fetch the whole recently-played buffer, newest first.
 
-    No `before`/`after` cursor: the buffer only ever holds HISTORY_CAPACITY
-    items and the cursors cannot page outside it, so asking for all of it and
-    filtering locally is both simpler and strictly more informative -- it gives
-    us the horizon for free. Note that the response's `next` field is non-null
-    even when following it yields nothing, so it is not a usable signal.
+    No `before` cursor: the buffer only ever holds HISTORY_CAPACITY items and
+    the cursors cannot page outside it, so asking for all of it and filtering
+    locally is both simpler and strictly more informative -- it gives us the
+    horizon for free. Note that the response's `next` field is non-null even
+    when following it yields nothing, so it is not a usable signal.
+
+    `after_ms` is for the history archive, which only wants what's new since
+    its last poll.
     """
-    SPOTIFY_RECENTLY_PLAYED_URL = "https://api.spotify.com/v1/me/player/recently-played"
+    SPOTIFY_RECENTLY_PLAYED_URL = f"{config.SPOTIFY_API_URL}/me/player/recently-played"
 
-    response = requests.get(
+    params = {"limit": HISTORY_CAPACITY}
+    if after_ms is not None:
+        params["after"] = after_ms
+    response = http_client.get(
         SPOTIFY_RECENTLY_PLAYED_URL,
         headers=build_headers(token),
-        params={"limit": HISTORY_CAPACITY},
+        params=params,
+        name="spotify.recently_played",
     )
 
-    if response.status_code != 200:
-        raise Exception(response.status_code, response.json())
+    raise_for_spotify_status(response, "reading your listening history")
 
     return response.json()["items"]
 
 
-def add_songs(
-    recently_played_songs_id_array: list, playlist_id: str, token: str
-) -> dict:
-    SPOTIFY_ADD_TO_PLAYLIST_URL = (
-        "https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    )
-
-    data = {
-        "uris": [f"spotify:track:{x}" for x in recently_played_songs_id_array],
-        "position": 0,
-    }
-
-    try:
-        response = requests.post(
-            SPOTIFY_ADD_TO_PLAYLIST_URL.format(playlist_id=playlist_id),
-            headers=build_headers(token),
-            json=data,
+# Spotify's add-items endpoint takes at most this many URIs per call.
+MAX_TRACKS_PER_ADD = 100
+# Passes over the chunks still unwritten before giving up on them.
+ADD_ATTEMPTS = 3
+
+
+@dataclass
+class PlaylistWrite:
+    """What `add_songs` got into the playlist: all of it, or how far it got."""
+
+    requested: int
+    added: int = 0
+    # From the last add that landed; names the playlist version we left it at.
+    snapshot_id: str | None = None
+    # Chunks that never landed: (index of their first track, why), in order.
+    failed: list = field(default_factory=list)
+
+    @property
+    def complete(self) -> bool:
+        return self.added == self.requested
+
+    @property
+    def shortfall(self) -> str | None:
+        """What the playlist is missing, for the enhancement row; None if nothing."""
+        if self.complete:
+            return None
+        first, error = self.failed[0]
+        return (
+            f"Partial playlist: added {self.added} of {self.requested} tracks; "
+            f"the chunk from track {first} failed: {error}"
         )
-        response.raise_for_status()
 
-        # Return response object
-        return response.json()
 
-    except requests.exceptions.RequestException as e:
-        return {"error": str(e)}
+@dataclass(frozen=True)
+class RunPlaylist:
+    """A run's playlist: its web URL, and how much of the selection it holds."""
 
+    url: str
+    written: PlaylistWrite
 
-"""
-Function to build a Spotify playlist after an activity based on the user's recently played songs.
 
-Parameters:
-    user_id (str): The Spotify user ID.
-    playlist_name (str): The name of the playlist to be created.
-    playlist_description (str): The description of the playlist.
-    public (bool): Whether the playlist should be public or private.
-    start_time (str): The start time of the activity in ISO 8601 format.
-    end_time (str): The end time of the activity in ISO 8601 format.
+class _ChunkRejected(HTTPException):
+    """Spotify turned an add down with a 4xx: it wasn't applied, and won't be."""
 
-Returns:
-    str: The Spotify web URL of the created playlist.
 
-"""
+def _playlist_state(playlist_id: str, token: str) -> tuple[int, str] | None:
+    """The playlist's track count and snapshot_id now, or None if we can't tell."""
+    try:
+        response = http_client.get(
+            f"{config.SPOTIFY_API_URL}/playlists/{playlist_id}",
+            headers=build_headers(token),
+            params={"fields": "snapshot_id,tracks.total"},
+            name="spotify.get_playlist",
+        )
+    except Exception:
+        return None
+    if response.status_code != 200:
+        return None
+    playlist = response.json()
+    return playlist["tracks"]["total"], playlist["snapshot_id"]
 
 
-def build_playlist(
-    user_id: str,
-    spotify_user_id: str,
-    start_time: str,
-    end_time: str,
-    db: Session,
-    playlist_name="Songs from your run",
-    playlist_description="Songs listened to during your run",
-    public=True,
-    include_protocol=True,
-) -> str:
-    # Set up the base URL for Spotify web playlists
-    SPOTIFY_WEB_URL_BASE = (
-        "https://open.spotify.com/playlist/"
-        if include_protocol
-        else "open.spotify.com/playlist/"
+def _add_chunk(playlist_id: str, uris: list, position: int, token: str) -> str | None:
+    """Insert one chunk at `position`; return the new snapshot_id, if Spotify gave one."""
+    # Not idempotent either: a repeat would add the chunk twice, so the client
+    # won't retry it past a timeout or 5xx. add_songs checks and retries.
+    response = http_client.post(
+        f"{config.SPOTIFY_API_URL}/playlists/{playlist_id}/tracks",
+        headers=build_headers(token),
+        json={"uris": uris, "position": position},
+        name="spotify.add_tracks",
     )
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        raise _ChunkRejected(
+            status_code=502,
+            detail=f"Spotify returned {response.status_code} when adding tracks to your playlist.",
+        )
+    raise_for_spotify_status(response, "adding tracks to your playlist")
+    return response.json().get("snapshot_id")
 
-    token = get_spotify_access_token_from_db(user_id, db)
 
-    # Pull the whole history buffer and work out what it can tell us about this
-    # particular run. Distinct statuses matter here: "you played nothing" and
-    # "we can no longer see that far back" are very different messages.
+@traced
+def add_songs(
+    recently_played_songs_id_array: list, playlist_id: str, token: str
+) -> PlaylistWrite:
+    """Add tracks to a playlist, in order, MAX_TRACKS_PER_ADD at a time.
+
+    A chunk that fails is skipped and retried on a later pass, at the
+    position that keeps the playlist in order, for up to ADD_ATTEMPTS passes.
+    Where a failure leaves it unclear whether the chunk landed (a timeout, a
+    5xx), the playlist's length says, so a retry never adds it twice; that
+    needs the playlist to hold nothing but what this call adds, as a freshly
+    created one does. A chunk Spotify rejected with a 4xx (other than 429)
+    would only be rejected again, so it isn't retried.
+
+    Never raises for a failed add; the PlaylistWrite says what was written.
+    """
+    uris = [f"spotify:track:{x}" for x in recently_played_songs_id_array]
+    chunks = [
+        uris[i : i + MAX_TRACKS_PER_ADD]
+        for i in range(0, len(uris), MAX_TRACKS_PER_ADD)
+    ]
+    written = PlaylistWrite(requested=len(uris))
+    landed = [False] * len(chunks)
+    rejected: set[int] = set()
+    errors: dict[int, str] = {}
+
+    for attempt in range(ADD_ATTEMPTS):
+        if attempt:
+            time.sleep(http_client.backoff_seconds(attempt))
+        for k, chunk in enumerate(chunks):
+            if landed[k] or k in rejected:
+                continue
+            # Tracks already in the playlist that belong before this chunk.
+            position = sum(len(chunks[j]) for j in range(k) if landed[j])
+            try:
+                snapshot_id = _add_chunk(playlist_id, chunk, position, token)
+                written.snapshot_id = snapshot_id or written.snapshot_id
+            except Exception as error:
+                # Transport errors included, without importing requests up
+                # front (see http_client): a failed add never raises.
+                errors[k] = getattr(error, "detail", None) or str(error)
+                if isinstance(error, _ChunkRejected):
+                    rejected.add(k)
+                    continue
+                # A 429 (a 503 by now) was refused outright; anything else
+                # might have been applied before it failed.
+                if isinstance(error, HTTPException) and error.status_code == 503:
+                    continue
+                state = _playlist_state(playlist_id, token)
+                if state is None or state[0] != written.added + len(chunk):
+                    continue
+                written.snapshot_id = state[1]
+            landed[k] = True
+            errors.pop(k, None)
+            written.added += len(chunk)
+        if all(landed[k] or k in rejected for k in range(len(chunks))):
+            break
+
+    written.failed = [(k * MAX_TRACKS_PER_ADD, errors[k]) for k in sorted(errors)]
+    return written
+
+
+@traced
+def select_run_tracks(
+    items: list, start_time: str, end_time: str, archive: Archive | None = None
+) -> Selection:
+    """Pick the tracks played during a run, or explain why we can't.
+
+    Raises the user-facing 410/400 for the two non-playable outcomes, so
+    callers only ever get back something worth turning into a playlist.
+    """
+    # Distinct statuses matter here: "you played nothing" and "we can no longer
+    # see that far back" are very different messages.
     selection = select_tracks_in_window(
-        items=get_recently_played(token),
+        items=items,
         start_ms=iso_to_unix(start_time),
         end_ms=iso_to_unix(end_time),
+        archive=archive,
     )
-    print(f"{selection.status.value}: {len(selection.track_ids)} tracks", flush=True)
+    return raise_for_selection(selection)
+
+
+def raise_for_selection(selection: Selection) -> Selection:
+    """Return a playable selection; raise the matching 410/400 otherwise."""
+    metrics.selection_total.inc(status=selection.status.value)
 
     if selection.status is Status.HORIZON_EXCEEDED:
         raise HTTPException(
@@ -329,7 +460,30 @@ def build_playlist(
             ),
         )
 
-    song_ids = selection.track_ids
+    return selection
+
+
+@traced
+def create_run_playlist(
+    selection: Selection,
+    spotify_user_id: str,
+    token: str,
+    playlist_name: str,
+    playlist_description: str,
+    public: bool = True,
+    include_protocol: bool = True,
+) -> RunPlaylist:
+    """Create a playlist holding a selection's tracks.
+
+    Raises if none of the tracks could be added. If only some were, the
+    playlist is still returned, and its `written.shortfall` says what's missing.
+    """
+    # Set up the base URL for Spotify web playlists
+    SPOTIFY_WEB_URL_BASE = (
+        "https://open.spotify.com/playlist/"
+        if include_protocol
+        else "open.spotify.com/playlist/"
+    )
 
     # Say so rather than quietly handing over a playlist that is missing the
     # start of the run.
@@ -349,12 +503,70 @@ def build_playlist(
     )
 
     # Add the recently played songs to the created playlist
-    add_songs(
-        recently_played_songs_id_array=list(song_ids),
+    written = add_songs(
+        recently_played_songs_id_array=list(selection.track_ids),
         playlist_id=playlist_id,
         token=token,
     )
-    print(playlist_id, flush=True)
+    if written.failed and not written.added:
+        raise HTTPException(status_code=502, detail=written.failed[0][1])
+    if written.failed:
+        # Most of a playlist beats none: hand it over, but say what's missing.
+        logger.warning(
+            "Playlist %s: added %d/%d tracks, failed chunks %s",
+            playlist_id,
+            written.added,
+            written.requested,
+            written.failed,
+        )
 
-    # Return the Spotify web URL for the created playlist
-    return SPOTIFY_WEB_URL_BASE + playlist_id
+    return RunPlaylist(url=SPOTIFY_WEB_URL_BASE + playlist_id, written=written)
+
+
+"""
+Function to build a Spotify playlist after an activity based on the user's recently played songs.
+
+Parameters:
+    user_id (str): The Spotify user ID.
+    playlist_name (str): The name of the playlist to be created.
+    playlist_description (str): The description of the playlist.
+    public (bool): Whether the playlist should be public or private.
+    start_time (str): The start time of the activity in ISO 8601 format.
+    end_time (str): The end time of the activity in ISO 8601 format.
+
+Returns:
+    RunPlaylist: The Spotify web URL of the created playlist, and what went into it.
+
+"""
+
+
+@traced
+def build_playlist(
+    user_id: str,
+    spotify_user_id: str,
+    start_time: str,
+    end_time: str,
+    db: Session,
+    playlist_name="Songs from your run",
+    playlist_description="Songs listened to during your run",
+    public=True,
+    include_protocol=True,
+) -> RunPlaylist:
+    token = get_spotify_access_token_from_db(user_id, db)
+
+    # Pull the whole history buffer, plus whatever the archive kept from before
+    # it, and work out what they can tell us about this particular run.
+    archive = load_archive(db, user_id, iso_to_unix(start_time), iso_to_unix(end_time))
+    selection = select_run_tracks(
+        get_recently_played(token), start_time, end_time, archive
+    )
+
+    return create_run_playlist(
+        selection=selection,
+        spotify_user_id=spotify_user_id,
+        token=token,
+        playlist_name=playlist_name,
+        playlist_description=playlist_description,
+        public=public,
+        include_protocol=include_protocol,
+    )
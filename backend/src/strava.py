@@ -1,28 +1,64 @@
-from datetime import datetime, timezone, timedelta
+import asyncio
 import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
 from urllib.parse import urlencode
 from src.db_ops import store_token
 from src.strava_models import RefreshStravaAccessTokenResponse, StravaAuthResponse
 from src.helpers import build_state
-from dotenv import load_dotenv
-from requests import post, get, put
+from src.http_client import post, post_async
+# API calls spend the app-wide rate limit; the OAuth token endpoint doesn't.
+from src.strava_quota import QuotaExhausted, get, put
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
+from src.config import BASE_URL, STRAVA_CLIENT_ID, STRAVA_CLIENT_SECRET, STRAVA_URL
 from src.db import Token
-from spotify import build_playlist
+from src.token_cache import REFRESH_HTTP_TIMEOUT, get_access_token
+from src.ttl_cache import TTLCache
+from src.history_archive import load_archive
+from src import enhanced_activities
+from src.tracing import traced
+from src.enhanced_activities import Enhancement
+from time_utils import iso_to_unix
+from listening_history import select_tracks_in_windows
+from spotify import (
+    build_playlist,
+    create_run_playlist,
+    get_recently_played,
+    get_spotify_access_token_from_db,
+    raise_for_selection,
+    select_run_tracks,
+)
 
-load_dotenv()
+STRAVA_SCOPE = "activity:read_all,activity:write"
 
-BASE_URL = os.getenv("BASE_URL")
+ACTIVITIES_PER_PAGE = 10
+# Strava allows up to 200; more than a screenful is never asked for.
+MAX_ACTIVITIES_PER_PAGE = 50
+# How long a user's page of activities is reused. New uploads take up to this
+# long to appear; paging back and forth within it costs no Strava calls.
+ACTIVITY_PAGE_CACHE_TTL_SECONDS = float(
+    os.getenv("ACTIVITY_PAGE_CACHE_TTL_SECONDS", 30)
+)
 
-STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
-STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
-STRAVA_SCOPE = "activity:read_all,activity:write"
+ACTIVITY_PAGE_CACHE_MAX_ENTRIES = int(os.getenv("ACTIVITY_PAGE_CACHE_MAX_ENTRIES", 1024))
+
+
+# (user_id, before, after, per_page) -> one page of fetch_activities.
+# No per-key locking: two requests missing the same page both fetch it, which
+# costs a Strava call but keeps nothing keyed by the query string around
+# beyond the entry limit.
+activity_pages: TTLCache[list] = TTLCache(
+    max_entries=ACTIVITY_PAGE_CACHE_MAX_ENTRIES,
+    ttl=ACTIVITY_PAGE_CACHE_TTL_SECONDS,
+    clock=time.monotonic,
+)
 
 STRAVA_REDIRECT_URI = f"{BASE_URL}/api/strava/callback"
-STRAVA_AUTH_URL = "https://www.strava.com/oauth/authorize"
-STRAVA_ACCESS_TOKEN_URL = "https://www.strava.com/oauth/token"
-STRAVA_API_URL = "https://www.strava.com/api/v3"
+STRAVA_AUTH_URL = f"{STRAVA_URL}/oauth/authorize"
+STRAVA_ACCESS_TOKEN_URL = f"{STRAVA_URL}/oauth/token"
+STRAVA_API_URL = f"{STRAVA_URL}/api/v3"
 
 
 def build_strava_auth_url(token: str):
@@ -40,27 +76,39 @@ def build_strava_auth_url(token: str):
     return f"{STRAVA_AUTH_URL}?{urlencode(params)}"
 
 
-def exchange_strava_code_for_access_token(code: str):
+async def exchange_strava_code_for_access_token(code: str):
     params = {
         "client_id": STRAVA_CLIENT_ID,
         "client_secret": STRAVA_CLIENT_SECRET,
         "code": code,
         "grant_type": "authorization_code",
     }
-    response = post(STRAVA_ACCESS_TOKEN_URL, data=params).json()
+    response = (
+        await post_async(STRAVA_ACCESS_TOKEN_URL, data=params, name="strava.token")
+    ).json()
     return StravaAuthResponse.model_validate(response)
 
 
-def refresh_strava_access_token(
-    token: Token, db: Session
-) -> RefreshStravaAccessTokenResponse:
+def fetch_refreshed_strava_token(refresh_token: str) -> dict:
+    """Trade a refresh token for new credentials. Network only, no DB.
+
+    Returns the fields of a tokens row: access_token, refresh_token and
+    expires_at.
+    """
     body = {
         "client_id": STRAVA_CLIENT_ID,
         "client_secret": STRAVA_CLIENT_SECRET,
         "grant_type": "refresh_token",
-        "refresh_token": token.refresh_token,
+        "refresh_token": refresh_token,
     }
-    response = post(STRAVA_ACCESS_TOKEN_URL, data=body)
+    response = post(
+        STRAVA_ACCESS_TOKEN_URL,
+        data=body,
+        name="strava.refresh_token",
+        # Runs under the token's refresh lock; see src/token_cache.py.
+        timeout=REFRESH_HTTP_TIMEOUT,
+        retries=0,
+    )
     if response.status_code != 200:
         raise Exception(f"Failed to refresh Strava access token: {response.json()}")
     response_json = response.json()
@@ -71,26 +119,25 @@ def refresh_strava_access_token(
     object: RefreshStravaAccessTokenResponse = (
         RefreshStravaAccessTokenResponse.model_validate(response_json)
     )
-    store_token(
+    return {
+        "access_token": object.access_token,
+        "refresh_token": object.refresh_token,
+        "expires_at": datetime.fromtimestamp(object.expires_at),
+    }
+
+
+def refresh_strava_access_token(token: Token, db: Session) -> Token:
+    return store_token(
         db=db,
         user_id=token.user_id,
         provider="strava",
-        access_token=object.access_token,
-        refresh_token=object.refresh_token,
-        expires_at=datetime.fromtimestamp(object.expires_at),
+        **fetch_refreshed_strava_token(token.refresh_token),
     )
-    return object
 
 
-def get_strava_access_token_from_db(user_id: int, db: Session):
-    token = (
-        db.query(Token)
-        .filter(Token.user_id == user_id, Token.provider == "strava")
-        .first()
-    )
-    if token.expires_at.timestamp() < datetime.now().timestamp():
-        token = refresh_strava_access_token(token, db)
-    return token.access_token
+@traced
+def get_strava_access_token_from_db(user_id: int, db: Session) -> str:
+    return get_access_token(user_id, "strava", db, refresh_strava_access_token)
 
 
 def compose_description(existing: str | None, playlist_url: str) -> str:
@@ -103,8 +150,9 @@ def compose_description(existing: str | None, playlist_url: str) -> str:
     return f"{existing}\n\n{playlist_url}" if existing else playlist_url
 
 
-def get_latest_run(user_id: int, db: Session):
-    access_token = get_strava_access_token_from_db(user_id, db)
+@traced
+def fetch_latest_run(access_token: str) -> dict:
+    """The athlete's most recent activity, in full. Network only, no DB."""
     query_params = {
         "per_page": 1,
     }
@@ -115,6 +163,7 @@ def get_latest_run(user_id: int, db: Session):
         f"{STRAVA_API_URL}/athlete/activities",
         params=query_params,
         headers=headers,
+        name="strava.list_activities",
     )
 
     # Check before indexing: on a non-200 the body is an error object, and
@@ -132,13 +181,25 @@ def get_latest_run(user_id: int, db: Session):
             detail="You don't have any Strava activities yet. Record one and try again.",
         )
 
-    id = activities[0]["id"]
-    full_activity_url = f"{STRAVA_API_URL}/activities/{id}"
-    activity_detail = get(full_activity_url, headers=headers)
+    return fetch_activity(activities[0]["id"], access_token, what="your latest activity")
+
+
+@traced
+def fetch_activity(
+    activity_id: int, access_token: str, what: str = "that activity"
+) -> dict:
+    """One activity in full, trimmed to what we use. Network only, no DB."""
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+    }
+    full_activity_url = f"{STRAVA_API_URL}/activities/{activity_id}"
+    activity_detail = get(
+        full_activity_url, headers=headers, name="strava.get_activity"
+    )
     if activity_detail.status_code != 200:
         raise HTTPException(
             status_code=502,
-            detail=f"Strava returned {activity_detail.status_code} when fetching your latest activity.",
+            detail=f"Strava returned {activity_detail.status_code} when fetching {what}.",
         )
     activity_response = activity_detail.json()
     return {
@@ -153,39 +214,423 @@ def get_latest_run(user_id: int, db: Session):
     }
 
 
-def add_playlist_to_latest_run(user_id: int, spotify_user_id: str, db: Session):
-    latest_run = get_latest_run(user_id, db)
-    latest_run_id = latest_run["id"]
-    latest_run_description = latest_run["description"]
+def fetch_activities(
+    access_token: str,
+    before: int | None = None,
+    after: int | None = None,
+    per_page: int = ACTIVITIES_PER_PAGE,
+) -> list[dict]:
+    """One page of the athlete's activities, newest first. Network only, no DB.
+
+    `before` and `after` are Unix seconds, and bound the start time.
+    """
+    params = {"per_page": per_page}
+    if before is not None:
+        params["before"] = before
+    if after is not None:
+        params["after"] = after
+    response = get(
+        f"{STRAVA_API_URL}/athlete/activities",
+        params=params,
+        headers={"Authorization": f"Bearer {access_token}"},
+        name="strava.list_activities",
+    )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Strava returned {response.status_code} when listing your activities.",
+        )
+    activities = [
+        {
+            "id": activity["id"],
+            "name": activity["name"],
+            "sport_type": activity.get("sport_type") or activity.get("type"),
+            "distance": activity.get("distance"),
+            "moving_time": activity.get("moving_time"),
+            "elapsed_time": activity.get("elapsed_time"),
+            "start_date": activity["start_date"],
+            "url": f"https://www.strava.com/activities/{activity['id']}",
+        }
+        for activity in response.json()
+    ]
+    # With `after`, Strava pages forwards in time and returns oldest first.
+    activities.sort(key=lambda activity: activity["start_date"], reverse=True)
+    return activities
+
+
+def list_recent_activities(
+    user_id: int,
+    db: Session,
+    before: int | None = None,
+    after: int | None = None,
+    per_page: int = ACTIVITIES_PER_PAGE,
+) -> dict:
+    """A page of the user's activities, newest first, each saying if it has a playlist.
+
+    Keyset pagination on start time: `next_before` asks for the page of older
+    activities, `prev_after` for the newer ones, both in Unix seconds (None
+    when there's nothing that way). It costs one Strava call and one query
+    whatever the page size, and the Strava half is cached per user for
+    ACTIVITY_PAGE_CACHE_TTL_SECONDS. Enhancement status is always read fresh,
+    so a playlist shows up as soon as it's made.
+    """
+
+    key = (user_id, before, after, per_page)
+    page = activity_pages.get(key)
+    if page is None:
+        access_token = get_strava_access_token_from_db(user_id, db)
+        page = fetch_activities(access_token, before, after, per_page)
+        activity_pages.put(key, page)
+    enhanced = enhanced_activities.lookup(db, user_id, [a["id"] for a in page])
+
+    activities = []
+    for activity in page:
+        enhancement = enhanced.get(activity["id"])
+        done = enhancement is not None and enhancement.status == "done"
+        activities.append(
+            dict(
+                activity,
+                enhanced=done,
+                playlist_url=enhancement.playlist_url if done else None,
+            )
+        )
 
+    full = len(page) == per_page
+    starts = [iso_to_unix(a["start_date"]) // 1000 for a in page]
+    return {
+        "activities": activities,
+        # Older ones exist if this page was full, or if we came here going forwards.
+        "next_before": min(starts) if starts and (full or after is not None) else None,
+        # Newer ones exist unless this is the first page, or we've paged up to it.
+        "prev_after": (
+            max(starts)
+            if starts and (before is not None or (after is not None and full))
+            else None
+        ),
+    }
+
+
+def get_latest_run(user_id: int, db: Session):
+    access_token = get_strava_access_token_from_db(user_id, db)
+    return fetch_latest_run(access_token)
+
+
+def run_window(run: dict) -> tuple[str, str]:
+    """Start and end of an activity as UTC ISO 8601 strings ending in 'Z'."""
     # Parse start (robust to 'Z')
     start_dt_utc = datetime.fromisoformat(
-        latest_run["start_date"].replace("Z", "+00:00")
+        run["start_date"].replace("Z", "+00:00")
     ).astimezone(timezone.utc)
-    end_dt_utc = start_dt_utc + timedelta(seconds=latest_run["elapsed_time"])
+    end_dt_utc = start_dt_utc + timedelta(seconds=run["elapsed_time"])
     start_time_iso_utc = start_dt_utc.isoformat().replace("+00:00", "Z")
     end_time_iso_utc = end_dt_utc.isoformat().replace("+00:00", "Z")
+    return start_time_iso_utc, end_time_iso_utc
 
-    playlist_url = build_playlist(
-        user_id=user_id,
-        spotify_user_id=spotify_user_id,
-        start_time=start_time_iso_utc,
-        end_time=end_time_iso_utc,
-        playlist_name=latest_run["name"],
-        playlist_description=f"The songs played during a run called {latest_run['name']}",
-        db=db,
-    )
 
-    access_token = get_strava_access_token_from_db(user_id, db)
+def playlist_details(run: dict) -> dict:
+    return {
+        "playlist_name": run["name"],
+        "playlist_description": f"The songs played during a run called {run['name']}",
+    }
+
+
+@traced
+def write_playlist_link(run: dict, playlist_url: str, access_token: str):
     body = {
-        "description": compose_description(latest_run_description, playlist_url),
+        "description": compose_description(run["description"], playlist_url),
     }
     headers = {
         "Authorization": f"Bearer {access_token}",
     }
+    # A PUT of the same description is safe to repeat, so the client retries
+    # this one through timeouts and 5xx.
     response = put(
-        f"{STRAVA_API_URL}/activities/{latest_run_id}",
+        f"{STRAVA_API_URL}/activities/{run['id']}",
         data=body,
         headers=headers,
-    ).json()
-    return response
+        name="strava.update_activity",
+    )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=502,
+            detail=(
+                f"Strava returned {response.status_code} when adding the playlist "
+                f"to your activity."
+            ),
+        )
+    return response.json()
+
+
+def _duplicate(enhancement: Enhancement) -> dict:
+    """What a request for an activity someone else has claimed gets back."""
+    if enhancement.status == "done":
+        return enhancement.result
+    raise HTTPException(
+        status_code=409,
+        detail="A playlist is already being added to this activity. Try again shortly.",
+    )
+
+
+def _error_text(error: Exception) -> str:
+    return getattr(error, "detail", None) or repr(error)
+
+
+@contextmanager
+def _enhancing(db: Session, user_id: int, activity_id: int):
+    """Hold a won claim: finish it on success, release it on any failure."""
+    try:
+        yield
+    except Exception as error:
+        db.rollback()
+        enhanced_activities.release(db, user_id, activity_id, _error_text(error))
+        raise
+    enhanced_activities.finish(db, user_id, activity_id)
+
+
+@traced
+def add_playlist_to_latest_run(user_id: int, spotify_user_id: str, db: Session):
+    # One Strava token for both the lookup and the write-back.
+    access_token = get_strava_access_token_from_db(user_id, db)
+    latest_run = fetch_latest_run(access_token)
+    return _add_playlist_to_run(user_id, spotify_user_id, latest_run, access_token, db)
+
+
+@traced
+def add_playlist_to_activity(
+    user_id: int, spotify_user_id: str, activity_id: int, db: Session
+):
+    """Like `add_playlist_to_latest_run`, for an activity we already know the id of."""
+    # Claimed before anything is fetched: a redelivered webhook costs no calls.
+    won, enhancement = enhanced_activities.claim(db, user_id, activity_id)
+    if not won:
+        return _duplicate(enhancement)
+    with _enhancing(db, user_id, activity_id):
+        access_token = get_strava_access_token_from_db(user_id, db)
+        activity = fetch_activity(activity_id, access_token)
+        return _write_run_playlist(
+            user_id, spotify_user_id, activity, access_token, db, enhancement
+        )
+
+
+def _add_playlist_to_run(
+    user_id: int, spotify_user_id: str, run: dict, access_token: str, db: Session
+):
+    won, enhancement = enhanced_activities.claim(db, user_id, run["id"])
+    if not won:
+        return _duplicate(enhancement)
+    with _enhancing(db, user_id, run["id"]):
+        return _write_run_playlist(
+            user_id, spotify_user_id, run, access_token, db, enhancement
+        )
+
+
+def _write_run_playlist(
+    user_id: int,
+    spotify_user_id: str,
+    run: dict,
+    access_token: str,
+    db: Session,
+    enhancement: Enhancement,
+):
+    """Make the run's playlist, unless an earlier attempt did, and link it."""
+    playlist_url = enhancement.playlist_url
+    if playlist_url is None:
+        start_time, end_time = run_window(run)
+        playlist = build_playlist(
+            user_id=user_id,
+            spotify_user_id=spotify_user_id,
+            start_time=start_time,
+            end_time=end_time,
+            db=db,
+            **playlist_details(run),
+        )
+        playlist_url = playlist.url
+        enhanced_activities.record_playlist(
+            db, user_id, run["id"], playlist_url, playlist.written.shortfall
+        )
+
+    return write_playlist_link(run, playlist_url, access_token)
+
+
+def add_playlists_to_activities(
+    user_id: int, spotify_user_id: str, activity_ids: list[int], db: Session
+) -> list[dict]:
+    """`add_playlist_to_activity` for several of one user's activities at once.
+
+    For a warm-up, race and cool-down uploaded together, or a backlog: the
+    listening history and the archive are read once and every activity is
+    matched against that one snapshot, rather than refetching per activity.
+    Activities that already have a playlist are claimed first and skipped.
+
+    One result per activity, in order: {"activity_id", "playlist_url"} when it
+    has a playlist, {"activity_id", "status_code", "detail"} when it doesn't,
+    plus "retry_after" if that was the Strava budget running out. One activity
+    failing doesn't stop the others.
+    """
+    results: dict[int, dict] = {}
+    # Won claims not yet finished or released.
+    held: dict[int, Enhancement] = {}
+
+    def succeeded(activity_id: int, playlist_url: str) -> None:
+        results[activity_id] = {"activity_id": activity_id, "playlist_url": playlist_url}
+
+    def failed(activity_id: int, error: HTTPException) -> None:
+        results[activity_id] = {
+            "activity_id": activity_id,
+            "status_code": error.status_code,
+            "detail": error.detail,
+        }
+        if isinstance(error, QuotaExhausted):
+            results[activity_id]["retry_after"] = error.retry_after
+        if held.pop(activity_id, None) is not None:
+            enhanced_activities.release(db, user_id, activity_id, _error_text(error))
+
+    for activity_id in activity_ids:
+        won, enhancement = enhanced_activities.claim(db, user_id, activity_id)
+        if won:
+            held[activity_id] = enhancement
+            continue
+        try:
+            succeeded(activity_id, _duplicate(enhancement)["playlist_url"])
+        except HTTPException as error:
+            failed(activity_id, error)
+
+    try:
+        strava_token = get_strava_access_token_from_db(user_id, db)
+        runs = []
+        for activity_id in list(held):
+            try:
+                runs.append(fetch_activity(activity_id, strava_token))
+            except HTTPException as error:
+                failed(activity_id, error)
+
+        if runs:
+            windows = [run_window(run) for run in runs]
+            windows_ms = [(iso_to_unix(start), iso_to_unix(end)) for start, end in windows]
+            spotify_token = get_spotify_access_token_from_db(user_id, db)
+            items = get_recently_played(spotify_token)
+            # One archive read spanning every window.
+            archive = load_archive(
+                db,
+                user_id,
+                min(start for start, _ in windows_ms),
+                max(end for _, end in windows_ms),
+            )
+            selections = select_tracks_in_windows(items, windows_ms, archive=archive)
+
+            for run, selection in zip(runs, selections):
+                activity_id = run["id"]
+                try:
+                    playlist_url = held[activity_id].playlist_url
+                    if playlist_url is None:
+                        playlist = create_run_playlist(
+                            selection=raise_for_selection(selection),
+                            spotify_user_id=spotify_user_id,
+                            token=spotify_token,
+                            **playlist_details(run),
+                        )
+                        playlist_url = playlist.url
+                        enhanced_activities.record_playlist(
+                            db, user_id, activity_id, playlist_url, playlist.written.shortfall
+                        )
+                    write_playlist_link(run, playlist_url, strava_token)
+                except HTTPException as error:
+                    failed(activity_id, error)
+                    continue
+                del held[activity_id]
+                enhanced_activities.finish(db, user_id, activity_id)
+                succeeded(activity_id, playlist_url)
+    finally:
+        # Whatever stopped the batch, don't leave the rest claimed until the
+        # lease runs out.
+        if held:
+            db.rollback()
+        for activity_id in list(held):
+            enhanced_activities.release(db, user_id, activity_id, "batch aborted")
+
+    return [results[activity_id] for activity_id in activity_ids]
+
+
+async def add_playlist_to_latest_run_async(
+    user_id: int, spotify_user_id: str, db: Session
+):
+    """`add_playlist_to_latest_run`, with the independent stages overlapped.
+
+    Finding and claiming the run (list + detail on Strava) and reading the
+    listening history (recently-played on Spotify) don't depend on each other,
+    so they run side by side and the critical path is the longer of the two
+    plus the writes. The provider client is blocking, so each stage runs on a
+    worker thread.
+
+    The Session is not safe to use from two threads at once, so only the
+    Strava branch touches it during the fan-out, to claim the run: both
+    tokens are loaded first, and the Strava one is reused for the write-back.
+    A duplicate request is turned away at the claim, before any write; the
+    history read alongside it is the only call it wastes.
+    """
+    strava_token = await asyncio.to_thread(
+        get_strava_access_token_from_db, user_id, db
+    )
+    spotify_token = await asyncio.to_thread(
+        get_spotify_access_token_from_db, user_id, db
+    )
+
+    @traced
+    def claimed_latest_run():
+        run = fetch_latest_run(strava_token)
+        return run, enhanced_activities.claim(db, user_id, run["id"])
+
+    # Both branches are waited for, so a claim won while the history read
+    # failed is still released below, not left pending until its lease ends.
+    claimed, items = await asyncio.gather(
+        asyncio.to_thread(claimed_latest_run),
+        asyncio.to_thread(get_recently_played, spotify_token),
+        return_exceptions=True,
+    )
+    if isinstance(claimed, BaseException):
+        raise claimed
+    latest_run, (won, enhancement) = claimed
+    if not won:
+        return _duplicate(enhancement)
+
+    activity_id = latest_run["id"]
+    try:
+        playlist_url = enhancement.playlist_url
+        if playlist_url is None:
+            if isinstance(items, BaseException):
+                raise items
+            # Which archived plays matter depends on the run, so this one
+            # waits for it.
+            start_time, end_time = run_window(latest_run)
+            archive = await asyncio.to_thread(
+                load_archive, db, user_id, iso_to_unix(start_time), iso_to_unix(end_time)
+            )
+            selection = select_run_tracks(items, start_time, end_time, archive)
+            playlist = await asyncio.to_thread(
+                create_run_playlist,
+                selection=selection,
+                spotify_user_id=spotify_user_id,
+                token=spotify_token,
+                **playlist_details(latest_run),
+            )
+            playlist_url = playlist.url
+            await asyncio.to_thread(
+                enhanced_activities.record_playlist,
+                db,
+                user_id,
+                activity_id,
+                playlist_url,
+                playlist.written.shortfall,
+            )
+
+        result = await asyncio.to_thread(
+            write_playlist_link, latest_run, playlist_url, strava_token
+        )
+    except Exception as error:
+        await asyncio.to_thread(db.rollback)
+        await asyncio.to_thread(
+            enhanced_activities.release, db, user_id, activity_id, _error_text(error)
+        )
+        raise
+    await asyncio.to_thread(enhanced_activities.finish, db, user_id, activity_id)
+    return result
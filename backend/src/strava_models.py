@@ -40,3 +40,14 @@ class RefreshStravaAccessTokenResponse(BaseModel):
     expires_at: int
     expires_in: int
     refresh_token: str
+
+
+# https://developers.strava.com/docs/webhooks/#event-data
+class StravaWebhookEvent(BaseModel):
+    object_type: Literal["activity", "athlete"]
+    object_id: int
+    aspect_type: Literal["create", "update", "delete"]
+    updates: Optional[dict] = None
+    owner_id: int
+    subscription_id: int
+    event_time: int
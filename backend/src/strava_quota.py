@@ -0,0 +1,455 @@
+"""Strava's app-wide rate limit, budgeted across every process that calls it.
+
+Strava allows so many calls per 15 minutes (windows start on the quarter hour,
+UTC) and per day (from midnight UTC), for the whole app rather than per user,
+and reports where we stand on every response:
+
+    X-RateLimit-Limit: 200,2000
+    X-RateLimit-Usage: 31,560
+
+The web app and the worker spend that one budget. Every Strava API call goes
+through `request` here, which counts each attempt against the shared budget
+before sending it, retries included. Counting first is what stops concurrent
+callers from all seeing one call left and taking it. What a response reports
+is kept in memory and folded in the next time the budget is counted, rather
+than costing a statement of its own.
+
+Calls come in two priority classes:
+
+- interactive, the default: someone is waiting on the answer, and may use the
+  whole budget.
+- background (`with background_priority():`): webhook processing and
+  backfills. These only get STRAVA_BACKGROUND_SHARE of each window, so
+  however much is queued there is always headroom left for people clicking
+  the button.
+
+A call the budget can't cover isn't sent. `QuotaExhausted` is raised instead:
+a 503 with Retry-After to someone waiting on a request, and for a job, a
+deferral to when the window resets (see `jobs.Deferred`).
+
+The budget lives in the strava_quota table, in a single row. A process takes
+calls from it STRAVA_QUOTA_BLOCK (default 5) at a time, in one autocommitted
+UPDATE ... RETURNING, and hands them out in memory. So most calls cost no
+database round trip at all, and the row is locked only while that statement
+runs. The price: calls a process took but didn't make stay counted until the
+window resets, at most STRAVA_QUOTA_BLOCK - 1 per process and priority class.
+STRAVA_QUOTA_STORE=memory keeps the budget in process instead, which is
+enough for one process and for local work.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Iterator, Mapping
+
+from fastapi import HTTPException
+from sqlalchemy import Engine, Integer, case, cast, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from src import http_client
+from src.db import StravaQuota, get_engine
+
+SHORT_WINDOW_SECONDS = 15 * 60
+DAY_SECONDS = 24 * 60 * 60
+# Strava's defaults for a new app, used until a response says otherwise.
+DEFAULT_SHORT_LIMIT = 200
+DEFAULT_DAILY_LIMIT = 2000
+DEFAULT_BACKGROUND_SHARE = 0.75
+# Calls taken from the shared row per round trip; see the module docstring.
+DEFAULT_RESERVE_BLOCK = 5
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(str, Enum):
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+
+_priority: ContextVar[Priority] = ContextVar(
+    "strava_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def background_priority() -> Iterator[None]:
+    """Count Strava calls made inside the block as background work.
+
+    A context variable, so it follows the work into `asyncio.to_thread`.
+    """
+    token = _priority.set(Priority.BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class QuotaExhausted(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=(
+                "We've used up our Strava requests for the moment. "
+                "Try again in a few minutes."
+            ),
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class Reported:
+    """What a response's rate limit headers said, and when."""
+
+    at: float
+    usage: tuple[int, int]
+    limit: tuple[int, int]
+
+    def merge(self, later: "Reported") -> "Reported":
+        """The later report, keeping the higher usage of any window both saw.
+
+        Usage only ever grows within a window, and responses come back out of
+        order, so a lower figure is stale rather than a correction.
+        """
+        short_usage, daily_usage = later.usage
+        if int(self.at // SHORT_WINDOW_SECONDS) == int(later.at // SHORT_WINDOW_SECONDS):
+            short_usage = max(short_usage, self.usage[0])
+        if int(self.at // DAY_SECONDS) == int(later.at // DAY_SECONDS):
+            daily_usage = max(daily_usage, self.usage[1])
+        return Reported(later.at, (short_usage, daily_usage), later.limit)
+
+
+@dataclass
+class QuotaState:
+    short_window: int = 0
+    short_usage: int = 0
+    short_limit: int = DEFAULT_SHORT_LIMIT
+    day: int = 0
+    daily_usage: int = 0
+    daily_limit: int = DEFAULT_DAILY_LIMIT
+
+    def roll(self, now: float) -> None:
+        """Start afresh on any window that has reset since the last call."""
+        window, day = int(now // SHORT_WINDOW_SECONDS), int(now // DAY_SECONDS)
+        if window != self.short_window:
+            self.short_window, self.short_usage = window, 0
+        if day != self.day:
+            self.day, self.daily_usage = day, 0
+
+    def try_reserve(self, now: float, share: float) -> int | None:
+        """Count one call if `share` of each limit allows it.
+
+        Returns None if it was counted, or else the seconds until the window
+        that's full resets.
+        """
+        self.roll(now)
+        retry_after = self.retry_after(now, share)
+        if retry_after is None:
+            self.short_usage += 1
+            self.daily_usage += 1
+        return retry_after
+
+    def retry_after(self, now: float, share: float) -> int | None:
+        """Seconds until the full window resets, or None if neither is full."""
+        if self.daily_usage >= int(self.daily_limit * share):
+            return _seconds_until_next(now, DAY_SECONDS)
+        if self.short_usage >= int(self.short_limit * share):
+            return _seconds_until_next(now, SHORT_WINDOW_SECONDS)
+        return None
+
+    def observe(self, reported: Reported) -> None:
+        """Fold in what a response reported, once rolled to the current windows.
+
+        Usage from a window that has since reset no longer counts, and a lower
+        figure than ours is stale rather than a correction.
+        """
+        if int(reported.at // SHORT_WINDOW_SECONDS) == self.short_window:
+            self.short_usage = max(self.short_usage, reported.usage[0])
+        if int(reported.at // DAY_SECONDS) == self.day:
+            self.daily_usage = max(self.daily_usage, reported.usage[1])
+        self.short_limit, self.daily_limit = reported.limit
+
+
+def _seconds_until_next(now: float, period: int) -> int:
+    return int(period - now % period) + 1
+
+
+def parse_rate_limit(
+    headers: Mapping[str, str],
+) -> tuple[tuple[int, int], tuple[int, int]] | None:
+    """(usage, limit) from a Strava response, each as (15-minute, daily)."""
+    try:
+        short_usage, daily_usage = headers["X-RateLimit-Usage"].split(",")
+        short_limit, daily_limit = headers["X-RateLimit-Limit"].split(",")
+        return (
+            (int(short_usage), int(daily_usage)),
+            (int(short_limit), int(daily_limit)),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+class MemoryQuotaStore:
+    """The budget for this process only."""
+
+    def __init__(self, state: QuotaState | None = None):
+        self._state = state or QuotaState()
+        self._lock = threading.Lock()
+
+    def reserve(
+        self, now: float, share: float, reported: Reported | None = None
+    ) -> int | None:
+        with self._lock:
+            self._state.roll(now)
+            if reported is not None:
+                self._state.observe(reported)
+            return self._state.try_reserve(now, share)
+
+
+class PostgresQuotaStore:
+    """The budget in the strava_quota row, shared by every process.
+
+    Calls are taken from the row `block` at a time and handed out from memory,
+    separately for each share, until the window they were taken in ends.
+    """
+
+    ROW_ID = 1
+
+    def __init__(
+        self, engine_factory: Callable[[], Engine], block: int = DEFAULT_RESERVE_BLOCK
+    ):
+        self._engine_factory = engine_factory
+        self.block = block
+        # share -> (short window, day, calls taken and not yet handed out)
+        self._taken: dict[float, tuple[int, int, int]] = {}
+        # Reported usage not yet sent to the row.
+        self._reported: Reported | None = None
+        self._lock = threading.Lock()
+
+    def reserve(
+        self, now: float, share: float, reported: Reported | None = None
+    ) -> int | None:
+        """Hand out one call, or return the seconds until there's room for it.
+
+        Goes to the row only when the calls taken for `share` in this window
+        have run out; `reported` waits for that trip.
+        """
+        window, day = int(now // SHORT_WINDOW_SECONDS), int(now // DAY_SECONDS)
+        with self._lock:
+            if reported is not None:
+                self._reported = (
+                    reported if self._reported is None else self._reported.merge(reported)
+                )
+            taken_window, taken_day, left = self._taken.get(share, (None, None, 0))
+            if (taken_window, taken_day) == (window, day) and left:
+                self._taken[share] = (window, day, left - 1)
+                return None
+
+            reported, self._reported = self._reported, None
+            granted, state = self._take(now, share, reported)
+            if granted:
+                self._taken[share] = (window, day, granted - 1)
+                return None
+            # 1s if the window turned over while we were asking.
+            return state.retry_after(now, share) or 1
+
+    def _take(
+        self, now: float, share: float, reported: Reported | None
+    ) -> tuple[int, QuotaState]:
+        """Take up to `block` calls from the row: how many, and the row after.
+
+        A single UPDATE ... RETURNING, in autocommit, on a
+        connection of its own, so the row lock is never held across a Strava
+        call or the caller's transaction. It rolls the windows over, folds in
+        `reported`, and takes whatever of the block the budget allows.
+        """
+        with self._engine_factory().connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT")
+            for _ in range(2):
+                row = conn.execute(self._update(now, share, reported)).first()
+                if row is not None:
+                    granted, *state = row
+                    return granted, QuotaState(*state)
+                # The first call ever: there's no row to count it in yet.
+                conn.execute(
+                    insert(StravaQuota)
+                    .values(
+                        id=self.ROW_ID,
+                        short_limit=DEFAULT_SHORT_LIMIT,
+                        daily_limit=DEFAULT_DAILY_LIMIT,
+                    )
+                    .on_conflict_do_nothing(index_elements=["id"])
+                )
+        raise RuntimeError("The strava_quota row could not be created")
+
+    def _update(self, now: float, share: float, reported: Reported | None):
+        window, day = int(now // SHORT_WINDOW_SECONDS), int(now // DAY_SECONDS)
+        # What QuotaState.roll and .observe do, in SQL.
+        short_usage = case(
+            (StravaQuota.short_window == window, StravaQuota.short_usage), else_=0
+        )
+        daily_usage = case((StravaQuota.day == day, StravaQuota.daily_usage), else_=0)
+        short_limit, daily_limit = StravaQuota.short_limit, StravaQuota.daily_limit
+        if reported is not None:
+            short_limit, daily_limit = (literal(limit) for limit in reported.limit)
+            if int(reported.at // SHORT_WINDOW_SECONDS) == window:
+                short_usage = func.greatest(short_usage, reported.usage[0])
+            if int(reported.at // DAY_SECONDS) == day:
+                daily_usage = func.greatest(daily_usage, reported.usage[1])
+
+        # The row as it stands once rolled over and folded in, locked, so the
+        # UPDATE below counts from the latest version of it.
+        rolled = (
+            select(
+                StravaQuota.id,
+                short_usage.label("short_usage"),
+                short_limit.label("short_limit"),
+                daily_usage.label("daily_usage"),
+                daily_limit.label("daily_limit"),
+            )
+            .where(StravaQuota.id == self.ROW_ID)
+            .with_for_update()
+            .subquery("rolled")
+        )
+        # And QuotaState.try_reserve, for up to a block of calls at once.
+        granted = func.greatest(
+            0,
+            func.least(
+                self.block,
+                cast(func.floor(rolled.c.short_limit * share), Integer)
+                - rolled.c.short_usage,
+                cast(func.floor(rolled.c.daily_limit * share), Integer)
+                - rolled.c.daily_usage,
+            ),
+        )
+        return (
+            update(StravaQuota)
+            .where(StravaQuota.id == rolled.c.id)
+            .values(
+                short_window=window,
+                short_usage=rolled.c.short_usage + granted,
+                short_limit=rolled.c.short_limit,
+                day=day,
+                daily_usage=rolled.c.daily_usage + granted,
+                daily_limit=rolled.c.daily_limit,
+            )
+            .returning(
+                granted,
+                StravaQuota.short_window,
+                StravaQuota.short_usage,
+                StravaQuota.short_limit,
+                StravaQuota.day,
+                StravaQuota.daily_usage,
+                StravaQuota.daily_limit,
+            )
+        )
+
+
+class QuotaGovernor:
+    def __init__(
+        self,
+        store,
+        background_share: float = DEFAULT_BACKGROUND_SHARE,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.store = store
+        self.background_share = background_share
+        self._clock = clock
+        self._reported: Reported | None = None
+        self._reported_lock = threading.Lock()
+
+    def share(self, priority: Priority) -> float:
+        return 1.0 if priority is Priority.INTERACTIVE else self.background_share
+
+    def reserve(self, priority: Priority | None = None) -> None:
+        """Count one call against the budget, or raise QuotaExhausted."""
+        priority = priority or _priority.get()
+        with self._reported_lock:
+            reported, self._reported = self._reported, None
+        retry_after = self.store.reserve(self._clock(), self.share(priority), reported)
+        if retry_after is not None:
+            logger.warning(
+                "Strava budget spent for %s calls; next in %ss",
+                priority.value,
+                retry_after,
+            )
+            raise QuotaExhausted(retry_after)
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        """Keep what a response reported, for the next reservation to fold in.
+
+        If the next reservation fails, what it was carrying is dropped. The
+        response after it will report the same again.
+        """
+        parsed = parse_rate_limit(headers)
+        if parsed is None:
+            return
+        reported = Reported(self._clock(), *parsed)
+        with self._reported_lock:
+            if self._reported is not None:
+                reported = self._reported.merge(reported)
+            self._reported = reported
+
+
+_governor: QuotaGovernor | None = None
+_lock = threading.Lock()
+
+
+def _build_governor() -> QuotaGovernor:
+    if os.getenv("STRAVA_QUOTA_STORE", "postgres") == "memory":
+        store = MemoryQuotaStore()
+    else:
+        store = PostgresQuotaStore(
+            get_engine,
+            block=int(os.getenv("STRAVA_QUOTA_BLOCK", DEFAULT_RESERVE_BLOCK)),
+        )
+    return QuotaGovernor(
+        store,
+        background_share=float(
+            os.getenv("STRAVA_BACKGROUND_SHARE", DEFAULT_BACKGROUND_SHARE)
+        ),
+    )
+
+
+def get_governor() -> QuotaGovernor:
+    """Return the process-wide governor, building it on first use."""
+    global _governor
+    if _governor is None:
+        with _lock:
+            if _governor is None:
+                _governor = _build_governor()
+    return _governor
+
+
+def reset_governor() -> None:
+    global _governor
+    with _lock:
+        _governor = None
+
+
+def request(method: str, url: str, **kwargs):
+    """`http_client.request` for the Strava API, within the shared budget.
+
+    Each attempt is counted, retries included: Strava counts them too.
+    """
+    governor = get_governor()
+    response = http_client.request(method, url, before_attempt=governor.reserve, **kwargs)
+    governor.observe(response.headers)
+    return response
+
+
+def get(url: str, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url: str, **kwargs):
+    return request("PUT", url, **kwargs)
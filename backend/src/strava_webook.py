@@ -1,4 +1,49 @@
-import requests
+"""Strava webhook: subscription, verification, and event ingestion.
+
+Strava wants a 200 within two seconds of posting an event and retries if it
+doesn't get one, while enhancing an activity takes several seconds of Spotify
+and Strava calls. So ingestion and processing are separate stages: the
+endpoint validates the event, stores it (deduped on object and aspect, since
+retries resend the same event) along with a job to process it, and answers
+straight away. A worker (src/worker.py) runs the enhancement from the stored
+row, retrying it if a provider is having trouble. Activities an athlete
+uploads together (a warm-up, race and cool-down) are enhanced together, by
+whichever of their jobs runs first, from one read of the listening history.
+
+Configuration:
+
+    STRAVA_WEBHOOK_VERIFY_TOKEN  echoed back by Strava when subscribing
+    STRAVA_SUBSCRIPTION_ID       events for any other subscription are refused;
+                                 unset, every event is
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from src import http_client
+from src.config import (
+    STRAVA_SUBSCRIPTION_ID,
+    STRAVA_URL,
+    STRAVA_WEBHOOK_VERIFY_TOKEN,
+)
+from src.db import User, WebhookEvent
+from src.jobs import Deferred, enqueue, job_handler
+from src.strava import add_playlist_to_activity, add_playlists_to_activities
+from src.strava_quota import QuotaExhausted, background_priority
+from src.strava_models import StravaWebhookEvent
+
+WEBHOOK_EVENT_JOB = "strava_webhook_event"
+# Most other unprocessed new activities of the same athlete enhanced alongside
+# an event's own.
+BATCH_LIMIT = 10
+
+logger = logging.getLogger(__name__)
+_warned_unconfigured = False
 
 
 def subscribe_to_strava(
@@ -16,7 +61,7 @@ def subscribe_to_strava(
     Returns:
         None - prints success message if subscription is successful.
     """
-    STRAVA_SUBSCRIPTION_URL = "https://www.strava.com/api/v3/push_subscriptions"
+    STRAVA_SUBSCRIPTION_URL = f"{STRAVA_URL}/api/v3/push_subscriptions"
 
     data = {
         "client_id": STRAVA_CLIENT_ID,
@@ -25,7 +70,9 @@ def subscribe_to_strava(
         "verify_token": VERIFICATION_TOKEN,
     }
 
-    response = requests.post(STRAVA_SUBSCRIPTION_URL, json=data)
+    response = http_client.post(
+        STRAVA_SUBSCRIPTION_URL, json=data, name="strava.subscribe"
+    )
 
     if response.status_code == 201:
         print("Successfully subscribed to Strava updates")
@@ -35,53 +82,158 @@ def subscribe_to_strava(
     return response.json()
 
 
-# See below for how to call the above function at the server root and respond to its redirect.
+def verify_subscription(
+    hub_mode: str | None, hub_verify_token: str | None, hub_challenge: str | None
+) -> str | None:
+    """Strava's GET callback check: the challenge to echo, or None to refuse."""
+    if hub_mode != "subscribe" or not hub_challenge:
+        return None
+    if not STRAVA_WEBHOOK_VERIFY_TOKEN or hub_verify_token != STRAVA_WEBHOOK_VERIFY_TOKEN:
+        return None
+    return hub_challenge
 
-# STRAVA_SUB_CALLBACK_URL = os.getenv("STRAVA_CALLBACK_URL")
-# STRAVA_SUB_VERIFICATION_TOKEN = generate_random_string(16)
 
-# @app.get("/strava/webhook")
-# def verify_webhook(request: Request):
+def is_our_subscription(event: StravaWebhookEvent) -> bool:
+    # Events carry no signature; the subscription id is the check available.
+    # Without one configured, nothing can be told apart from a forgery.
+    global _warned_unconfigured
+    if not STRAVA_SUBSCRIPTION_ID:
+        if not _warned_unconfigured:
+            _warned_unconfigured = True
+            logger.warning("STRAVA_SUBSCRIPTION_ID is not set; refusing webhook events")
+        return False
+    return str(event.subscription_id) == STRAVA_SUBSCRIPTION_ID
 
-#     hub_mode = request.query_params.get("hub.mode")
-#     hub_challenge = request.query_params.get("hub.challenge")
-#     hub_verify_token = request.query_params.get("hub.verify_token")
 
-#     print(hub_mode, hub_challenge, hub_verify_token)
-
-#     """
-#     Strava will send a GET request to verify the callback URL.
-#     Check if tokens match and respond back with hub.challenge.
-
-#     Args:
-#         hub_mode: str - Strava hub.mode.
-#         hub_challenge: str - Strava hub.challenge.
-#         hub_verify_token: str - Strava hub.verify_token.
-
-#     Returns:
-#         dict: hub.challenge if tokens match, error message otherwise.
-#     """
-#     if hub_mode != "subscribe":
-#         return {"error": "Invalid hub.mode"}
-
-#     if hub_verify_token == STRAVA_SUB_VERIFICATION_TOKEN:
-#         return {"hub.challenge": hub_challenge}
-
-#     return {"error": "Invalid verification token"}
+def is_actionable(event: StravaWebhookEvent) -> bool:
+    """Only new activities get a playlist.
 
+    Updates in particular must be ignored: writing the playlist link onto an
+    activity is itself an update, and would otherwise trigger another run.
+    """
+    return event.object_type == "activity" and event.aspect_type == "create"
 
-# # NOT WORKING, INCOMPLETE: Connect to Strava endpoint, kick things off with subscribe_to_strava.
-# @app.get("/strava/subscribe")
-# def connect_to_strava():
-#     """
-#     Trigger the Strava subscription process when a user visits this endpoint.
-#     """
 
-#     subscribe_to_strava(
-#         STRAVA_CLIENT_ID=STRAVA_CLIENT_ID,
-#         STRAVA_CLIENT_SECRET=STRAVA_CLIENT_SECRET,
-#         CALLBACK_URL=STRAVA_SUB_CALLBACK_URL,
-#         VERIFICATION_TOKEN=STRAVA_SUB_VERIFICATION_TOKEN,
-#     )
+def record_event(db: Session, event: StravaWebhookEvent) -> int | None:
+    """Store an event, and queue it if it's worth acting on, in one commit.
 
-#     return {"message": "Subscription request sent to Strava"}
+    Returns the event's id, or None if it was a duplicate.
+    """
+    statement = (
+        insert(WebhookEvent)
+        .values(
+            object_type=event.object_type,
+            object_id=event.object_id,
+            aspect_type=event.aspect_type,
+            owner_id=event.owner_id,
+            event_time=event.event_time,
+            updates=event.updates,
+            received_at=datetime.now(),
+        )
+        .on_conflict_do_nothing(constraint="uq_webhook_event")
+        .returning(WebhookEvent.id)
+    )
+    event_id = db.execute(statement).scalar_one_or_none()
+    if event_id is not None and is_actionable(event):
+        enqueue(db, WEBHOOK_EVENT_JOB, {"event_id": event_id})
+    db.commit()
+    return event_id
+
+
+def pending_siblings(db: Session, event: WebhookEvent) -> list[WebhookEvent]:
+    """The athlete's other new activities still waiting on a playlist."""
+    return list(
+        db.execute(
+            select(WebhookEvent)
+            .where(
+                WebhookEvent.owner_id == event.owner_id,
+                WebhookEvent.object_type == "activity",
+                WebhookEvent.aspect_type == "create",
+                WebhookEvent.processed_at.is_(None),
+                WebhookEvent.id != event.id,
+            )
+            .order_by(WebhookEvent.id)
+            .limit(BATCH_LIMIT)
+        )
+        .scalars()
+        .all()
+    )
+
+
+@job_handler(WEBHOOK_EVENT_JOB)
+def process_event(payload: dict, db: Session) -> None:
+    """Enhance the activity a stored event is about, and mark it processed.
+
+    Failures that are the activity's fault (no songs played, say) are recorded
+    on the event and done with. Provider errors and anything unexpected are
+    raised, so the job is retried with backoff. Its Strava calls are background
+    work: once that share of the rate limit is spent, the job waits for the
+    window to reset.
+
+    The athlete's other pending activities go in the same batch; their own
+    jobs then find them processed. One that fails with a provider error is
+    left for its own job to retry.
+    """
+    event = db.get(WebhookEvent, payload["event_id"])
+    if event is None or event.processed_at is not None:
+        return
+
+    user = db.query(User).filter(User.strava_id == str(event.owner_id)).first()
+    if user is None or not user.spotify_id:
+        event.error = "no linked Spotify account"
+        event.processed_at = datetime.now()
+        db.commit()
+        return
+
+    siblings = pending_siblings(db, event)
+    if not siblings:
+        _process_one(event, user, db)
+        return
+
+    events = [event, *siblings]
+    try:
+        with background_priority():
+            results = add_playlists_to_activities(
+                user.id, user.spotify_id, [e.object_id for e in events], db
+            )
+    except QuotaExhausted as e:
+        raise _deferred(e.retry_after)
+
+    retry = None
+    for pending, result in zip(events, results):
+        status_code = result.get("status_code")
+        if status_code is not None and status_code >= 500:
+            if pending is event:
+                retry = result
+            continue
+        if status_code is not None:
+            pending.error = f"{status_code}: {result['detail']}"
+        pending.processed_at = datetime.now()
+    db.commit()
+
+    if retry is not None:
+        if "retry_after" in retry:
+            raise _deferred(retry["retry_after"])
+        raise HTTPException(status_code=retry["status_code"], detail=retry["detail"])
+
+
+def _process_one(event: WebhookEvent, user: User, db: Session) -> None:
+    try:
+        with background_priority():
+            add_playlist_to_activity(user.id, user.spotify_id, event.object_id, db)
+    except QuotaExhausted as e:
+        raise _deferred(e.retry_after)
+    except HTTPException as e:
+        if e.status_code >= 500:
+            raise
+        event.error = f"{e.status_code}: {e.detail}"
+
+    event.processed_at = datetime.now()
+    db.commit()
+
+
+def _deferred(retry_after: int) -> Deferred:
+    return Deferred(
+        datetime.now() + timedelta(seconds=retry_after),
+        "Strava budget for background work is spent",
+    )
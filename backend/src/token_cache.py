@@ -0,0 +1,176 @@
+"""In-process cache of provider access tokens, with single-flight refresh.
+
+Every Spotify or Strava call needs an access token, and reading it from
+Postgres each time costs a round trip per call. Access tokens are valid for
+hours, so a process can keep them in memory until shortly before they expire.
+
+Refreshing needs more care than reading. Spotify may rotate the refresh token
+on every refresh, so two refreshes racing for the same user leave the loser
+holding a refresh token that no longer works. Two guards:
+
+- Within a process, one lock per (user_id, provider): the first caller
+  refreshes, everyone behind it finds the fresh token in the cache.
+- Across processes, the refresh happens under `SELECT ... FOR UPDATE` on the
+  token row and re-checks expiry once it holds the lock, so a second instance
+  waits and then reads what the first one stored.
+
+Refreshes happen REFRESH_MARGIN before `expires_at` rather than after it, so a
+token never expires mid-request.
+
+Neither lock is held for longer than a refresh takes. Reading the stored
+tokens happens before either is taken. A request that finds a refresh already
+under way uses the old token if it's still valid. Otherwise it waits up to
+TOKEN_REFRESH_LOCK_TIMEOUT seconds (default 10), then gives up with a 503.
+The refresh call's own timeout, REFRESH_HTTP_TIMEOUT, is shorter than that
+wait. So a slow token endpoint fails the refresh before anyone waiting on it
+gives up.
+"""
+
+import os
+import time
+from typing import Callable
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from src.db import Token
+from src.tracing import span
+from src.ttl_cache import DEFAULT_MAX_ENTRIES, TTLCache
+
+# Treat a token as expired this long before it actually is.
+REFRESH_MARGIN_SECONDS = 5 * 60
+# A token expiring sooner than this isn't handed out, even while a refresh is
+# under way, because the request using it might outlast it.
+MIN_REMAINING_SECONDS = 60
+
+REFRESH_LOCK_TIMEOUT_SECONDS = float(os.getenv("TOKEN_REFRESH_LOCK_TIMEOUT", 10))
+# (connect, read) for the provider's token endpoint, together well inside the
+# lock wait. Sent without retries for the same reason.
+REFRESH_HTTP_TIMEOUT = (REFRESH_LOCK_TIMEOUT_SECONDS / 4, REFRESH_LOCK_TIMEOUT_SECONDS / 2)
+
+# Postgres's SQLSTATE for a lock_timeout that ran out.
+LOCK_NOT_AVAILABLE = "55P03"
+
+class TokenCache(TTLCache[str]):
+    """Access tokens by (user_id, provider), expiring `margin` early.
+
+    Values are access tokens and expiries are Unix seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        margin: float = REFRESH_MARGIN_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        super().__init__(max_entries=max_entries, margin=margin, clock=clock)
+
+
+token_cache = TokenCache()
+
+
+def get_access_token(
+    user_id: int,
+    provider: str,
+    db: Session,
+    refresh: Callable[[Token, Session], Token],
+) -> str:
+    """A usable access token for a user, from memory if possible.
+
+    Falls back to the database, reading the user and both their tokens in one
+    query (see src/credentials.py), and refreshes this one through `refresh`
+    when it is within REFRESH_MARGIN_SECONDS of expiring. `refresh` must store the new
+    token (which commits, releasing the row lock) and return the stored row.
+    """
+    key = (user_id, provider)
+    access_token = token_cache.get(key)
+    if access_token is not None:
+        return access_token
+
+    # Imported here: src.credentials builds on this module.
+    from src.credentials import load_credentials
+
+    # Outside the lock: a read needs no guarding, and caches what it finds.
+    credentials = load_credentials(db, user_id)
+    stored = credentials.token(provider) if credentials else None
+    if stored is None:
+        raise _not_connected(provider)
+    if token_cache.is_fresh(stored.expires_at):
+        token_cache.put(key, stored.access_token, stored.expires_at)
+        return stored.access_token
+
+    # A token inside the margin still works. If someone else is refreshing
+    # it, use it rather than wait for them.
+    usable = stored.expires_at - MIN_REMAINING_SECONDS > time.time()
+    wait = 0 if usable else REFRESH_LOCK_TIMEOUT_SECONDS
+    with token_cache.locked(key, timeout=wait) as acquired:
+        if not acquired:
+            return _during_refresh(stored, provider)
+        # Whoever held the lock before us may have just refreshed it.
+        access_token = token_cache.get(key)
+        if access_token is not None:
+            return access_token
+
+        # Take the row lock, then look again: another instance may have
+        # refreshed while we were waiting for it.
+        try:
+            token = _token_row(user_id, provider, db, for_update=True)
+        except OperationalError as exc:
+            if _sqlstate(exc) != LOCK_NOT_AVAILABLE:
+                raise
+            db.rollback()
+            return _during_refresh(stored, provider)
+        if token_cache.is_fresh(token.expires_at.timestamp()):
+            db.commit()
+        else:
+            with span("token.refresh", provider=provider):
+                token = refresh(token, db)
+        token_cache.put(key, token.access_token, token.expires_at.timestamp())
+        return token.access_token
+
+
+def _during_refresh(stored, provider: str) -> str:
+    """The stored token while another caller refreshes it, if it's still usable."""
+    if stored.expires_at - MIN_REMAINING_SECONDS > time.time():
+        return stored.access_token
+    raise HTTPException(
+        status_code=503,
+        detail=f"Reconnecting to {provider.title()} is taking a while. Try again in a moment.",
+        headers={"Retry-After": "5"},
+    )
+
+
+def _sqlstate(exc: OperationalError) -> str | None:
+    # psycopg 3 and psycopg2 name it differently.
+    return getattr(exc.orig, "sqlstate", None) or getattr(exc.orig, "pgcode", None)
+
+
+def _token_row(
+    user_id: int, provider: str, db: Session, for_update: bool = False
+) -> Token:
+    query = db.query(Token).filter(
+        Token.user_id == user_id, Token.provider == provider
+    )
+    if for_update:
+        if db.get_bind().dialect.name == "postgresql":
+            # Another instance refreshing holds the row for no longer than its
+            # provider call is allowed to take; don't wait on it forever.
+            db.execute(
+                text(f"SET LOCAL lock_timeout = {int(REFRESH_LOCK_TIMEOUT_SECONDS * 1000)}")
+            )
+        # populate_existing: the row is already in the session from the first
+        # read, and we need what is in the database now, not that copy.
+        query = query.with_for_update().populate_existing()
+    token = query.first()
+    if token is None or token.expires_at is None:
+        raise _not_connected(provider)
+    return token
+
+
+def _not_connected(provider: str) -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"Your {provider.title()} account isn't connected. Connect it and try again.",
+    )
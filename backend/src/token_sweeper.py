@@ -0,0 +1,225 @@
+"""Refresh provider tokens before anyone needs them.
+
+Left alone, a token is only refreshed when a request finds it expired, and
+that request waits on the provider's token endpoint. The sweeper gets there
+first: it walks the tokens table in `expires_at` order (indexed), refreshes
+everything due within a horizon, and writes each batch back in one statement.
+
+Run it on a schedule, either from cron:
+
+    python -m src.token_sweeper --horizon-minutes 30
+
+or by hitting `GET /api/cron/refresh-tokens` with `Authorization: Bearer
+$CRON_SECRET`. Schedule it more often than the horizon, so every token is seen
+at least once before it expires.
+
+A batch is claimed in one statement that stamps `updated_at` on its rows and
+commits, so no row lock is held while the provider calls run: a request
+refreshing a token itself (see token_cache) never waits on a slow batch. The
+stamp is the claim. Another sweeper skips rows stamped within CLAIM_LEASE, and
+skips rows another claim has locked at that moment (`SKIP LOCKED`). The results are
+written back only to rows that still hold the refresh token and expiry that
+were claimed, so a token refreshed by a request in the meantime is left as
+that request stored it.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from sqlalchemy import DateTime, Integer, String, column, or_, select, update, values
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from src.db import SessionLocal, Token
+from src.strava import fetch_refreshed_strava_token
+from src.token_cache import token_cache
+from spotify import fetch_refreshed_spotify_token
+
+DEFAULT_HORIZON = timedelta(minutes=30)
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 8
+# A claimed token is left to its sweeper for this long: well past what a
+# batch's refresh calls can take, each bounded by REFRESH_HTTP_TIMEOUT.
+CLAIM_LEASE = timedelta(minutes=5)
+
+REFRESHERS: Dict[str, Callable[[str], dict]] = {
+    "spotify": fetch_refreshed_spotify_token,
+    "strava": fetch_refreshed_strava_token,
+}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepResult:
+    refreshed: int = 0
+    failed: List[int] = field(default_factory=list)
+
+
+def _claim_due(
+    db: Session, due_before: datetime, batch_size: int, skip: List[int]
+) -> List[Row]:
+    """Claim a batch and commit. Plain rows of what the refresh and write-back need."""
+    now = datetime.now()
+    due = (
+        select(Token.id)
+        .where(
+            Token.expires_at < due_before,
+            Token.refresh_token.isnot(None),
+            or_(Token.updated_at.is_(None), Token.updated_at < now - CLAIM_LEASE),
+        )
+        .order_by(Token.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    if skip:
+        due = due.where(Token.id.notin_(skip))
+    claimed = db.execute(
+        update(Token)
+        .where(Token.id.in_(due.scalar_subquery()))
+        .values(updated_at=now)
+        .returning(Token.id, Token.provider, Token.refresh_token, Token.expires_at)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return claimed
+
+
+def _write_back(db: Session, claimed: List[Row], refreshed: List[dict]) -> List[Row]:
+    """Store refreshed tokens whose rows are as claimed, in one statement. Commits.
+
+    Returns (user_id, provider, access_token, expires_at) for each one stored.
+    """
+    rows = values(
+        column("id", Integer),
+        column("claimed_refresh_token", String),
+        column("claimed_expires_at", DateTime),
+        column("access_token", String),
+        column("refresh_token", String),
+        column("expires_at", DateTime),
+        name="refreshed",
+    ).data(
+        [
+            (
+                token.id,
+                token.refresh_token,
+                token.expires_at,
+                fields["access_token"],
+                fields["refresh_token"],
+                fields["expires_at"],
+            )
+            for token, fields in zip(claimed, refreshed)
+        ]
+    )
+    stored = db.execute(
+        update(Token)
+        .where(
+            Token.id == rows.c.id,
+            Token.refresh_token == rows.c.claimed_refresh_token,
+            Token.expires_at == rows.c.claimed_expires_at,
+        )
+        .values(
+            access_token=rows.c.access_token,
+            refresh_token=rows.c.refresh_token,
+            expires_at=rows.c.expires_at,
+            updated_at=datetime.now(),
+        )
+        .returning(Token.user_id, Token.provider, Token.access_token, Token.expires_at)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return stored
+
+
+def _refresh(token_id: int, provider: str, refresh_token: str) -> dict | None:
+    try:
+        return REFRESHERS[provider](refresh_token)
+    except Exception:
+        logger.exception("Refreshing %s token %s failed", provider, token_id)
+        return None
+
+
+def sweep(
+    db: Session,
+    horizon: timedelta = DEFAULT_HORIZON,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> SweepResult:
+    """Refresh every token expiring within `horizon`, a batch at a time.
+
+    Provider calls in a batch run on up to `concurrency` threads; the Session
+    stays on this one, and holds no locks while they run. Tokens whose
+    refresh fails are skipped for the rest of the sweep and reported, not
+    retried. A token changed by someone else since it was claimed isn't
+    counted as either.
+    """
+    result = SweepResult()
+    due_before = datetime.now() + horizon
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = _claim_due(db, due_before, batch_size, result.failed)
+            if not batch:
+                break
+
+            refreshed = list(
+                pool.map(
+                    _refresh,
+                    [token.id for token in batch],
+                    [token.provider for token in batch],
+                    [token.refresh_token for token in batch],
+                )
+            )
+
+            claimed, results = [], []
+            for token, fields in zip(batch, refreshed):
+                if fields is None:
+                    result.failed.append(token.id)
+                    continue
+                claimed.append(token)
+                results.append(fields)
+            if not claimed:
+                continue
+
+            stored = _write_back(db, claimed, results)
+            for user_id, provider, access_token, expires_at in stored:
+                token_cache.put((user_id, provider), access_token, expires_at.timestamp())
+            result.refreshed += len(stored)
+
+    return result
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--horizon-minutes",
+        type=float,
+        default=DEFAULT_HORIZON.total_seconds() / 60,
+        help="refresh tokens expiring within this many minutes",
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        result = sweep(
+            db,
+            horizon=timedelta(minutes=args.horizon_minutes),
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+        )
+    finally:
+        db.close()
+
+    logger.info("Refreshed %d tokens, %d failed", result.refreshed, len(result.failed))
+    return 1 if result.failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
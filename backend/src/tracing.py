@@ -0,0 +1,378 @@
+"""Per-request traces: which stage, provider call or query a request spent its time in.
+
+Every request gets an ID (the caller's X-Request-ID if it sent a sensible
+one, otherwise a fresh one) and a trace. Inside it, spans mark:
+
+- the stages of adding a playlist, through `traced` on the functions that
+  make them up;
+- every provider call, from src/http_client.py, with its status and retries;
+- every SQL statement, from the engine's cursor events.
+
+Spans nest by context, so stages run on worker threads with
+`asyncio.to_thread` land under the span that started them. Log records made
+during a request carry its request_id, trace_id and span_id.
+
+A request slower than SLOW_REQUEST_MS (default 2000) is logged with its whole
+span tree. With TRACE_EXPORT_PATH set, every trace is also appended to that
+file, one OTLP/JSON ExportTraceServiceRequest per line, which the
+OpenTelemetry Collector's otlpjsonfile receiver reads. On Vercel only /tmp is
+writable.
+
+Outside a request (the worker, the sweeper, tests) there's no trace and
+spans cost nothing.
+"""
+
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+DEFAULT_SLOW_REQUEST_MS = 2000.0
+REQUEST_ID_HEADER = b"x-request-id"
+SERVICE_NAME = "rebeat"
+
+logger = logging.getLogger(__name__)
+
+# What a caller-supplied request ID may look like; anything else is replaced.
+_REQUEST_ID = re.compile(r"^[\w.:-]{1,128}$")
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    kind: str = "internal"  # "server", "client" or "internal", as in OTLP
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    attributes: Dict[str, object] = field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def end(self, error: str | None = None) -> None:
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = error
+
+
+@dataclass
+class Trace:
+    request_id: str
+    trace_id: str = field(default_factory=lambda: os.urandom(16).hex())
+    # Appended to from worker threads; list.append is atomic.
+    spans: List[Span] = field(default_factory=list)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_span: ContextVar[Span | None] = ContextVar("span", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+def request_id() -> str | None:
+    trace = _trace.get()
+    return trace.request_id if trace else None
+
+
+def start_span(name: str, kind: str = "internal", **attributes) -> Span | None:
+    """Open a span under the current one, without making it current.
+
+    For spans with nothing nested in them that open and close in different
+    callbacks, like a SQL statement. Close it with `Span.end`.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return None
+    parent = _span.get()
+    span = Span(
+        name=name,
+        trace_id=trace.trace_id,
+        span_id=os.urandom(8).hex(),
+        parent_id=parent.span_id if parent else None,
+        kind=kind,
+        attributes=attributes,
+    )
+    trace.spans.append(span)
+    return span
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """A span around the block, current for anything opened inside it."""
+    opened = start_span(name, kind, **attributes)
+    if opened is None:
+        yield None
+        return
+    token = _span.set(opened)
+    try:
+        yield opened
+    except BaseException as error:
+        opened.error = _describe(error)
+        raise
+    finally:
+        opened.end()
+        _span.reset(token)
+
+
+def traced(name: str | Callable) -> Callable:
+    """Run a function inside a span: `@traced("name")`, or bare `@traced` to
+    name the span after the function.
+    """
+    if callable(name):
+        return traced(name.__name__)(name)
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _trace.get() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def annotate(**attributes) -> None:
+    """Add attributes to the current span, if there is one."""
+    current = _span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def _describe(error: BaseException) -> str:
+    detail = getattr(error, "detail", None)
+    status = getattr(error, "status_code", None)
+    if detail is not None:
+        return f"{type(error).__name__} {status}: {detail}"
+    return f"{type(error).__name__}: {error}"
+
+
+# --- SQL -----------------------------------------------------------------
+
+
+def instrument_engine(engine) -> None:
+    """Give every statement `engine` executes a span."""
+    from sqlalchemy import event
+
+    from src.metrics import statement_label
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("rebeat_query_spans", []).append(
+            start_span(
+                statement_label(statement),
+                kind="client",
+                **{"db.system": engine.dialect.name, "db.statement": statement[:1000]},
+            )
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finished(conn, cursor, statement, parameters, context, executemany):
+        opened = conn.info["rebeat_query_spans"].pop()
+        if opened is not None:
+            opened.end()
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        spans = context.connection.info.get("rebeat_query_spans") if context.connection else None
+        if spans:
+            opened = spans.pop()
+            if opened is not None:
+                opened.end(_describe(context.original_exception))
+
+
+# --- logging -------------------------------------------------------------
+
+
+def install_log_context() -> None:
+    """Stamp every log record with the request, trace and span it was made in.
+
+    As `request_id`, `trace_id` and `span_id` ("-" outside a request), for
+    use in a handler's format string. Safe to call more than once.
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "_rebeat_tracing", False):
+        return
+
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        trace = _trace.get()
+        current = _span.get()
+        record.request_id = trace.request_id if trace else "-"
+        record.trace_id = trace.trace_id if trace else "-"
+        record.span_id = current.span_id if current else "-"
+        return record
+
+    make_record._rebeat_tracing = True
+    logging.setLogRecordFactory(make_record)
+
+
+# --- reporting -----------------------------------------------------------
+
+
+def format_tree(trace: Trace) -> str:
+    """The trace's spans as an indented tree, each with its duration."""
+    children: Dict[str | None, List[Span]] = {}
+    for each in trace.spans:
+        children.setdefault(each.parent_id, []).append(each)
+    lines = []
+
+    def walk(parent_id, depth):
+        for each in sorted(children.get(parent_id, []), key=lambda s: s.start_ns):
+            offset = (each.start_ns - trace.spans[0].start_ns) / 1e6
+            line = f"{'  ' * depth}{each.name}  {each.duration_ms:.1f} ms  (+{offset:.1f})"
+            extras = [f"{key}={value}" for key, value in each.attributes.items()
+                      if key != "db.statement"]
+            if each.error:
+                extras.append(f"error={each.error}")
+            if extras:
+                line += "  " + " ".join(extras)
+            lines.append(line)
+            walk(each.span_id, depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+
+_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def to_otlp(trace: Trace) -> dict:
+    """The trace as an OTLP/JSON ExportTraceServiceRequest."""
+    spans = []
+    for each in trace.spans:
+        otlp = {
+            "traceId": each.trace_id,
+            "spanId": each.span_id,
+            "name": each.name,
+            "kind": _KINDS[each.kind],
+            "startTimeUnixNano": str(each.start_ns),
+            "endTimeUnixNano": str(each.end_ns or each.start_ns),
+            "attributes": _otlp_attributes(each.attributes),
+            # 1 is OK, 2 is ERROR.
+            "status": {"code": 2, "message": each.error} if each.error else {"code": 1},
+        }
+        if each.parent_id:
+            otlp["parentSpanId"] = each.parent_id
+        spans.append(otlp)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes({"service.name": SERVICE_NAME})
+                },
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }
+        ]
+    }
+
+
+_export_lock = threading.Lock()
+
+
+def export(trace: Trace, path: str) -> None:
+    line = json.dumps(to_otlp(trace), separators=(",", ":"))
+    with _export_lock, open(path, "a", encoding="utf-8") as out:
+        out.write(line + "\n")
+
+
+# --- requests ------------------------------------------------------------
+
+
+class RequestTracer:
+    """ASGI middleware that gives each request an ID and a trace.
+
+    The ID goes back in the X-Request-ID response header. Once the response
+    is sent the trace is logged if slow, and exported if configured.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.slow_ms = float(os.getenv("SLOW_REQUEST_MS", DEFAULT_SLOW_REQUEST_MS))
+        self.export_path = os.getenv("TRACE_EXPORT_PATH") or None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or []).get(REQUEST_ID_HEADER, b"").decode(
+            "latin-1"
+        )
+        trace = Trace(
+            request_id=incoming if _REQUEST_ID.match(incoming) else os.urandom(8).hex()
+        )
+        trace_token = _trace.set(trace)
+        # For the unhandled-error handler, which runs outside this middleware.
+        scope.setdefault("state", {})["request_id"] = trace.request_id
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.response.status_code"] = message["status"]
+                headers = list(message.get("headers") or [])
+                headers.append((REQUEST_ID_HEADER, trace.request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            with span(
+                f"{scope['method']} {scope['path']}",
+                kind="server",
+                **{"http.request.method": scope["method"], "request_id": trace.request_id},
+            ) as root:
+                try:
+                    await self.app(scope, receive, send_with_request_id)
+                finally:
+                    # Named after the route template once routing has found it.
+                    route = getattr(scope.get("route"), "path", None)
+                    if route:
+                        root.name = f"{scope['method']} {route}"
+                        root.attributes["http.route"] = route
+        finally:
+            _trace.reset(trace_token)
+            self._report(trace, root)
+
+    def _report(self, trace: Trace, root: Span) -> None:
+        if root.duration_ms >= self.slow_ms:
+            logger.warning(
+                "Slow request %s: %s took %.0f ms\n%s",
+                trace.request_id,
+                root.name,
+                root.duration_ms,
+                format_tree(trace),
+            )
+        if self.export_path:
+            try:
+                export(trace, self.export_path)
+            except OSError:
+                logger.exception("Couldn't export trace to %s", self.export_path)
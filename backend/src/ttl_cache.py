@@ -0,0 +1,120 @@
+"""A bounded in-process cache whose entries expire, with single-flight loading.
+
+The process-wide caches (access tokens, decoded JWTs and users, pages of
+Strava activities) all need the same thing: a map that forgets an entry once
+it expires, stays within a fixed number of entries by dropping the least
+recently used, and is safe to share between threads. Some also need a miss
+to be loaded once, however many callers want it at the same moment.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Generic, Hashable, Iterator, Tuple, TypeVar
+
+V = TypeVar("V")
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class TTLCache(Generic[V]):
+    """LRU map of key -> (value, expires_at on `clock`).
+
+    Entries within `margin` of expiry read as missing, and are evicted when
+    read. `put` without an expiry keeps the value for `ttl` seconds.
+    `get_or_load` lets only one caller per key run the loader at a time; a
+    key's lock exists only while someone holds or waits for it.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        margin: float = 0,
+        ttl: float | None = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.max_entries = max_entries
+        self.margin = margin
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[V, float]]" = OrderedDict()
+        # key -> [its load lock, how many callers hold or wait for it]
+        self._locks: dict[Hashable, list] = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, expires_at: float) -> bool:
+        return expires_at - self.margin > self._clock()
+
+    def get(self, key: Hashable) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if not self.is_fresh(expires_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: V, expires_at: float | None = None) -> None:
+        if expires_at is None:
+            if self.ttl is None:
+                raise TypeError("put needs expires_at on a cache without a ttl")
+            expires_at = self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    @contextmanager
+    def locked(self, key: Hashable, timeout: float = -1) -> Iterator[bool]:
+        """Hold `key`'s load lock for the block.
+
+        Yields whether it was acquired, which only fails if `timeout` seconds
+        (0 to not wait at all) run out first.
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        lock = entry[0]
+        try:
+            acquired = lock.acquire(timeout=timeout)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    lock.release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Tuple[V, float]]) -> V:
+        """Return the cached value, or run `load` once for everyone waiting.
+
+        `load` returns (value, expires_at on the cache's clock).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.locked(key):
+            # Whoever held the lock before us may have just loaded it.
+            value = self.get(key)
+            if value is not None:
+                return value
+            value, expires_at = load()
+            self.put(key, value, expires_at)
+            return value
@@ -0,0 +1,101 @@
+"""Who's asking, cached per process so most authenticated requests skip Postgres.
+
+Every authenticated request decodes its JWT and needs the user behind it
+before any real work starts, and loading the user is a round trip to the
+database. Both are kept here:
+
+- decoded tokens, by token string, until the token itself expires;
+- users, by id, as frozen `CurrentUser` snapshots, for USER_CACHE_TTL_SECONDS.
+
+Snapshots rather than ORM rows, because a row belongs to the session that
+loaded it and is detached once that request ends.
+
+A process that changes a user (linking a provider, setting their name) drops
+them from its own cache. Other processes keep their copy until the TTL runs
+out, which bounds how stale a user can be: a newly linked account shows up
+everywhere within a minute.
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from sqlalchemy.orm import Session
+
+from src.db import User
+from src.ttl_cache import TTLCache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 4096))
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    id: int
+    name: str | None
+    strava_id: str | None
+    spotify_id: str | None
+    created_at: datetime | None
+
+    @classmethod
+    def from_row(cls, user: User) -> "CurrentUser":
+        return cls(
+            id=user.id,
+            name=user.name,
+            strava_id=user.strava_id,
+            spotify_id=user.spotify_id,
+            created_at=user.created_at,
+        )
+
+
+# JWT -> the user id it names, until the token expires.
+decoded_tokens: TTLCache[int] = TTLCache(max_entries=USER_CACHE_MAX_ENTRIES)
+users: TTLCache[CurrentUser] = TTLCache(max_entries=USER_CACHE_MAX_ENTRIES)
+
+
+class _NoSuchUser(Exception):
+    pass
+
+
+def get_user(db: Session, user_id: int) -> CurrentUser | None:
+    """The user with this id, from the cache if we have them."""
+
+    def load():
+        # Imported here: src.credentials builds on this module.
+        from src.credentials import load_credentials
+
+        # Their tokens come with them, and are cached for the request's next steps.
+        credentials = load_credentials(db, user_id)
+        if credentials is None:
+            # Not cached: a missing user is an error path, not a hot one.
+            raise _NoSuchUser
+        return credentials.user, time.time() + USER_CACHE_TTL_SECONDS
+
+    try:
+        return users.get_or_load(user_id, load)
+    except _NoSuchUser:
+        return None
+
+
+async def get_user_async(db: "AsyncSession", user_id: int) -> CurrentUser | None:
+    """get_user, on an AsyncSession.
+
+    Concurrent misses for the same user each run the query: the cache's
+    per-key lock is a thread lock, and can't be held across an await.
+    """
+    from src.credentials import load_credentials_async
+
+    user = users.get(user_id)
+    if user is None:
+        credentials = await load_credentials_async(db, user_id)
+        user = credentials.user if credentials else None
+    return user
+
+
+def invalidate_user(user_id: int) -> None:
+    users.invalidate(user_id)
@@ -0,0 +1,99 @@
+"""Worker process for the job queue in src/jobs.py.
+
+    python -m src.worker --concurrency 4
+
+Runs `concurrency` jobs at a time, each on its own thread with its own
+Session, polling for more whenever one finishes. Start as many processes as
+the load needs: claiming is SKIP LOCKED, so they never hand out the same job.
+SIGTERM and SIGINT stop claiming and let the jobs in hand finish.
+"""
+
+import argparse
+import importlib
+import logging
+import signal
+import threading
+from datetime import timedelta
+from typing import List
+
+from src.db import SessionLocal
+from src.jobs import DEFAULT_VISIBILITY_TIMEOUT, claim, run
+
+# Imported for their @job_handler registrations.
+HANDLER_MODULES = ["src.strava_webook"]
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_POLL_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def work(stop: threading.Event, poll_interval: float, visibility_timeout) -> None:
+    """Claim and run jobs one at a time until `stop` is set."""
+    db = SessionLocal()
+    try:
+        while not stop.is_set():
+            try:
+                jobs = claim(db, limit=1, visibility_timeout=visibility_timeout)
+            except Exception:
+                logger.exception("Claiming a job failed")
+                db.rollback()
+                jobs = []
+            if not jobs:
+                stop.wait(poll_interval)
+                continue
+            for job in jobs:
+                try:
+                    run(db, job)
+                except Exception:
+                    # Recording the outcome failed; the lease will lapse and
+                    # the job be retried. This thread carries on.
+                    logger.exception("Recording job %s's outcome failed", job.id)
+                    db.rollback()
+    finally:
+        db.close()
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="seconds an idle thread waits before looking for work again",
+    )
+    parser.add_argument(
+        "--visibility-timeout",
+        type=float,
+        default=DEFAULT_VISIBILITY_TIMEOUT.total_seconds(),
+        help="seconds a claimed job stays leased before another worker may retry it",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    visibility_timeout = timedelta(seconds=args.visibility_timeout)
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(stop, args.poll_interval, visibility_timeout),
+            name=f"worker-{i}",
+        )
+        for i in range(args.concurrency)
+    ]
+    logger.info("Running %d jobs at a time", args.concurrency)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Fixtures shared across test modules."""
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def postgres():
+    """An engine on an empty schema in a real Postgres, for SQL only it runs.
+
+    Skipped unless TEST_DATABASE_URL is set, e.g. to the docker-compose
+    database. Every table in it is dropped, before and after each test.
+    """
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from sqlalchemy import create_engine
+
+    from src.db import Base
+
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        yield engine
+    finally:
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+@pytest.fixture
+def serve_async(monkeypatch):
+    """Answer the async provider client's requests in-process, for this test.
+
+    `serve_async(handler)` routes every async client built from then on to
+    `handler`, an httpx MockTransport handler (sync or async). No sockets.
+    """
+    import httpx
+
+    from src import http_client
+
+    build = http_client._build_async_client
+
+    def serve(handler):
+        def build_with_transport():
+            client = build()
+            client._transport = httpx.MockTransport(handler)
+            return client
+
+        monkeypatch.setattr(http_client, "_build_async_client", build_with_transport)
+
+    return serve
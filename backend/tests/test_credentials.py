@@ -0,0 +1,119 @@
+"""Tests for loading a user and their tokens in one query.
+
+Against a real database (SQLite in memory) rather than a mock, so that what's
+counted is the statements actually sent.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    from src.token_cache import token_cache
+    from src.user_cache import decoded_tokens, users
+
+    for cache in (token_cache, users, decoded_tokens):
+        cache.clear()
+    yield
+    for cache in (token_cache, users, decoded_tokens):
+        cache.clear()
+
+
+@pytest.fixture
+def db():
+    from src.db import Base, Token, User
+
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(engine)
+    later = datetime.now() + timedelta(hours=1)
+    with Session(engine) as setup:
+        setup.add(User(id=1, name="Runner", spotify_id="sp", strava_id="st"))
+        setup.add_all(
+            [
+                Token(user_id=1, provider="spotify", access_token="spotify-token", expires_at=later),
+                Token(user_id=1, provider="strava", access_token="strava-token", expires_at=later),
+            ]
+        )
+        setup.commit()
+
+    session = Session(engine)
+    session.statements = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: session.statements.append(statement),
+    )
+    yield session
+    session.close()
+
+
+def enhancement_credentials(db, jwt):
+    """What POST /api/latest reads before its first provider call."""
+    from src.auth import get_current_user
+    from src.spotify import get_spotify_access_token_from_db
+    from src.strava import get_strava_access_token_from_db
+
+    user = get_current_user(jwt, db)
+    return (
+        user,
+        get_strava_access_token_from_db(user.id, db),
+        get_spotify_access_token_from_db(user.id, db),
+        # The write-back reuses the Strava token.
+        get_strava_access_token_from_db(user.id, db),
+    )
+
+
+@pytest.fixture
+def jwt(monkeypatch):
+    from src import auth
+
+    monkeypatch.setattr(auth, "SECRET_KEY", "a-test-secret-at-least-32-bytes-long")
+    return auth.create_access_token(1)
+
+
+def test_a_cold_request_reads_the_user_and_both_tokens_in_one_query(db, jwt):
+    user, strava, spotify, strava_again = enhancement_credentials(db, jwt)
+    assert user.spotify_id == "sp"
+    assert (strava, spotify, strava_again) == ("strava-token", "spotify-token", "strava-token")
+    assert len(db.statements) == 1
+    assert "JOIN tokens" in db.statements[0]
+
+
+def test_a_warm_request_reads_nothing(db, jwt):
+    enhancement_credentials(db, jwt)
+    db.statements.clear()
+    enhancement_credentials(db, jwt)
+    assert db.statements == []
+
+
+def test_tokens_missing_from_the_cache_are_read_together(db, jwt):
+    from src.token_cache import token_cache
+
+    enhancement_credentials(db, jwt)
+    token_cache.clear()
+    db.statements.clear()
+    enhancement_credentials(db, jwt)
+    assert len(db.statements) == 1
+
+
+def test_credentials_are_frozen_and_carry_what_was_read(db):
+    from dataclasses import FrozenInstanceError
+
+    from src.credentials import load_credentials
+
+    credentials = load_credentials(db, 1)
+    assert credentials.user.name == "Runner"
+    assert credentials.token("strava").access_token == "strava-token"
+    assert credentials.token("spotify").expires_at > datetime.now().timestamp()
+    with pytest.raises(FrozenInstanceError):
+        credentials.strava = None
+    with pytest.raises(ValueError):
+        credentials.token("deezer")
+    assert load_credentials(db, 2) is None
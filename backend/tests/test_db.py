@@ -0,0 +1,163 @@
+"""Importing the app must not touch the database.
+
+Run in a fresh interpreter, since by now this one has imported everything.
+"""
+
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+
+CHECK = """
+import sys
+sys.path[:0] = ["src", "."]
+import app
+from src import db
+assert db._engine is None, "importing the app built the engine"
+assert db._async_engine is None, "importing the app built the async engine"
+assert "asyncpg" not in sys.modules and "greenlet" not in sys.modules
+try:
+    db.SessionLocal()
+except RuntimeError as e:
+    assert "DATABASE_URL" in str(e)
+else:
+    raise AssertionError("a session was handed out with no DATABASE_URL")
+"""
+
+
+def test_the_app_imports_without_a_database():
+    env = {key: value for key, value in os.environ.items() if key != "DATABASE_URL"}
+    # An empty value, so a developer's .env can't supply one either.
+    env["DATABASE_URL"] = ""
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK],
+        cwd=BACKEND,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+# --- pool modes ----------------------------------------------------------
+
+
+def test_the_pool_mode_defaults_to_external_on_vercel(monkeypatch):
+    from src import db
+
+    monkeypatch.delenv("DB_POOL_MODE", raising=False)
+    monkeypatch.delenv("VERCEL", raising=False)
+    assert db.pool_mode() == "pooled"
+    monkeypatch.setenv("VERCEL", "1")
+    assert db.pool_mode() == "external"
+    monkeypatch.setenv("DB_POOL_MODE", "pooled")
+    assert db.pool_mode() == "pooled"
+
+
+def test_an_unknown_pool_mode_is_refused(monkeypatch):
+    import pytest
+
+    from src import db
+
+    monkeypatch.setenv("DB_POOL_MODE", "pgbouncer")
+    with pytest.raises(RuntimeError, match="DB_POOL_MODE"):
+        db.pool_mode()
+
+
+def test_pooled_mode_keeps_and_pings_connections(monkeypatch):
+    from src import db
+
+    monkeypatch.setenv("DB_POOL_SIZE", "2")
+    options = db.engine_options("postgresql://h/rebeat", "pooled")
+    assert options["poolclass"] is db.TimedQueuePool
+    assert (options["pool_size"], options["max_overflow"]) == (2, 5)
+    assert options["pool_pre_ping"] is True
+
+
+def test_external_mode_keeps_nothing_and_prepares_nothing():
+    from src import db
+
+    for url, connect_args in [
+        ("postgresql+psycopg2://h/rebeat", {}),
+        ("postgresql+psycopg://h/rebeat", {"prepare_threshold": None}),
+        (
+            "postgresql+asyncpg://h/rebeat",
+            {"statement_cache_size": 0, "prepared_statement_cache_size": 0},
+        ),
+    ]:
+        options = db.engine_options(url, "external")
+        assert options == {"poolclass": db.TimedNullPool, "connect_args": connect_args}
+
+
+def test_connections_and_checkouts_are_counted():
+    from sqlalchemy import create_engine, text
+
+    from src import db, metrics
+
+    engine = create_engine("sqlite://", poolclass=db.TimedNullPool)
+    metrics.instrument_engine(engine)
+    checkouts = metrics.db_checkout_seconds.count(mode="external")
+    opened = metrics.db_connections_opened_total.value(mode="external")
+    closed = metrics.db_connections_closed_total.value(mode="external")
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            assert metrics.db_connections_checked_out.value(mode="external") == 1
+    assert metrics.db_checkout_seconds.count(mode="external") == checkouts + 3
+    assert metrics.db_connections_opened_total.value(mode="external") == opened + 3
+    assert metrics.db_connections_closed_total.value(mode="external") == closed + 3
+    assert metrics.db_connections_checked_out.value(mode="external") == 0
+
+
+# --- async engine ----------------------------------------------------------
+
+
+def test_the_async_engine_speaks_asyncpg_to_the_same_database():
+    from src import db
+
+    url = db.async_database_url(
+        "postgresql://u:p@ep-x-pooler.neon.tech/neondb?sslmode=require&channel_binding=require"
+    )
+    assert url == "postgresql+asyncpg://u:p@ep-x-pooler.neon.tech/neondb?ssl=require"
+    options = db.engine_options(url, "pooled")
+    assert options["poolclass"] is db.TimedAsyncQueuePool
+
+
+def test_the_async_engine_is_built_once_and_instrumented(monkeypatch):
+    from src import config, db
+
+    monkeypatch.setattr(config, "DATABASE_URL", "postgresql://u:p@h/rebeat")
+    monkeypatch.setenv("DB_POOL_MODE", "external")
+    monkeypatch.setattr(db, "_engine", None)
+    monkeypatch.setattr(db, "_async_engine", None)
+    monkeypatch.setattr(db, "_async_session_factory", None)
+    engine = db.get_async_engine()
+    try:
+        assert db.get_async_engine() is engine
+        # Only the pool that's asked for: no sync engine on the side.
+        assert db._engine is None
+        assert engine.dialect.driver == "asyncpg"
+        assert isinstance(engine.pool, db.TimedNullPool)
+        session = db.AsyncSessionLocal()
+        assert session.bind is engine
+        assert session.sync_session.expire_on_commit is False
+    finally:
+        engine.sync_engine.dispose()
+
+
+def test_no_route_checks_out_from_both_pools():
+    import app
+    from src.db import get_async_db, get_db
+
+    def dependencies(dependant):
+        for sub in dependant.dependencies:
+            yield sub.call
+            yield from dependencies(sub)
+
+    for route in app.app.routes:
+        dependant = getattr(route, "dependant", None)
+        if dependant is None:
+            continue
+        calls = set(dependencies(dependant))
+        assert not {get_db, get_async_db} <= calls, route.path
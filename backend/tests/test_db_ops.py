@@ -0,0 +1,220 @@
+"""Tests for storing tokens and finding users.
+
+Both are single Postgres statements. Most tests check what they say, with the
+Session replaced; those taking `postgres` run them against a real database.
+"""
+
+from datetime import datetime
+from unittest import mock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+
+@pytest.fixture(scope="module")
+def db_ops():
+    from src import db_ops
+
+    return db_ops
+
+
+def sql(statement) -> str:
+    return " ".join(str(statement.compile(dialect=postgresql.dialect())).split())
+
+
+def stored(db, **columns):
+    from src.db import Token
+
+    token = Token(**columns)
+    db.scalars.return_value.one.return_value = token
+    return token
+
+
+def test_storing_a_token_is_one_upsert_on_user_and_provider(db_ops):
+    db = mock.Mock()
+    expires_at = datetime(2030, 1, 1)
+    token = stored(db, user_id=1, provider="spotify", access_token="a", expires_at=expires_at)
+
+    with mock.patch.object(db_ops, "token_cache") as cache:
+        result = db_ops.store_token(db, 1, "spotify", "a", "r", expires_at)
+
+    assert result is token
+    db.scalars.assert_called_once()
+    statement = sql(db.scalars.call_args.args[0])
+    assert statement.startswith("INSERT INTO tokens")
+    assert "ON CONFLICT (user_id, provider) DO UPDATE" in statement
+    # A refresh that doesn't rotate the refresh token keeps the stored one.
+    assert "refresh_token = coalesce(excluded.refresh_token, tokens.refresh_token)" in statement
+    assert "RETURNING tokens.id" in statement
+    assert db.scalars.call_args.kwargs["execution_options"] == {"populate_existing": True}
+    # Detached before the commit, so reading it afterwards isn't a query.
+    assert db.method_calls.index(mock.call.expunge(token)) < db.method_calls.index(
+        mock.call.commit()
+    )
+    cache.put.assert_called_once_with((1, "spotify"), "a", expires_at.timestamp())
+
+
+def test_an_empty_refresh_token_keeps_the_stored_one(db_ops):
+    db = mock.Mock()
+    stored(db, user_id=1, provider="strava", access_token="a")
+    with mock.patch.object(db_ops, "token_cache"):
+        db_ops.store_token(db, 1, "strava", "a", refresh_token="")
+    params = db.scalars.call_args.args[0].compile(dialect=postgresql.dialect()).params
+    assert params["refresh_token"] is None
+
+
+def test_the_async_versions_send_the_same_statements(db_ops):
+    import asyncio
+
+    db = mock.AsyncMock()
+    db.expunge = mock.Mock()
+    token = stored(db, user_id=1, provider="strava", access_token="a")
+    db.scalars.return_value = mock.Mock(one=mock.Mock(return_value=token))
+    sync_db = mock.Mock()
+    stored(sync_db, user_id=1, provider="strava", access_token="a")
+
+    with mock.patch.object(db_ops, "token_cache") as cache:
+        assert asyncio.run(db_ops.store_token_async(db, 1, "strava", "a", "r")) is token
+        db_ops.store_token(sync_db, 1, "strava", "a", "r")
+    db.expunge.assert_called_once_with(token)
+    db.commit.assert_awaited_once()
+    assert cache.invalidate.call_count == 2  # no expiry: nothing to cache
+    assert sql(db.scalars.call_args.args[0]) == sql(sync_db.scalars.call_args.args[0])
+
+    user = asyncio.run(db_ops.find_or_create_user_async(db, "spotify", "sp1"))
+    assert user is db.scalars.return_value.first.return_value
+    db_ops.find_or_create_user(sync_db, "spotify", "sp1")
+    assert sql(db.scalars.call_args.args[0]) == sql(sync_db.scalars.call_args.args[0])
+
+
+def test_tokens_are_unique_per_user_and_provider():
+    from src.db import Token
+
+    (index,) = [i for i in Token.__table__.indexes if i.name == "uq_token_user_provider"]
+    assert index.unique
+    assert [c.name for c in index.columns] == ["user_id", "provider"]
+
+
+def test_finding_a_user_is_one_statement_and_doesnt_commit(db_ops):
+    db = mock.Mock()
+    user = db_ops.find_or_create_user(db, "spotify", "sp1")
+
+    assert user is db.scalars.return_value.first.return_value
+    db.scalars.assert_called_once()
+    db.commit.assert_not_called()
+    statement = sql(db.scalars.call_args.args[0])
+    assert statement.startswith("WITH existing AS")
+    assert "WHERE users.spotify_id = " in statement
+    assert "linked AS" not in statement
+    assert "INSERT INTO users (spotify_id, created_at) SELECT" in statement
+    assert "ON CONFLICT (spotify_id) DO UPDATE" in statement
+
+
+def test_a_jwt_links_the_provider_to_its_user(db_ops):
+    db = mock.Mock()
+    with mock.patch.object(db_ops, "verify_token", return_value=7):
+        db_ops.find_or_create_user(db, "strava", "st1", rebeat_jwt="jwt")
+
+    db.scalars.assert_called_once()
+    statement = sql(db.scalars.call_args.args[0])
+    # Only a user not yet linked to Strava, and only if nobody else has the ID.
+    assert "linked AS (UPDATE users SET strava_id=" in statement
+    assert "users.strava_id IS NULL AND NOT (EXISTS (SELECT existing.id" in statement
+    # Otherwise the JWT's user is kept as they are...
+    assert "kept AS (SELECT users.id" in statement
+    # ...and a user is created only when there's none of the above.
+    assert "NOT (EXISTS (SELECT linked.id FROM linked))" in statement
+    assert "NOT (EXISTS (SELECT kept.id FROM kept))" in statement
+
+
+def test_an_invalid_jwt_is_ignored(db_ops):
+    db = mock.Mock()
+    with mock.patch.object(db_ops, "verify_token", return_value=None):
+        db_ops.find_or_create_user(db, "strava", "st1", rebeat_jwt="bad")
+    assert "linked AS" not in sql(db.scalars.call_args.args[0])
+
+
+# --- against Postgres ----------------------------------------------------
+
+
+@pytest.fixture
+def session(postgres):
+    from sqlalchemy.orm import Session
+
+    with Session(postgres) as session:
+        yield session
+
+
+def signed_in(db_ops, session, provider, provider_id, jwt_user_id=None):
+    with mock.patch.object(db_ops, "verify_token", return_value=jwt_user_id):
+        user = db_ops.find_or_create_user(
+            session, provider, provider_id, rebeat_jwt="jwt" if jwt_user_id else None
+        )
+    session.commit()
+    return user
+
+
+def all_users(session):
+    from src.db import User
+
+    return session.query(User.id, User.spotify_id, User.strava_id).order_by(User.id).all()
+
+
+def test_a_new_provider_id_makes_a_user_and_signing_in_again_finds_them(db_ops, session):
+    first = signed_in(db_ops, session, "spotify", "sp1")
+    again = signed_in(db_ops, session, "spotify", "sp1")
+    assert again.id == first.id
+    assert all_users(session) == [(first.id, "sp1", None)]
+
+
+def test_a_jwt_user_without_the_provider_is_linked_to_it(db_ops, session):
+    user = signed_in(db_ops, session, "spotify", "sp1")
+    linked = signed_in(db_ops, session, "strava", "st1", jwt_user_id=user.id)
+    assert linked.id == user.id
+    assert all_users(session) == [(user.id, "sp1", "st1")]
+
+
+def test_a_jwt_user_linked_to_another_account_is_returned_unchanged(db_ops, session):
+    user = signed_in(db_ops, session, "spotify", "sp1")
+    signed_in(db_ops, session, "strava", "st1", jwt_user_id=user.id)
+    kept = signed_in(db_ops, session, "strava", "st2", jwt_user_id=user.id)
+    assert kept.id == user.id
+    assert kept.strava_id == "st1"
+    assert all_users(session) == [(user.id, "sp1", "st1")]
+
+
+def test_the_provider_ids_owner_wins_over_the_jwt(db_ops, session):
+    owner = signed_in(db_ops, session, "strava", "st1")
+    other = signed_in(db_ops, session, "spotify", "sp1")
+    found = signed_in(db_ops, session, "strava", "st1", jwt_user_id=other.id)
+    assert found.id == owner.id
+    assert all_users(session) == [(owner.id, None, "st1"), (other.id, "sp1", None)]
+
+
+def test_a_jwt_naming_nobody_makes_a_new_user(db_ops, session):
+    user = signed_in(db_ops, session, "strava", "st1", jwt_user_id=999)
+    assert all_users(session) == [(user.id, None, "st1")]
+
+
+def test_a_stored_token_keeps_its_refresh_token_when_none_comes_back(db_ops, session):
+    user = signed_in(db_ops, session, "spotify", "sp1")
+    with mock.patch.object(db_ops, "token_cache"):
+        db_ops.store_token(session, user.id, "spotify", "a1", "r1", datetime(2030, 1, 1))
+        token = db_ops.store_token(session, user.id, "spotify", "a2")
+    assert (token.access_token, token.refresh_token) == ("a2", "r1")
+    assert token.expires_at == datetime(2030, 1, 1)
+
+
+def test_duplicate_tokens_are_only_cleared_before_the_index_exists():
+    from src import db
+
+    engine = mock.MagicMock()
+    with mock.patch.object(db, "inspect") as inspect:
+        inspect.return_value.has_index.return_value = True
+        db._dedupe_tokens(engine)
+        engine.begin.assert_not_called()
+
+        inspect.return_value.has_index.return_value = False
+        db._dedupe_tokens(engine)
+    conn = engine.begin.return_value.__enter__.return_value
+    assert "DELETE FROM tokens" in str(conn.execute.call_args.args[0])
@@ -0,0 +1,88 @@
+"""Tests for the enhanced_activities claim.
+
+The claim is a single Postgres statement; these check what it says and how
+its outcome is read, with the Session replaced.
+"""
+
+from unittest import mock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+
+@pytest.fixture(scope="module")
+def enhanced():
+    from src import enhanced_activities
+
+    return enhanced_activities
+
+
+def sql(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect())).replace("\n", " ")
+
+
+def test_claiming_is_one_conditional_upsert(enhanced):
+    db = mock.Mock()
+    db.execute.return_value.first.return_value = ("pending", None, None)
+
+    won, enhancement = enhanced.claim(db, user_id=1, activity_id=42)
+
+    assert won is True
+    assert enhancement == enhanced.Enhancement(42, "pending")
+    statement = sql(db.execute.call_args_list[0].args[0])
+    assert "ON CONFLICT (user_id, strava_activity_id) DO UPDATE" in statement
+    # Only a failed row, or one whose claimant's lease lapsed, is taken over.
+    assert "WHERE enhanced_activities.status = " in statement
+    assert "enhanced_activities.claimed_until < " in statement
+    assert "RETURNING" in statement
+    db.commit.assert_called_once()
+
+
+def test_a_lost_claim_reports_the_row_as_it_stands(enhanced):
+    db = mock.Mock()
+    db.execute.return_value.first.return_value = None
+    db.execute.return_value.one.return_value = ("done", "p1", "https://x/p1")
+
+    won, enhancement = enhanced.claim(db, user_id=1, activity_id=42)
+
+    assert won is False
+    assert enhancement.status == "done"
+    assert enhancement.result == {"id": 42, "status": "done", "playlist_url": "https://x/p1"}
+
+
+def test_lookup_is_one_query_for_any_number_of_activities(enhanced):
+    db = mock.Mock()
+    db.execute.return_value.all.return_value = [
+        (1, "done", "p", "u")
+    ]
+    found = enhanced.lookup(db, user_id=7, activity_ids=range(1, 101))
+    assert list(found) == [1]
+    db.execute.assert_called_once()
+    assert "strava_activity_id IN" in sql(db.execute.call_args.args[0])
+
+
+def test_lookup_of_nothing_asks_nothing(enhanced):
+    db = mock.Mock()
+    assert enhanced.lookup(db, user_id=7, activity_ids=[]) == {}
+    db.execute.assert_not_called()
+
+
+def test_the_lookup_index_covers_what_lookup_reads(enhanced):
+    from src.db import EnhancedActivity
+
+    (index,) = EnhancedActivity.__table__.indexes
+    assert index.unique
+    assert [c.name for c in index.columns] == ["user_id", "strava_activity_id"]
+    assert index.dialect_options["postgresql"]["include"] == [
+        "status",
+        "playlist_id",
+        "playlist_url",
+    ]
+
+
+def test_a_playlist_is_recorded_by_its_id_and_url(enhanced):
+    db = mock.Mock()
+    enhanced.record_playlist(db, 1, 42, "https://open.spotify.com/playlist/abc123")
+    params = db.execute.call_args.args[0].compile().params
+    assert params["playlist_id"] == "abc123"
+    assert params["playlist_url"] == "https://open.spotify.com/playlist/abc123"
@@ -0,0 +1,188 @@
+"""Tests for the history archive's polling schedule and coverage bookkeeping,
+and for the poller carrying on past one user's failure.
+
+The insert itself is Postgres-specific and replaced here; what matters is which
+plays count as new, what the archive then claims to cover, and when the next
+poll is due.
+"""
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from listening_history import HISTORY_CAPACITY
+from time_utils import iso_to_unix
+
+
+@pytest.fixture(scope="module")
+def archive():
+    from src import history_archive
+
+    return history_archive
+
+
+def plays(count, oldest_ms=iso_to_unix("2026-08-19T06:00:00Z"), gap_ms=3 * 60_000):
+    """A newest-first recently-played response."""
+    from datetime import timezone
+
+    items = [
+        {
+            "played_at": datetime.fromtimestamp(
+                (oldest_ms + i * gap_ms) / 1000, timezone.utc
+            ).isoformat(),
+            "track": {"id": f"t{i}"},
+        }
+        for i in range(count)
+    ]
+    return list(reversed(items))
+
+
+def state(**fields):
+    defaults = dict(
+        user_id=1,
+        cursor_ms=None,
+        covered_since_ms=None,
+        plays_per_hour=0.0,
+        last_polled_at=None,
+        next_poll_at=None,
+    )
+    return SimpleNamespace(**{**defaults, **fields})
+
+
+def record(archive, st, items):
+    db = mock.Mock()
+    with mock.patch.object(archive, "insert") as insert:
+        new = archive.record_poll(db, st, items)
+    rows = insert.return_value.values.call_args.args[0] if new else []
+    return new, rows
+
+
+# --- schedule ------------------------------------------------------------
+
+
+def test_heavy_listeners_are_polled_before_the_buffer_wraps(archive):
+    # 20 plays an hour fills half the buffer in 1.25 hours.
+    assert archive.next_poll_interval(20) == timedelta(hours=1.25)
+
+
+@pytest.mark.parametrize(
+    "rate,expected",
+    [
+        (0, "MAX_POLL_INTERVAL"),
+        (0.01, "MAX_POLL_INTERVAL"),
+        (10_000, "MIN_POLL_INTERVAL"),
+    ],
+)
+def test_poll_interval_is_clamped(archive, rate, expected):
+    assert archive.next_poll_interval(rate) == getattr(archive, expected)
+
+
+def test_first_poll_estimates_the_rate_from_the_buffer_span(archive):
+    items = plays(21, gap_ms=3 * 60_000)  # 20 gaps over an hour
+    new, _ = record(archive, state(), items)
+    assert new == 21
+    assert archive.observed_rate(
+        sorted((iso_to_unix(i["played_at"]), i["track"]["id"]) for i in items), 21, None
+    ) == pytest.approx(20)
+
+
+def test_rate_is_smoothed_across_polls(archive):
+    assert archive.smooth_rate(10, 20, first=False) == pytest.approx(13)
+    assert archive.smooth_rate(10, 20, first=True) == 20
+
+
+# --- coverage ------------------------------------------------------------
+
+
+def test_a_first_poll_of_a_partial_buffer_covers_everything(archive):
+    st = state()
+    new, rows = record(archive, st, plays(10))
+    assert st.covered_since_ms == 0
+    assert st.cursor_ms == max(row["played_at"] for row in rows)
+    assert st.next_poll_at > datetime.now()
+
+
+def test_a_first_poll_of_a_full_buffer_covers_from_its_oldest_play(archive):
+    st = state()
+    items = plays(HISTORY_CAPACITY)
+    record(archive, st, items)
+    assert st.covered_since_ms == iso_to_unix(items[-1]["played_at"])
+
+
+def test_only_plays_after_the_cursor_are_archived(archive):
+    items = plays(10)
+    cursor = iso_to_unix(items[3]["played_at"])  # newest-first: 3 are newer
+    st = state(cursor_ms=cursor, covered_since_ms=0, last_polled_at=datetime.now())
+    new, rows = record(archive, st, items)
+    assert new == 3
+    assert all(row["played_at"] > cursor for row in rows)
+    assert st.covered_since_ms == 0
+
+
+def test_a_full_turnover_restarts_coverage(archive):
+    """Fifty plays, all new: anything between the old cursor and these is lost."""
+    items = plays(HISTORY_CAPACITY, oldest_ms=iso_to_unix("2026-08-20T06:00:00Z"))
+    st = state(
+        cursor_ms=iso_to_unix("2026-08-19T06:00:00Z"),
+        covered_since_ms=0,
+        last_polled_at=datetime.now() - timedelta(hours=12),
+    )
+    record(archive, st, items)
+    assert st.covered_since_ms == iso_to_unix(items[-1]["played_at"])
+
+
+def test_an_empty_poll_backs_off(archive):
+    st = state(
+        cursor_ms=1,
+        covered_since_ms=0,
+        plays_per_hour=0.5,
+        last_polled_at=datetime.now() - timedelta(hours=6),
+    )
+    new, _ = record(archive, st, [])
+    assert new == 0
+    assert st.cursor_ms == 1
+    assert st.plays_per_hour < 0.5
+
+
+# --- poller --------------------------------------------------------------
+
+
+def test_one_users_failure_doesnt_spoil_the_run_for_the_rest():
+    from src import history_poller
+
+    db = mock.MagicMock()
+    states = [state(user_id=1), state(user_id=2), state(user_id=3)]
+
+    def token(user_id, db):
+        if user_id == 1:
+            raise RuntimeError("refresh failed")
+        return f"token-{user_id}"
+
+    def record_poll(db, st, items):
+        if st.user_id == 2:
+            raise RuntimeError("insert failed")
+        return len(items)
+
+    with mock.patch.object(history_poller, "enroll_connected_users"), mock.patch.object(
+        history_poller, "claim_due", side_effect=[states, []]
+    ), mock.patch.object(
+        history_poller, "get_spotify_access_token_from_db", side_effect=token
+    ), mock.patch.object(
+        history_poller, "get_recently_played", return_value=plays(2)
+    ), mock.patch.object(
+        history_poller, "record_poll", side_effect=record_poll
+    ):
+        result = history_poller.poll_due(db, concurrency=1)
+
+    assert (result.polled, result.new_plays, result.failed) == (1, 2, 2)
+    # The failed lookup is rolled back before anyone else uses the session,
+    # and each user's archive step is a savepoint of its own.
+    assert db.method_calls[0] == mock.call.rollback()
+    assert db.begin_nested.call_count == 2
+    savepoint = db.begin_nested.return_value.__exit__
+    assert savepoint.call_args_list[0].args[0] is RuntimeError
+    assert savepoint.call_args_list[1].args[0] is None
+    assert states[0].next_poll_at and states[1].next_poll_at
+    db.commit.assert_called_once()
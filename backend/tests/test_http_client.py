@@ -0,0 +1,290 @@
+"""Tests for the shared provider HTTP client.
+
+No sockets are opened: the session's `request` is replaced, and what matters
+is what it is called with and that the same pooled session keeps being used.
+"""
+
+from unittest import mock
+
+import pytest
+
+from src import http_client, metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch):
+    for name in (
+        "HTTP_POOL_CONNECTIONS",
+        "HTTP_POOL_MAXSIZE",
+        "HTTP_CONNECT_TIMEOUT",
+        "HTTP_READ_TIMEOUT",
+        "HTTP_MAX_RETRIES",
+        "HTTP_MAX_RETRY_AFTER",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    http_client.reset_session()
+    yield
+    http_client.reset_session()
+
+
+def test_the_session_is_reused_across_calls():
+    """One session means one pool, which is the whole point."""
+    assert http_client.get_session() is http_client.get_session()
+
+
+def test_pool_sizes_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("HTTP_POOL_CONNECTIONS", "3")
+    monkeypatch.setenv("HTTP_POOL_MAXSIZE", "25")
+    adapter = http_client.get_session().get_adapter("https://api.spotify.com")
+    assert adapter._pool_connections == 3
+    assert adapter._pool_maxsize == 25
+
+
+def test_plain_http_is_pooled_too():
+    """Local provider stand-ins are served over http."""
+    session = http_client.get_session()
+    assert session.get_adapter("http://localhost") is session.get_adapter(
+        "https://www.strava.com"
+    )
+
+
+def test_every_call_gets_a_connect_and_read_timeout(monkeypatch):
+    monkeypatch.setenv("HTTP_CONNECT_TIMEOUT", "1.5")
+    monkeypatch.setenv("HTTP_READ_TIMEOUT", "7")
+    session = http_client.get_session()
+    with mock.patch.object(session, "request", return_value=reply(200)) as request:
+        http_client.get("https://api.spotify.com/v1/me")
+    request.assert_called_once_with(
+        "GET", "https://api.spotify.com/v1/me", timeout=(1.5, 7.0)
+    )
+
+
+def test_an_explicit_timeout_wins():
+    session = http_client.get_session()
+    with mock.patch.object(session, "request", return_value=reply(200)) as request:
+        http_client.put("https://www.strava.com/api/v3/activities/1", timeout=30)
+    assert request.call_args.kwargs["timeout"] == 30
+
+
+@pytest.mark.parametrize("verb", ["get", "post", "put"])
+def test_verbs_map_to_methods(verb):
+    session = http_client.get_session()
+    with mock.patch.object(session, "request", return_value=reply(200)) as request:
+        getattr(http_client, verb)("https://example.test", data={"a": 1})
+    assert request.call_args.args == (verb.upper(), "https://example.test")
+    assert request.call_args.kwargs["data"] == {"a": 1}
+
+
+# --- retries -------------------------------------------------------------
+
+
+def reply(status, headers=None):
+    response = mock.Mock()
+    response.status_code = status
+    response.headers = headers or {}
+    return response
+
+
+@pytest.fixture
+def sleeps():
+    with mock.patch.object(http_client.time, "sleep") as sleep:
+        yield sleep
+
+
+def send(responses, method="GET", **kwargs):
+    session = http_client.get_session()
+    with mock.patch.object(session, "request", side_effect=responses) as request:
+        result = http_client.request(method, "https://api.spotify.com/v1/x", **kwargs)
+    return result, request.call_count
+
+
+def test_each_call_is_timed_under_its_name(sleeps):
+    seconds = metrics.provider_request_seconds
+    errors = metrics.provider_errors_total
+    labels = dict(provider="spotify", call="probe")
+    before = seconds.count(**labels, status="502")
+    failed_before = errors.value(**labels, reason="5xx")
+    send([reply(503), reply(502), reply(502), reply(502)], name="spotify.probe")
+    # Once for the call, not once per attempt.
+    assert seconds.count(**labels, status="502") == before + 1
+    assert errors.value(**labels, reason="5xx") == failed_before + 1
+
+
+def test_a_call_that_raises_is_counted_as_an_error(sleeps):
+    import requests
+
+    errors = metrics.provider_errors_total
+    labels = dict(provider="spotify", call="probe", reason="ConnectionError")
+    before = errors.value(**labels)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        send([requests.exceptions.ConnectionError()], method="POST", name="spotify.probe")
+    assert errors.value(**labels) == before + 1
+
+
+def test_429_waits_out_retry_after_and_retries(sleeps):
+    before = http_client.retry_counts().get(("api.spotify.com", "rate_limited"), 0)
+    result, calls = send([reply(429, {"Retry-After": "2"}), reply(200)])
+    assert result.status_code == 200
+    assert calls == 2
+    sleeps.assert_called_once_with(2.0)
+    after = http_client.retry_counts()[("api.spotify.com", "rate_limited")]
+    assert after == before + 1
+
+
+def test_429_is_retried_even_for_a_post(sleeps):
+    """Refused, not processed: sending it again can't create a duplicate."""
+    result, calls = send([reply(429, {"Retry-After": "1"}), reply(201)], method="POST")
+    assert result.status_code == 201
+    assert calls == 2
+
+
+def test_a_retry_after_too_long_to_wait_is_handed_back(sleeps):
+    result, calls = send([reply(429, {"Retry-After": "3600"})])
+    assert result.status_code == 429
+    assert calls == 1
+    sleeps.assert_not_called()
+
+
+def test_5xx_is_retried_for_idempotent_calls_with_backoff(sleeps):
+    result, calls = send([reply(503), reply(502), reply(200)])
+    assert result.status_code == 200
+    assert calls == 3
+    assert sleeps.call_count == 2
+
+
+def test_5xx_is_not_retried_for_a_post(sleeps):
+    """The playlist may have been created before the error; don't make two."""
+    result, calls = send([reply(500)], method="POST")
+    assert result.status_code == 500
+    assert calls == 1
+
+
+def test_a_post_can_opt_in_as_idempotent(sleeps):
+    result, calls = send([reply(500), reply(200)], method="POST", idempotent=True)
+    assert result.status_code == 200
+    assert calls == 2
+
+
+def test_gives_up_after_max_retries(sleeps):
+    result, calls = send([reply(503)] * (http_client.DEFAULT_MAX_RETRIES + 1))
+    assert result.status_code == 503
+    assert calls == http_client.DEFAULT_MAX_RETRIES + 1
+
+
+def test_read_timeouts_only_retry_idempotent_calls(sleeps):
+    import requests
+
+    result, calls = send([requests.exceptions.ReadTimeout(), reply(200)])
+    assert result.status_code == 200
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        send([requests.exceptions.ReadTimeout()], method="POST")
+
+
+def test_connect_timeouts_retry_anything(sleeps):
+    import requests
+
+    result, calls = send([requests.exceptions.ConnectTimeout(), reply(201)], method="POST")
+    assert result.status_code == 201
+
+
+def test_client_errors_are_returned_untouched(sleeps):
+    result, calls = send([reply(404)])
+    assert result.status_code == 404
+    assert calls == 1
+    sleeps.assert_not_called()
+
+
+def test_a_call_can_opt_out_of_retries(sleeps):
+    result, calls = send([reply(503), reply(200)], retries=0)
+    assert result.status_code == 503
+    assert calls == 1
+
+
+@pytest.mark.parametrize("attempt", [1, 2, 3, 10])
+def test_backoff_is_bounded(attempt):
+    ceiling = min(
+        http_client.BACKOFF_CAP_SECONDS,
+        http_client.BACKOFF_BASE_SECONDS * 2 ** (attempt - 1),
+    )
+    assert 0 <= http_client.backoff_seconds(attempt) <= ceiling
+
+
+# --- async client --------------------------------------------------------
+
+
+def test_the_async_client_has_timeouts_and_a_pool(monkeypatch):
+    import asyncio
+
+    monkeypatch.setenv("HTTP_CONNECT_TIMEOUT", "1.5")
+    monkeypatch.setenv("HTTP_READ_TIMEOUT", "7")
+
+    async def clients():
+        return http_client.get_async_client(), http_client.get_async_client()
+
+    first, second = asyncio.run(clients())
+    assert first is second
+    assert (first.timeout.connect, first.timeout.read) == (1.5, 7.0)
+    # Bound to the loop that built it, so another loop gets its own.
+    assert asyncio.run(clients())[0] is not first
+
+
+def test_a_loops_client_is_closed_when_the_loop_finishes(serve_async):
+    import asyncio
+
+    import httpx
+
+    serve_async(lambda request: httpx.Response(200))
+
+    async def used():
+        await http_client.get_async("https://api.spotify.com/v1/x", name="spotify.probe")
+        return http_client.get_async_client()
+
+    first = asyncio.run(used())
+    assert first.is_closed
+    second = asyncio.run(used())
+    assert second is not first and second.is_closed
+    assert http_client._async_clients == {}
+
+
+def test_the_apps_shutdown_closes_its_client():
+    import asyncio
+
+    async def shutdown():
+        client = http_client.get_async_client()
+        await http_client.close_async_client()
+        return client, dict(http_client._async_clients)
+
+    client, left = asyncio.run(shutdown())
+    assert client.is_closed
+    assert left == {}
+
+
+def test_async_calls_are_retried_and_timed_like_blocking_ones(serve_async):
+    import asyncio
+
+    import httpx
+
+    statuses = iter([503, 200])
+    seconds = metrics.provider_request_seconds
+    before = seconds.count(provider="spotify", call="probe", status="200")
+    serve_async(lambda request: httpx.Response(next(statuses)))
+    with mock.patch.object(http_client.asyncio, "sleep", mock.AsyncMock()) as sleep:
+        response = asyncio.run(
+            http_client.get_async("https://api.spotify.com/v1/x", name="spotify.probe")
+        )
+    assert response.status_code == 200
+    sleep.assert_awaited_once()
+    assert seconds.count(provider="spotify", call="probe", status="200") == before + 1
+
+
+def test_async_posts_are_not_retried_after_a_read_timeout(serve_async):
+    import asyncio
+
+    import httpx
+
+    def handler(request):
+        raise httpx.ReadTimeout("slow", request=request)
+
+    serve_async(handler)
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(http_client.post_async("https://accounts.spotify.com/api/token"))
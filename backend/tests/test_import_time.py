@@ -0,0 +1,53 @@
+"""`import app` has to stay cheap: on Vercel it's most of a cold start.
+
+Measured in a fresh interpreter, since this one has imported everything.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tomllib
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+
+# Only needed by some routes, or outside the serverless function altogether.
+LAZY_MODULES = ["dateutil", "requests", "uvicorn", "psycopg2"]
+
+MEASURE = """
+import json, sys, time
+sys.path[:0] = ["src", "."]
+started = time.perf_counter()
+import app
+elapsed_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({"ms": elapsed_ms, "modules": sorted(sys.modules)}))
+"""
+
+
+def budget_ms() -> float:
+    if os.getenv("IMPORT_BUDGET_MS"):
+        return float(os.environ["IMPORT_BUDGET_MS"])
+    with open(os.path.join(BACKEND, "pyproject.toml"), "rb") as f:
+        return tomllib.load(f)["tool"]["rebeat"]["import_budget_ms"]
+
+
+def import_app() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE],
+        cwd=BACKEND,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def test_import_app_stays_within_budget():
+    # Best of three, so one slow run on a busy machine doesn't fail the build.
+    fastest = min(import_app()["ms"] for _ in range(3))
+    assert fastest <= budget_ms(), f"import app took {fastest:.0f}ms"
+
+
+def test_route_specific_dependencies_are_not_imported_up_front():
+    modules = set(import_app()["modules"])
+    assert [name for name in LAZY_MODULES if name in modules] == []
@@ -0,0 +1,141 @@
+"""Tests for the job queue's retry policy and handler dispatch.
+
+Claiming is SQL that only means something against Postgres, so it's covered
+by the tests taking `postgres`; the rest is what happens to a job once it
+has been claimed, and the worker loop around it.
+"""
+
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def jobs():
+    from src import jobs
+
+    return jobs
+
+
+def claimed(jobs, kind="test", attempts=1, max_attempts=3):
+    return jobs.ClaimedJob(
+        id=7, kind=kind, payload={"x": 1}, attempts=attempts, max_attempts=max_attempts
+    )
+
+
+@pytest.mark.parametrize("attempts", [1, 2, 3, 4])
+def test_backoff_grows_and_stays_under_its_ceiling(jobs, attempts):
+    ceiling = jobs.BACKOFF_BASE_SECONDS * 2 ** (attempts - 1)
+    with mock.patch.object(jobs.random, "uniform", side_effect=lambda lo, hi: hi):
+        assert jobs.backoff_seconds(attempts) == ceiling
+
+
+def test_backoff_is_capped(jobs):
+    with mock.patch.object(jobs.random, "uniform", side_effect=lambda lo, hi: hi):
+        assert jobs.backoff_seconds(50) == jobs.BACKOFF_CAP_SECONDS
+
+
+def test_backoff_is_jittered(jobs):
+    delays = {jobs.backoff_seconds(3) for _ in range(20)}
+    assert len(delays) > 1
+    assert all(0 <= d <= jobs.BACKOFF_BASE_SECONDS * 4 for d in delays)
+
+
+def test_a_successful_handler_completes_the_job(jobs):
+    handler = mock.Mock()
+    db = mock.Mock()
+    job = claimed(jobs)
+    with mock.patch.dict(jobs.HANDLERS, {"test": handler}), mock.patch.object(
+        jobs, "complete"
+    ) as complete, mock.patch.object(jobs, "fail") as fail:
+        assert jobs.run(db, job) is True
+    handler.assert_called_once_with({"x": 1}, db)
+    complete.assert_called_once_with(db, job)
+    fail.assert_not_called()
+
+
+def test_a_raising_handler_fails_the_attempt(jobs):
+    db = mock.Mock()
+    job = claimed(jobs)
+    with mock.patch.dict(
+        jobs.HANDLERS, {"test": mock.Mock(side_effect=RuntimeError("boom"))}
+    ), mock.patch.object(jobs, "complete") as complete, mock.patch.object(
+        jobs, "fail"
+    ) as fail:
+        assert jobs.run(db, job) is False
+    db.rollback.assert_called_once()
+    fail.assert_called_once_with(db, job, "RuntimeError('boom')")
+    complete.assert_not_called()
+
+
+def test_an_unknown_kind_fails_rather_than_vanishing(jobs):
+    with mock.patch.object(jobs, "fail") as fail:
+        assert jobs.run(mock.Mock(), claimed(jobs, kind="nobody-handles-this")) is False
+    assert "nobody-handles-this" in fail.call_args.args[2]
+
+
+@pytest.mark.parametrize(
+    "attempts,status", [(1, "queued"), (2, "queued"), (3, "failed")]
+)
+def test_failures_requeue_until_attempts_run_out(jobs, attempts, status):
+    db = mock.Mock()
+    with mock.patch.object(jobs, "update") as update, mock.patch.object(jobs, "Job"):
+        jobs.fail(db, claimed(jobs, attempts=attempts, max_attempts=3), "err")
+    values = update.return_value.where.return_value.values.call_args.kwargs
+    assert values["status"] == status
+    assert ("run_after" in values) is (status == "queued")
+    db.commit.assert_called_once()
+
+
+def test_a_deferred_job_is_requeued_without_spending_an_attempt(jobs):
+    db = mock.Mock()
+    job = claimed(jobs)
+    until = jobs.datetime.now()
+    with mock.patch.dict(
+        jobs.HANDLERS,
+        {"test": mock.Mock(side_effect=jobs.Deferred(until, "not yet"))},
+    ), mock.patch.object(jobs, "defer") as defer, mock.patch.object(
+        jobs, "fail"
+    ) as fail:
+        assert jobs.run(db, job) is False
+    defer.assert_called_once_with(db, job, until, "not yet")
+    fail.assert_not_called()
+
+
+def test_a_worker_survives_failing_to_record_an_outcome(jobs):
+    from src import worker
+
+    stop = mock.Mock()
+    stop.is_set.side_effect = [False, False, True]
+    db = mock.Mock()
+    job = claimed(jobs)
+    run = mock.Mock(side_effect=[RuntimeError("db gone"), True])
+    with mock.patch.object(worker, "SessionLocal", return_value=db), mock.patch.object(
+        worker, "claim", return_value=[job]
+    ), mock.patch.object(worker, "run", run):
+        worker.work(stop, poll_interval=0, visibility_timeout=None)
+    assert run.call_count == 2
+    db.rollback.assert_called_once()
+    db.close.assert_called_once()
+
+
+def test_a_job_whose_lease_keeps_lapsing_runs_out_of_attempts(jobs, postgres):
+    from datetime import timedelta
+
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+
+    from src.db import Job
+
+    with Session(postgres) as db:
+        jobs.enqueue(db, "test", {}, max_attempts=2)
+        db.commit()
+        # Claimed, and the worker dies: a lease of no time at all lapses at once.
+        for attempt in (1, 2):
+            (job,) = jobs.claim(db, visibility_timeout=timedelta(seconds=-1))
+            assert job.attempts == attempt
+        assert jobs.claim(db) == []
+        row = db.execute(select(Job.status, Job.attempts, Job.last_error)).one()
+    assert row.status == "failed"
+    assert row.attempts == 2
+    assert "lapsed" in row.last_error
@@ -159,3 +159,137 @@ def test_is_playable_covers_every_status(status, playable):
     from listening_history import Selection
 
     assert Selection(status=status).is_playable is playable
+
+
+# --- with the history archive --------------------------------------------
+
+
+def archived(*plays, covered_since=0, cursor=None):
+    from listening_history import Archive
+
+    plays = [(iso_to_unix(iso), tid) for iso, tid in plays]
+    return Archive(
+        plays=plays,
+        covered_since_ms=covered_since,
+        cursor_ms=cursor if cursor is not None else max(ms for ms, _ in plays),
+    )
+
+
+def test_archive_sees_a_run_the_buffer_has_evicted():
+    """The case the archive exists for: the buffer has moved on, the archive hasn't."""
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T06:10:00Z", "during-1"),
+        ("2026-08-19T06:30:00Z", "during-2"),
+        ("2026-08-19T10:00:00Z", "track-0"),
+    )
+    result = select(items, archive=archive)
+    assert result.status is Status.OK
+    assert result.track_ids == ["during-1", "during-2"]
+
+
+def test_archive_and_buffer_overlap_without_duplicates():
+    items = [
+        play("2026-08-19T06:30:00Z", "during-2"),
+        play("2026-08-19T06:10:00Z", "during-1"),
+    ]
+    archive = archived(("2026-08-19T06:10:00Z", "during-1"))
+    assert select(items, archive=archive).track_ids == ["during-1", "during-2"]
+
+
+def test_silence_inside_archive_coverage_is_a_genuine_miss():
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T02:00:00Z", "long-before"),
+        ("2026-08-19T10:00:00Z", "track-0"),
+    )
+    assert select(items, archive=archive).status is Status.NO_SONGS_PLAYED
+
+
+def test_run_before_archive_coverage_still_refuses_to_guess():
+    covered_since = iso_to_unix("2026-08-19T08:00:00Z")
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T10:00:00Z", "track-0"), covered_since=covered_since
+    )
+    result = select(items, archive=archive)
+    assert result.status is Status.HORIZON_EXCEEDED
+    assert result.horizon_ms == covered_since
+
+
+def test_a_gap_between_archive_and_buffer_is_not_papered_over():
+    """The archive stopped at 07:00 and the buffer starts at 10:00: a run in
+    between could have had plays nobody saw."""
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T05:00:00Z", "early"), cursor=iso_to_unix("2026-08-19T07:00:00Z")
+    )
+    result = select(
+        items, start="2026-08-19T08:00:00Z", end="2026-08-19T08:30:00Z", archive=archive
+    )
+    assert result.status is Status.HORIZON_EXCEEDED
+    assert result.horizon_ms == iso_to_unix("2026-08-19T10:00:00Z")
+
+
+def test_a_run_inside_the_archive_is_seen_despite_a_later_gap():
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T06:20:00Z", "during"),
+        cursor=iso_to_unix("2026-08-19T07:00:00Z"),
+    )
+    result = select(items, archive=archive)
+    assert result.status is Status.OK
+    assert result.track_ids == ["during"]
+
+
+# --- many windows against one history ------------------------------------
+
+
+def test_batch_matches_one_window_at_a_time():
+    from listening_history import select_tracks_in_windows
+
+    items = buffer_of(HISTORY_CAPACITY, oldest_iso="2026-08-19T10:00:00Z")
+    archive = archived(
+        ("2026-08-19T06:10:00Z", "during-1"),
+        ("2026-08-19T08:30:00Z", "later"),
+        ("2026-08-19T10:00:00Z", "track-0"),
+        covered_since=iso_to_unix("2026-08-19T06:00:00Z"),
+    )
+    windows = [
+        ("2026-08-19T06:05:00Z", "2026-08-19T06:30:00Z"),  # in the archive
+        ("2026-08-19T05:00:00Z", "2026-08-19T05:20:00Z"),  # before its coverage
+        ("2026-08-19T07:00:00Z", "2026-08-19T07:30:00Z"),  # covered, silent
+        ("2026-08-19T10:05:00Z", "2026-08-19T10:20:00Z"),  # in the buffer
+    ]
+    windows_ms = [(iso_to_unix(s), iso_to_unix(e)) for s, e in windows]
+
+    batch = select_tracks_in_windows(items, windows_ms, archive=archive)
+
+    assert batch == [
+        select_tracks_in_window(items, s, e, archive=archive) for s, e in windows_ms
+    ]
+    assert [selection.status for selection in batch] == [
+        Status.OK,
+        Status.HORIZON_EXCEEDED,
+        Status.NO_SONGS_PLAYED,
+        Status.OK,
+    ]
+
+
+def test_window_edges_are_inclusive_after_padding():
+    from listening_history import build_history, select_in_history
+
+    history = build_history(
+        [play("2026-08-19T07:05:00Z", "at-end"), play("2026-08-19T05:55:00Z", "at-start")]
+    )
+    selection = select_in_history(
+        history, iso_to_unix("2026-08-19T06:00:00Z"), iso_to_unix("2026-08-19T07:00:00Z")
+    )
+    assert selection.track_ids == ["at-start", "at-end"]
+
+
+def test_batch_of_an_empty_history_is_no_history_for_every_window():
+    from listening_history import select_tracks_in_windows
+
+    statuses = [s.status for s in select_tracks_in_windows([], [(0, 1), (2, 3)])]
+    assert statuses == [Status.NO_HISTORY, Status.NO_HISTORY]
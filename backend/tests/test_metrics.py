@@ -0,0 +1,182 @@
+"""Tests for the metrics registry and what feeds it.
+
+Provider calls are covered in test_http_client.py; these cover the exposition
+format, routes, SQL statements and selection outcomes.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def sample_lines(name):
+    return [line for line in metrics.render().splitlines() if line.startswith(name)]
+
+
+# --- exposition ----------------------------------------------------------
+
+
+def test_histogram_buckets_are_cumulative_with_sum_and_count():
+    metrics.db_query_seconds.observe(0.004, statement="SELECT users")
+    metrics.db_query_seconds.observe(0.03, statement="SELECT users")
+    metrics.db_query_seconds.observe(60, statement="SELECT users")
+    lines = sample_lines("rebeat_db_query_seconds")
+    assert 'rebeat_db_query_seconds_bucket{statement="SELECT users",le="0.005"} 1' in lines
+    assert 'rebeat_db_query_seconds_bucket{statement="SELECT users",le="0.025"} 1' in lines
+    assert 'rebeat_db_query_seconds_bucket{statement="SELECT users",le="0.05"} 2' in lines
+    assert 'rebeat_db_query_seconds_bucket{statement="SELECT users",le="30"} 2' in lines
+    assert 'rebeat_db_query_seconds_bucket{statement="SELECT users",le="+Inf"} 3' in lines
+    assert 'rebeat_db_query_seconds_count{statement="SELECT users"} 3' in lines
+
+
+def test_every_metric_has_help_and_type():
+    text = metrics.render()
+    for metric in metrics.REGISTRY:
+        assert f"# HELP {metric.name} " in text
+        assert f"# TYPE {metric.name} {metric.kind}" in text
+
+
+def test_label_values_are_escaped():
+    metrics.selection_total.inc(status='a"b\\c\nd')
+    assert sample_lines("rebeat_selection_total") == [
+        'rebeat_selection_total{status="a\\"b\\\\c\\nd"} 1'
+    ]
+
+
+def test_retries_are_read_from_the_http_client(monkeypatch):
+    from src import http_client
+
+    monkeypatch.setattr(
+        http_client, "retry_counts", lambda: {("www.strava.com", "server_error"): 2}
+    )
+    assert sample_lines("rebeat_provider_retries_total") == [
+        'rebeat_provider_retries_total{host="www.strava.com",reason="server_error"} 2'
+    ]
+
+
+# --- routes --------------------------------------------------------------
+
+
+def serve(app, path="/api/activities"):
+    scope = {"type": "http", "method": "GET", "path": path}
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        pass
+
+    asyncio.run(metrics.RouteTimer(app)(scope, receive, send))
+
+
+def test_requests_are_timed_under_their_route_template():
+    async def app(scope, receive, send):
+        scope["route"] = SimpleNamespace(path="/api/activities")
+        await send({"type": "http.response.start", "status": 200})
+
+    serve(app, "/api/activities?per_page=5")
+    assert metrics.http_request_seconds.count(
+        method="GET", route="/api/activities", status="200"
+    ) == 1
+
+
+def test_a_request_that_raises_is_a_500():
+    async def app(scope, receive, send):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        serve(app, "/nowhere")
+    assert metrics.http_request_seconds.count(
+        method="GET", route="unmatched", status="500"
+    ) == 1
+
+
+def test_route_timer_is_the_outermost_middleware():
+    import app
+
+    # Starlette runs the last-added middleware first.
+    assert app.app.user_middleware[0].cls is app.metrics.RouteTimer
+
+
+@pytest.mark.parametrize(
+    "configured, sent, allowed",
+    [
+        (None, None, False),
+        (None, "Bearer None", False),
+        ("s3cret", None, False),
+        ("s3cret", "Bearer wrong", False),
+        ("s3cret", "Bearer s3cret", True),
+    ],
+)
+def test_metrics_need_a_configured_token(monkeypatch, configured, sent, allowed):
+    from fastapi import HTTPException
+
+    import app
+
+    monkeypatch.setattr(app, "METRICS_TOKEN", configured)
+    request = SimpleNamespace(headers={"authorization": sent} if sent else {})
+    if allowed:
+        assert app.get_metrics(request).status_code == 200
+    else:
+        with pytest.raises(HTTPException) as excinfo:
+            app.get_metrics(request)
+        assert excinfo.value.status_code == 401
+
+
+# --- SQL -----------------------------------------------------------------
+
+
+@pytest.mark.parametrize(
+    "sql, label",
+    [
+        ("SELECT users.id FROM users WHERE users.id = %(id)s", "SELECT users"),
+        ("INSERT INTO enhanced_activities (user_id) VALUES (%(u)s)", "INSERT enhanced_activities"),
+        ("UPDATE tokens SET access_token=%(a)s WHERE tokens.id = %(i)s", "UPDATE tokens"),
+        ("DELETE FROM jobs WHERE jobs.id = %(i)s", "DELETE jobs"),
+        ("select 1", "SELECT"),
+        ("BEGIN", "BEGIN"),
+    ],
+)
+def test_statements_are_labelled_by_operation_and_table(sql, label):
+    assert metrics.statement_label(sql) == label
+
+
+def test_an_instrumented_engine_times_its_statements():
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER)"))
+        conn.execute(text("SELECT id FROM users"))
+        with pytest.raises(Exception):
+            conn.execute(text("SELECT id FROM missing"))
+        conn.execute(text("SELECT id FROM users"))
+    assert metrics.db_query_seconds.count(statement="SELECT users") == 2
+    assert metrics.db_query_seconds.count(statement="SELECT missing") == 0
+
+
+# --- selection -----------------------------------------------------------
+
+
+def test_selection_outcomes_are_counted():
+    from fastapi import HTTPException
+
+    import spotify
+    from listening_history import Selection, Status
+
+    spotify.raise_for_selection(Selection(Status.OK, ["t1"], 0))
+    with pytest.raises(HTTPException):
+        spotify.raise_for_selection(Selection(Status.HORIZON_EXCEEDED, [], 0))
+    assert metrics.selection_total.value(status=Status.OK.value) == 1
+    assert metrics.selection_total.value(status=Status.HORIZON_EXCEEDED.value) == 1
@@ -0,0 +1,71 @@
+"""Tests for the OAuth callbacks.
+
+The whole app is served in-process and the providers are stubbed at the
+HTTP client, so what's checked is how the callbacks behave on the event loop.
+"""
+
+import asyncio
+from unittest import mock
+
+import httpx
+import pytest
+
+from src import http_client
+
+
+@pytest.fixture
+def app(monkeypatch):
+    import app as module
+    from src import auth
+    from src.db import get_async_db
+
+    async def no_db():
+        yield mock.AsyncMock()
+
+    monkeypatch.setattr(auth, "SECRET_KEY", "a-test-secret-at-least-32-bytes-long")
+    monkeypatch.setattr(
+        module, "find_or_create_user_async", mock.AsyncMock(return_value=mock.Mock(id=1))
+    )
+    monkeypatch.setattr(module, "store_token_async", mock.AsyncMock())
+    module.app.dependency_overrides[get_async_db] = no_db
+    http_client.reset_session()
+    yield module.app
+    module.app.dependency_overrides.clear()
+    http_client.reset_session()
+
+
+def slow_spotify(token_requested: asyncio.Event, answer: asyncio.Event):
+    """A Spotify whose token endpoint doesn't answer until told to, for serve_async."""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/token":
+            token_requested.set()
+            await answer.wait()
+            return httpx.Response(200, json={"access_token": "a", "expires_in": 3600})
+        return httpx.Response(200, json={"id": "sp1", "display_name": "Runner"})
+
+    return handler
+
+
+def test_other_requests_are_served_while_a_callback_waits_on_the_provider(app, serve_async):
+    async def scenario():
+        token_requested, answer = asyncio.Event(), asyncio.Event()
+        transport = httpx.ASGITransport(app=app)
+        serve_async(slow_spotify(token_requested, answer))
+        async with httpx.AsyncClient(transport=transport, base_url="http://rebeat") as client:
+            callback = asyncio.create_task(
+                client.get("/api/spotify/callback", params={"code": "c", "state": "s"})
+            )
+            await asyncio.wait_for(token_requested.wait(), timeout=5)
+
+            # Spotify hasn't answered, and another request still gets through.
+            other = await asyncio.wait_for(client.get("/api"), timeout=5)
+            assert other.status_code == 200
+            assert not callback.done()
+
+            answer.set()
+            return await asyncio.wait_for(callback, timeout=5)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 307
+    assert "?token=" in response.headers["location"]
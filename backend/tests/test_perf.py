@@ -0,0 +1,75 @@
+"""Regression budgets for the hot paths of track selection.
+
+Timings come from benchmarks/bench_listening_history.py, in this process.
+On a shared CI runner they're at the mercy of the neighbours, so the timed
+tests only run when asked for, with PERF_TESTS=1:
+
+    PERF_TESTS=1 python -m pytest tests/test_perf.py
+
+The check that the fast path parses what dateutil does always runs.
+"""
+
+import os
+import tomllib
+
+import pytest
+
+from benchmarks import bench_listening_history as bench
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+
+timed = pytest.mark.skipif(
+    os.getenv("PERF_TESTS") != "1", reason="timed; set PERF_TESTS=1 to run"
+)
+
+
+def budgets_us() -> dict:
+    with open(os.path.join(BACKEND, "pyproject.toml"), "rb") as f:
+        budgets = tomllib.load(f)["tool"]["rebeat"]["perf_budgets_us"]
+    scale = float(os.getenv("PERF_BUDGET_SCALE", "1"))
+    return {name: us * scale for name, us in budgets.items()}
+
+
+@pytest.fixture(scope="module")
+def timings():
+    return bench.measure(archive_sizes=[100_000])
+
+
+@timed
+@pytest.mark.parametrize("case", sorted(budgets_us()))
+def test_case_stays_within_budget(timings, case):
+    budget = budgets_us()[case]
+    assert timings[case] <= budget, f"{case}: {timings[case]:.1f}us > {budget:.1f}us"
+
+
+@timed
+def test_fast_path_beats_dateutil(timings):
+    # Holds on any machine, where the absolute budgets might not.
+    assert timings["iso_to_unix"] * 4 < timings["dateutil_isoparse"]
+
+
+@timed
+def test_a_batch_costs_about_one_window(timings):
+    # The history is built once, so 20 windows shouldn't cost 20 selections.
+    single = timings["select_archive_100000"]
+    assert timings["select_batch_20_archive_100000"] < 2 * single
+
+
+@pytest.mark.parametrize(
+    "iso",
+    [
+        bench.buffer_items()[0]["played_at"],
+        "2026-08-18T16:47:43Z",  # Strava's start_date
+        "2026-08-18T18:47:43+02:00",
+        "2026-08-18T16:47:43",  # naive, read as UTC
+        "2026-08-18T24:00:00Z",  # not fromisoformat's; falls back
+    ],
+)
+def test_fast_path_agrees_with_dateutil(iso):
+    from datetime import timezone
+
+    from dateutil import parser
+
+    dt = parser.isoparse(iso)
+    expected = int(dt.replace(tzinfo=dt.tzinfo or timezone.utc).timestamp() * 1000)
+    assert bench.iso_to_unix(iso) == expected
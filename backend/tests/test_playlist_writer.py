@@ -0,0 +1,133 @@
+"""Tests for writing a playlist's tracks in chunks.
+
+The provider client is replaced by an in-memory playlist that can be told to
+fail particular adds, either before or after applying them.
+"""
+
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def spotify():
+    import spotify
+
+    return spotify
+
+
+def response(status_code, payload):
+    stub = mock.Mock(status_code=status_code, headers={})
+    stub.json.return_value = payload
+    return stub
+
+
+class Playlist:
+    """A playlist behind the add-items and get-playlist endpoints."""
+
+    def __init__(self, fail=(), fail_after_applying=(), reject=()):
+        self.tracks = []
+        self.adds = []
+        self.fail = set(fail)  # add call numbers (from 0) that are refused
+        self.fail_after_applying = set(fail_after_applying)
+        self.reject = set(reject)  # ...and those turned down with a 400
+
+    def post(self, url, headers, json, name):
+        call = len(self.adds)
+        self.adds.append((json["position"], len(json["uris"])))
+        assert len(json["uris"]) <= 100
+        if call in self.fail:
+            return response(500, {"error": "boom"})
+        if call in self.reject:
+            return response(400, {"error": "invalid uri"})
+        self.tracks[json["position"] : json["position"]] = json["uris"]
+        if call in self.fail_after_applying:
+            return response(504, {"error": "gateway timeout"})
+        return response(201, {"snapshot_id": f"snap-{len(self.tracks)}"})
+
+    def get(self, url, headers, params, name):
+        return response(
+            200, {"snapshot_id": f"snap-{len(self.tracks)}", "tracks": {"total": len(self.tracks)}}
+        )
+
+
+def write(spotify, playlist, count):
+    ids = [f"t{i:04d}" for i in range(count)]
+    with mock.patch.object(spotify.http_client, "post", playlist.post), mock.patch.object(
+        spotify.http_client, "get", playlist.get
+    ), mock.patch.object(spotify.time, "sleep"):
+        written = spotify.add_songs(ids, "playlist", token="t")
+    return written, [f"spotify:track:{i}" for i in ids]
+
+
+def test_long_lists_go_in_order_in_chunks_of_100(spotify):
+    playlist = Playlist()
+    written, expected = write(spotify, playlist, 250)
+    assert playlist.adds == [(0, 100), (100, 100), (200, 50)]
+    assert playlist.tracks == expected
+    assert written.complete and written.failed == []
+    assert written.snapshot_id == "snap-250"
+
+
+def test_only_the_failed_chunk_is_retried_and_lands_in_place(spotify):
+    playlist = Playlist(fail={1})
+    written, expected = write(spotify, playlist, 300)
+    # Chunk 1 failed, chunk 2 went in behind chunk 0, then chunk 1 between them.
+    assert playlist.adds == [(0, 100), (100, 100), (100, 100), (100, 100)]
+    assert playlist.tracks == expected
+    assert written.complete
+
+
+def test_a_chunk_that_landed_despite_an_error_is_not_added_twice(spotify):
+    playlist = Playlist(fail_after_applying={0})
+    written, expected = write(spotify, playlist, 150)
+    assert playlist.adds == [(0, 100), (100, 50)]
+    assert playlist.tracks == expected
+    assert written.complete
+
+
+def test_a_chunk_inferred_to_have_landed_updates_the_snapshot(spotify):
+    playlist = Playlist(fail_after_applying={1})
+    written, _ = write(spotify, playlist, 150)
+    assert written.complete
+    assert written.snapshot_id == "snap-150"
+
+
+def test_an_add_without_a_snapshot_id_still_lands(spotify):
+    playlist = Playlist()
+    post = playlist.post
+
+    def without_snapshot(*args, **kwargs):
+        reply = post(*args, **kwargs)
+        if len(playlist.adds) == 2:
+            reply.json.return_value = {}
+        return reply
+
+    playlist.post = without_snapshot
+    written, expected = write(spotify, playlist, 150)
+    assert playlist.adds == [(0, 100), (100, 50)]
+    assert playlist.tracks == expected
+    assert written.complete
+    # The last snapshot Spotify did name.
+    assert written.snapshot_id == "snap-100"
+
+
+def test_a_chunk_spotify_rejected_is_not_retried(spotify):
+    playlist = Playlist(reject={1})
+    written, _ = write(spotify, playlist, 250)
+    # Chunk 1 is tried once; chunk 2 goes in behind chunk 0, and that's it.
+    assert playlist.adds == [(0, 100), (100, 100), (100, 50)]
+    assert written.added == 150
+    assert [start for start, _ in written.failed] == [100]
+    assert "400" in written.failed[0][1]
+    assert "added 150 of 250 tracks" in written.shortfall
+
+
+def test_a_chunk_that_keeps_failing_is_reported_not_raised(spotify):
+    playlist = Playlist(fail={1, 2, 3})  # the chunk, and both its retries
+    written, _ = write(spotify, playlist, 200)
+    assert written.added == 100
+    assert written.requested == 200
+    assert not written.complete
+    assert [start for start, _ in written.failed] == [100]
+    assert "500" in written.failed[0][1]
@@ -1,11 +1,20 @@
-"""Tests for fetching the latest activity and writing its description.
-
-These cover the paths that used to fail confusingly: an athlete with no
-activities, a non-200 from Strava, and an activity with no description.
+"""Tests for src/strava.py: finding activities and adding playlists to them.
+
+They cover:
+- fetching the latest activity, including the paths that used to fail
+  confusingly (an athlete with no activities, a non-200 from Strava);
+- writing the description, including an activity with none;
+- the POST /api/latest pipeline and its claim on the activity;
+- matching a batch of activities;
+- paging through recent activities.
+
+The real modules are imported, database included, but no session is ever
+used. Provider calls are replaced with canned responses, and the
+enhanced_activities ledger with mocks (`ledger`).
 """
 
-import sys
-import types
+import asyncio
+import time
 from unittest import mock
 
 import pytest
@@ -13,22 +22,32 @@ import pytest
 
 @pytest.fixture(scope="module")
 def strava():
-    """Import src.strava without opening a database connection.
-
-    Only the database modules are stubbed; everything else is imported for
-    real, so the test exercises the actual module graph.
-    """
-    for name in ("src.db", "src.db_ops", "db_ops"):
-        sys.modules.setdefault(name, types.ModuleType(name))
-    sys.modules["src.db"].Token = object
-    sys.modules["src.db"].get_db = lambda: None
-    sys.modules["src.db_ops"].store_token = lambda **kwargs: None
-    sys.modules["db_ops"].store_token = lambda **kwargs: None
     import strava
 
     return strava
 
 
+@pytest.fixture
+def ledger(strava):
+    """enhanced_activities, with every claim won and nothing yet made."""
+    from src.enhanced_activities import Enhancement
+
+    claim = mock.Mock(
+        side_effect=lambda db, user_id, activity_id: (
+            True,
+            Enhancement(activity_id, "pending"),
+        )
+    )
+    with mock.patch.multiple(
+        strava.enhanced_activities,
+        claim=claim,
+        record_playlist=mock.DEFAULT,
+        finish=mock.DEFAULT,
+        release=mock.DEFAULT,
+    ) as mocks:
+        yield dict(mocks, claim=claim)
+
+
 def response(status_code, payload):
     stub = mock.Mock()
     stub.status_code = status_code
@@ -47,6 +66,13 @@ ACTIVITY = {
 }
 
 
+def made(url, requested=10, added=10):
+    """What create_run_playlist returns for a playlist at `url`."""
+    from spotify import PlaylistWrite, RunPlaylist
+
+    return RunPlaylist(url, PlaylistWrite(requested=requested, added=added))
+
+
 # --- compose_description -------------------------------------------------
 
 
@@ -121,3 +147,349 @@ def test_non_200_when_fetching_detail_surfaces_the_status(strava):
         )
     assert excinfo.value.status_code == 502
     assert "404" in excinfo.value.detail
+
+
+# --- add_playlist_to_latest_run_async ------------------------------------
+
+
+STAGE_SECONDS = 0.2
+
+
+def slow(result):
+    def stage(*args, **kwargs):
+        time.sleep(STAGE_SECONDS)
+        return result
+
+    return stage
+
+
+def test_async_pipeline_overlaps_strava_lookup_and_spotify_history(strava, ledger):
+    """The two read branches run side by side, so the pipeline takes roughly
+    one stage of reads plus the writes rather than the sum of the reads."""
+    strava_tokens = mock.Mock(return_value="strava-token")
+    put_link = mock.Mock(return_value={"id": 42})
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=strava_tokens,
+        fetch_latest_run=slow(ACTIVITY),
+        get_spotify_access_token_from_db=lambda user_id, db: "spotify-token",
+        get_recently_played=slow([]),
+        load_archive=lambda *args: None,
+        select_run_tracks=mock.Mock(),
+        create_run_playlist=mock.Mock(
+            return_value=made("https://open.spotify.com/playlist/x")
+        ),
+        write_playlist_link=put_link,
+    ):
+        started = time.perf_counter()
+        result = asyncio.run(
+            strava.add_playlist_to_latest_run_async(1, "spotify-user", db=None)
+        )
+        elapsed = time.perf_counter() - started
+
+    assert result == {"id": 42}
+    assert elapsed < STAGE_SECONDS * 1.75
+    # Loaded once and reused for the write-back.
+    strava_tokens.assert_called_once()
+    put_link.assert_called_once_with(
+        ACTIVITY, "https://open.spotify.com/playlist/x", "strava-token"
+    )
+
+
+def test_async_pipeline_surfaces_a_failed_branch(strava, ledger):
+    from fastapi import HTTPException
+
+    def no_activities(access_token):
+        raise HTTPException(status_code=404, detail="none")
+
+    create = mock.Mock()
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_latest_run=no_activities,
+        get_spotify_access_token_from_db=lambda user_id, db: "spotify-token",
+        get_recently_played=lambda token: [],
+        create_run_playlist=create,
+    ):
+        with pytest.raises(HTTPException) as excinfo:
+            asyncio.run(strava.add_playlist_to_latest_run_async(1, "u", db=None))
+    assert excinfo.value.status_code == 404
+    create.assert_not_called()
+
+
+def test_a_claim_won_while_the_history_read_failed_is_released(strava, ledger):
+    from fastapi import HTTPException
+
+    def history_down(token):
+        raise HTTPException(status_code=502, detail="Spotify returned 500")
+
+    db = mock.Mock()
+    create = mock.Mock()
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_latest_run=lambda token: ACTIVITY,
+        get_spotify_access_token_from_db=lambda user_id, db: "spotify-token",
+        get_recently_played=history_down,
+        create_run_playlist=create,
+    ):
+        with pytest.raises(HTTPException) as excinfo:
+            asyncio.run(strava.add_playlist_to_latest_run_async(1, "u", db=db))
+    assert excinfo.value.status_code == 502
+    ledger["claim"].assert_called_once_with(db, 1, 42)
+    ledger["release"].assert_called_once_with(db, 1, 42, "Spotify returned 500")
+    ledger["finish"].assert_not_called()
+    create.assert_not_called()
+
+
+# --- add_playlists_to_activities -----------------------------------------
+
+
+def activity(activity_id, start_date, elapsed_time=1200):
+    return dict(ACTIVITY, id=activity_id, start_date=start_date, elapsed_time=elapsed_time)
+
+
+def test_batch_reads_the_history_once_for_every_activity(strava, ledger):
+    from fastapi import HTTPException
+
+    runs = {
+        1: activity(1, "2026-08-19T06:00:00Z"),  # warm-up
+        2: activity(2, "2026-08-19T06:30:00Z"),  # race
+        3: activity(3, "2026-08-19T09:00:00Z"),  # cool-down, nothing played
+    }
+
+    def fetch(activity_id, access_token):
+        if activity_id == 4:
+            raise HTTPException(status_code=502, detail="Strava returned 404")
+        return runs[activity_id]
+
+    items = [
+        {"played_at": "2026-08-19T06:40:00Z", "track": {"id": "race"}},
+        {"played_at": "2026-08-19T06:10:00Z", "track": {"id": "warm-up"}},
+    ]
+    recently_played = mock.Mock(return_value=items)
+    archive = mock.Mock(return_value=None)
+    create = mock.Mock(side_effect=lambda selection, **_: made(f"url-{selection.track_ids[0]}"))
+    put_link = mock.Mock()
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_activity=fetch,
+        get_spotify_access_token_from_db=lambda user_id, db: "spotify-token",
+        get_recently_played=recently_played,
+        load_archive=archive,
+        create_run_playlist=create,
+        write_playlist_link=put_link,
+    ):
+        results = strava.add_playlists_to_activities(1, "u", [1, 2, 3, 4], db=None)
+
+    recently_played.assert_called_once_with("spotify-token")
+    archive.assert_called_once()
+    assert results[:2] == [
+        {"activity_id": 1, "playlist_url": "url-warm-up"},
+        {"activity_id": 2, "playlist_url": "url-race"},
+    ]
+    assert [(r["activity_id"], r["status_code"]) for r in results[2:]] == [(3, 400), (4, 502)]
+    assert put_link.call_count == 2
+    ledger["finish"].assert_has_calls([mock.call(None, 1, 1), mock.call(None, 1, 2)])
+    # Nothing played in the cool-down, and the fourth couldn't be fetched.
+    assert [c.args[2] for c in ledger["release"].call_args_list] == [4, 3]
+
+
+def test_an_aborted_batch_rolls_back_before_releasing_its_claims(strava, ledger):
+    db = mock.Mock()
+    order = []
+    db.rollback.side_effect = lambda: order.append("rollback")
+    ledger["release"].side_effect = lambda db, user_id, activity_id, error: order.append(
+        (activity_id, error)
+    )
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=mock.Mock(side_effect=RuntimeError("db gone")),
+    ):
+        with pytest.raises(RuntimeError):
+            strava.add_playlists_to_activities(1, "u", [1, 2], db)
+    assert order == ["rollback", (1, "batch aborted"), (2, "batch aborted")]
+
+
+# --- one playlist per activity -------------------------------------------
+
+
+def test_a_done_activity_gets_its_playlist_back_without_any_calls(strava):
+    from src.enhanced_activities import Enhancement
+
+    done = Enhancement(42, "done", "x", "https://open.spotify.com/playlist/x")
+    tokens = mock.Mock()
+    with mock.patch.object(
+        strava.enhanced_activities, "claim", return_value=(False, done)
+    ), mock.patch.object(strava, "get_strava_access_token_from_db", tokens):
+        result = strava.add_playlist_to_activity(1, "u", 42, db=mock.Mock())
+    assert result == {
+        "id": 42,
+        "status": "done",
+        "playlist_url": "https://open.spotify.com/playlist/x",
+    }
+    tokens.assert_not_called()
+
+
+def test_an_activity_being_enhanced_elsewhere_is_a_409(strava):
+    from fastapi import HTTPException
+    from src.enhanced_activities import Enhancement
+
+    with mock.patch.object(
+        strava.enhanced_activities,
+        "claim",
+        return_value=(False, Enhancement(42, "pending")),
+    ):
+        with pytest.raises(HTTPException) as excinfo:
+            strava.add_playlist_to_activity(1, "u", 42, db=mock.Mock())
+    assert excinfo.value.status_code == 409
+
+
+def test_a_finished_enhancement_records_the_playlist_and_is_done(strava, ledger):
+    db = mock.Mock()
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_activity=lambda activity_id, token: ACTIVITY,
+        build_playlist=mock.Mock(return_value=made("https://open.spotify.com/playlist/p1")),
+        write_playlist_link=mock.Mock(return_value={"id": 42}),
+    ):
+        assert strava.add_playlist_to_activity(1, "u", 42, db) == {"id": 42}
+    ledger["record_playlist"].assert_called_once_with(
+        db, 1, 42, "https://open.spotify.com/playlist/p1", None
+    )
+    ledger["finish"].assert_called_once_with(db, 1, 42)
+    ledger["release"].assert_not_called()
+
+
+def test_a_partial_playlist_is_recorded_with_what_it_is_missing(strava, ledger):
+    from spotify import PlaylistWrite, RunPlaylist
+
+    db = mock.Mock()
+    written = PlaylistWrite(
+        requested=250, added=200, failed=[(200, "Spotify returned 500 when adding tracks")]
+    )
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_activity=lambda activity_id, token: ACTIVITY,
+        build_playlist=mock.Mock(return_value=RunPlaylist("https://x/p1", written)),
+        write_playlist_link=mock.Mock(return_value={"id": 42}),
+    ):
+        strava.add_playlist_to_activity(1, "u", 42, db)
+    (*_, shortfall), _ = ledger["record_playlist"].call_args
+    assert "added 200 of 250 tracks" in shortfall
+    assert "track 200" in shortfall
+    ledger["finish"].assert_called_once_with(db, 1, 42)
+
+
+def test_a_failed_enhancement_is_released_for_a_retry(strava, ledger):
+    from fastapi import HTTPException
+
+    db = mock.Mock()
+    put_link = mock.Mock(side_effect=HTTPException(status_code=502, detail="PUT failed"))
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_activity=lambda activity_id, token: ACTIVITY,
+        build_playlist=mock.Mock(return_value=made("https://open.spotify.com/playlist/p1")),
+        write_playlist_link=put_link,
+    ):
+        with pytest.raises(HTTPException):
+            strava.add_playlist_to_activity(1, "u", 42, db)
+    ledger["release"].assert_called_once_with(db, 1, 42, "PUT failed")
+    ledger["finish"].assert_not_called()
+
+
+def test_a_retry_reuses_the_playlist_an_earlier_attempt_made(strava, ledger):
+    from src.enhanced_activities import Enhancement
+
+    url = "https://open.spotify.com/playlist/p1"
+    ledger["claim"].side_effect = None
+    ledger["claim"].return_value = (True, Enhancement(42, "pending", "p1", url))
+    build = mock.Mock()
+    put_link = mock.Mock(return_value={"id": 42})
+    with mock.patch.multiple(
+        strava,
+        get_strava_access_token_from_db=lambda user_id, db: "strava-token",
+        fetch_activity=lambda activity_id, token: ACTIVITY,
+        build_playlist=build,
+        write_playlist_link=put_link,
+    ):
+        strava.add_playlist_to_activity(1, "u", 42, mock.Mock())
+    build.assert_not_called()
+    put_link.assert_called_once_with(ACTIVITY, url, "strava-token")
+
+
+# --- list_recent_activities ----------------------------------------------
+
+
+def listed(activity_id, start_date):
+    return {"id": activity_id, "name": f"Run {activity_id}", "type": "Run", "start_date": start_date}
+
+
+PAGE = [
+    listed(3, "2026-08-19T06:00:00Z"),
+    listed(2, "2026-08-18T06:00:00Z"),
+]
+
+
+@pytest.fixture
+def pages(strava):
+    strava.activity_pages.clear()
+    yield
+    strava.activity_pages.clear()
+
+
+def list_page(strava, payload, lookup=None, **kwargs):
+    from src.enhanced_activities import Enhancement
+
+    lookup = lookup or mock.Mock(
+        return_value={3: Enhancement(3, "done", "p", "https://open.spotify.com/playlist/p")}
+    )
+    send = mock.Mock(return_value=response(200, payload))
+    with mock.patch.object(strava, "get", send), mock.patch.object(
+        strava, "get_strava_access_token_from_db", return_value="token"
+    ), mock.patch.object(strava.enhanced_activities, "lookup", lookup):
+        page = strava.list_recent_activities(1, db=None, **kwargs)
+    return page, send, lookup
+
+
+def test_a_page_is_one_strava_call_and_one_lookup(strava, pages):
+    page, send, lookup = list_page(strava, PAGE, per_page=2)
+    send.assert_called_once()
+    assert send.call_args.kwargs["params"] == {"per_page": 2}
+    lookup.assert_called_once_with(None, 1, [3, 2])
+    assert [(a["id"], a["enhanced"], a["playlist_url"]) for a in page["activities"]] == [
+        (3, True, "https://open.spotify.com/playlist/p"),
+        (2, False, None),
+    ]
+
+
+def test_a_full_first_page_points_only_backwards(strava, pages):
+    page, _, _ = list_page(strava, PAGE, per_page=2)
+    assert page["next_before"] == 1787032800  # 2026-08-18T06:00:00Z
+    assert page["prev_after"] is None
+
+
+def test_a_short_older_page_is_the_last_one(strava, pages):
+    page, send, _ = list_page(strava, PAGE, before=1787100000, per_page=5)
+    assert send.call_args.kwargs["params"] == {"per_page": 5, "before": 1787100000}
+    assert page["next_before"] is None
+    assert page["prev_after"] == 1787119200  # 2026-08-19T06:00:00Z
+
+
+def test_paging_forwards_comes_back_newest_first(strava, pages):
+    page, _, _ = list_page(strava, list(reversed(PAGE)), after=1787000000, per_page=2)
+    assert [a["id"] for a in page["activities"]] == [3, 2]
+    assert page["next_before"] == 1787032800
+    assert page["prev_after"] == 1787119200
+
+
+def test_the_strava_page_is_cached_but_status_is_not(strava, pages):
+    list_page(strava, PAGE, per_page=2)
+    page, send, lookup = list_page(strava, PAGE, per_page=2, lookup=mock.Mock(return_value={}))
+    send.assert_not_called()
+    lookup.assert_called_once()
+    assert not any(a["enhanced"] for a in page["activities"])
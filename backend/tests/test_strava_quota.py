@@ -0,0 +1,272 @@
+"""Tests for the Strava rate limit budget.
+
+The in-memory store stands in for the strava_quota row, which holds the same
+state; the clock is injected. The row's own statement is run against a real
+Postgres when TEST_DATABASE_URL is set.
+"""
+
+import threading
+from unittest import mock
+
+import pytest
+
+# 2024-01-01 00:00:00 UTC, the start of both a day and a 15-minute window.
+MIDNIGHT = 1_704_067_200.0
+
+
+@pytest.fixture(scope="module")
+def quota():
+    from src import strava_quota
+
+    return strava_quota
+
+
+def governor(quota, now=MIDNIGHT, short_limit=4, daily_limit=100, share=0.5):
+    clock = mock.Mock(return_value=now)
+    store = quota.MemoryQuotaStore(
+        quota.QuotaState(short_limit=short_limit, daily_limit=daily_limit)
+    )
+    return quota.QuotaGovernor(store, background_share=share, clock=clock), clock
+
+
+def usage(gov):
+    state = gov.store._state
+    return state.short_usage, state.daily_usage
+
+
+def test_headers_are_parsed_as_short_and_daily(quota):
+    headers = {"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "31,560"}
+    assert quota.parse_rate_limit(headers) == ((31, 560), (200, 2000))
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [{}, {"X-RateLimit-Limit": "200,2000"}, {"X-RateLimit-Limit": "x", "X-RateLimit-Usage": "1,2"}],
+)
+def test_missing_or_garbled_headers_are_ignored(quota, headers):
+    assert quota.parse_rate_limit(headers) is None
+
+
+def test_each_reservation_is_counted(quota):
+    gov, _ = governor(quota)
+    gov.reserve()
+    gov.reserve()
+    assert usage(gov) == (2, 2)
+
+
+def test_background_work_stops_at_its_share(quota):
+    gov, _ = governor(quota, short_limit=4, share=0.5)
+    gov.reserve(quota.Priority.BACKGROUND)
+    gov.reserve(quota.Priority.BACKGROUND)
+    with pytest.raises(quota.QuotaExhausted) as exhausted:
+        gov.reserve(quota.Priority.BACKGROUND)
+    assert exhausted.value.status_code == 503
+    assert exhausted.value.retry_after == 15 * 60 + 1
+
+
+def test_interactive_calls_get_the_headroom_background_left(quota):
+    gov, _ = governor(quota, short_limit=4, share=0.5)
+    for _ in range(2):
+        gov.reserve(quota.Priority.BACKGROUND)
+    gov.reserve(quota.Priority.INTERACTIVE)
+    gov.reserve(quota.Priority.INTERACTIVE)
+    with pytest.raises(quota.QuotaExhausted):
+        gov.reserve(quota.Priority.INTERACTIVE)
+
+
+def test_a_new_window_resets_the_short_count_but_not_the_day(quota):
+    gov, clock = governor(quota, short_limit=2)
+    gov.reserve()
+    gov.reserve()
+    clock.return_value = MIDNIGHT + 15 * 60
+    gov.reserve()
+    assert usage(gov) == (1, 3)
+
+
+def test_a_spent_day_waits_for_midnight(quota):
+    gov, clock = governor(quota, short_limit=100, daily_limit=2)
+    gov.reserve()
+    gov.reserve()
+    clock.return_value = MIDNIGHT + 3600
+    with pytest.raises(quota.QuotaExhausted) as exhausted:
+        gov.reserve()
+    assert exhausted.value.retry_after == 23 * 3600 + 1
+
+
+def test_reported_usage_only_ever_raises_the_count(quota):
+    """Other processes' calls show up in the headers; stale responses don't undo ours."""
+    gov, _ = governor(quota, short_limit=600, daily_limit=30000)
+    gov.observe({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "50,900"})
+    gov.observe({"X-RateLimit-Limit": "600,30000", "X-RateLimit-Usage": "10,800"})
+    # Kept until the next call is counted, which folds them in.
+    assert usage(gov) == (0, 0)
+    gov.reserve()
+    state = gov.store._state
+    assert (state.short_usage, state.daily_usage) == (51, 901)
+    assert (state.short_limit, state.daily_limit) == (600, 30000)
+
+
+def test_usage_reported_in_a_window_since_reset_is_dropped(quota):
+    gov, clock = governor(quota)
+    gov.observe({"X-RateLimit-Limit": "4,100", "X-RateLimit-Usage": "3,50"})
+    clock.return_value = MIDNIGHT + 15 * 60
+    gov.reserve()
+    assert usage(gov) == (1, 51)
+
+
+def test_reservations_are_not_handed_out_twice(quota):
+    gov, _ = governor(quota, short_limit=50, share=1.0)
+    granted = []
+
+    def take():
+        for _ in range(20):
+            try:
+                gov.reserve()
+                granted.append(1)
+            except quota.QuotaExhausted:
+                pass
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(granted) == 50
+
+
+def test_priority_defaults_to_interactive_and_is_scoped(quota):
+    assert quota._priority.get() is quota.Priority.INTERACTIVE
+    with quota.background_priority():
+        assert quota._priority.get() is quota.Priority.BACKGROUND
+    assert quota._priority.get() is quota.Priority.INTERACTIVE
+
+
+def send(quota, gov, responses):
+    session = quota.http_client.get_session()
+    with mock.patch.object(quota, "get_governor", return_value=gov), mock.patch.object(
+        session, "request", side_effect=responses
+    ) as request, mock.patch.object(quota.http_client.time, "sleep"):
+        try:
+            return quota.get("https://www.strava.com/api/v3/athlete")
+        finally:
+            send.calls = request.call_count
+
+
+def reply(status, headers=None):
+    return mock.Mock(status_code=status, headers=headers or {})
+
+
+def test_request_counts_the_call_then_records_the_headers(quota):
+    gov, _ = governor(quota, short_limit=200)
+    response = reply(200, {"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "7,70"})
+    assert send(quota, gov, [response]) is response
+    assert usage(gov) == (1, 1)
+    gov.reserve()
+    assert usage(gov) == (8, 71)
+
+
+def test_request_is_not_sent_once_the_budget_is_spent(quota):
+    gov, _ = governor(quota, short_limit=0)
+    with pytest.raises(quota.QuotaExhausted):
+        send(quota, gov, [reply(200)])
+    assert send.calls == 0
+
+
+def test_retries_are_counted_too(quota):
+    gov, _ = governor(quota, short_limit=4)
+    assert send(quota, gov, [reply(503), reply(503), reply(200)]).status_code == 200
+    assert usage(gov) == (3, 3)
+
+
+def test_retries_stop_when_the_budget_runs_out(quota):
+    gov, _ = governor(quota, short_limit=2, share=1.0)
+    with pytest.raises(quota.QuotaExhausted):
+        send(quota, gov, [reply(503), reply(503), reply(200)])
+    assert send.calls == 2
+
+
+# --- the strava_quota row ------------------------------------------------
+
+
+def test_a_block_of_calls_is_one_statement(quota):
+    engine = mock.MagicMock()
+    conn = engine.connect.return_value.__enter__.return_value
+    window, day = int(MIDNIGHT // (15 * 60)), int(MIDNIGHT // (24 * 60 * 60))
+    conn.execute.return_value.first.return_value = (3, window, 8, 200, day, 53, 2000)
+    store = quota.PostgresQuotaStore(lambda: engine, block=3)
+    reported = quota.Reported(MIDNIGHT, (5, 50), (200, 2000))
+    assert store.reserve(MIDNIGHT + 1, 0.5, reported) is None
+
+    (call,) = conn.execute.call_args_list
+    conn.execution_options.assert_called_once_with(isolation_level="AUTOCOMMIT")
+    from sqlalchemy.dialects import postgresql
+
+    sql = " ".join(str(call.args[0].compile(dialect=postgresql.dialect())).split())
+    assert sql.startswith("UPDATE strava_quota SET short_window=")
+    assert "greatest(CASE WHEN (strava_quota.short_window = " in sql
+    assert "floor(" in sql
+    assert "FOR UPDATE" in sql
+    assert "RETURNING greatest(" in sql
+
+    # The rest of the block is handed out without going back to the row.
+    assert store.reserve(MIDNIGHT + 2, 0.5) is None
+    assert store.reserve(MIDNIGHT + 3, 0.5) is None
+    assert engine.connect.call_count == 1
+    # But not to another share, nor into the next window.
+    conn.execute.return_value.first.return_value = (0, window, 100, 200, day, 100, 2000)
+    assert store.reserve(MIDNIGHT + 4, 0.5) is not None
+    conn.execute.return_value.first.return_value = (3, window, 103, 200, day, 103, 2000)
+    assert store.reserve(MIDNIGHT + 5, 1.0) is None
+    assert engine.connect.call_count == 3
+
+
+def stored_usage(postgres):
+    from sqlalchemy import select
+
+    from src.db import StravaQuota
+
+    with postgres.connect() as conn:
+        return conn.execute(select(StravaQuota)).one()
+
+
+def test_the_row_counts_calls_across_stores(quota, postgres):
+    """Two stores, as in two processes, against a real strava_quota row."""
+    first, second = (quota.PostgresQuotaStore(lambda: postgres, block=5) for _ in range(2))
+    taken = [
+        store.reserve(MIDNIGHT, 1.0) is None for store in (first, second) * 110
+    ]
+    assert taken.count(True) == quota.DEFAULT_SHORT_LIMIT
+    # Reported usage and limits go with the next block taken.
+    reported = quota.Reported(MIDNIGHT + 60, (20, 300), (600, 3000))
+    assert first.reserve(MIDNIGHT + 60, 1.0, reported) is None
+    # A new window starts afresh, but the day carries on.
+    assert first.reserve(MIDNIGHT + 15 * 60, 0.5) is None
+    row = stored_usage(postgres)
+    # The day: the 300 reported, then a block of 5 each after it.
+    assert (row.short_usage, row.daily_usage) == (5, 310)
+    assert (row.short_limit, row.daily_limit) == (600, 3000)
+    retry_after = first.reserve(MIDNIGHT + 15 * 60, 0.0)
+    assert 0 < retry_after <= 24 * 60 * 60
+
+
+def test_concurrent_stores_never_take_more_than_the_budget(quota, postgres):
+    stores = [quota.PostgresQuotaStore(lambda: postgres, block=7) for _ in range(4)]
+    granted = []
+
+    def take(store):
+        for _ in range(80):
+            if store.reserve(MIDNIGHT, 1.0) is None:
+                granted.append(1)
+
+    threads = [
+        threading.Thread(target=take, args=(store,)) for store in stores for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    row = stored_usage(postgres)
+    assert row.short_usage == quota.DEFAULT_SHORT_LIMIT
+    # Every call counted was either made or is still held by its store.
+    held = sum(left for store in stores for _, _, left in store._taken.values())
+    assert len(granted) + held == quota.DEFAULT_SHORT_LIMIT
@@ -0,0 +1,176 @@
+"""Tests for the Strava webhook's verification and event filtering.
+
+Storage is exercised by benchmarks/bench_webhook_ingest.py against a real
+database; these cover the decisions made before and after it.
+"""
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from pydantic import ValidationError
+
+
+@pytest.fixture(scope="module")
+def webhook():
+    from src import strava_webook
+
+    return strava_webook
+
+
+def event(**overrides):
+    from src.strava_models import StravaWebhookEvent
+
+    payload = {
+        "object_type": "activity",
+        "object_id": 1360128428,
+        "aspect_type": "create",
+        "updates": {},
+        "owner_id": 134815,
+        "subscription_id": 120475,
+        "event_time": 1516126040,
+    }
+    payload.update(overrides)
+    return StravaWebhookEvent.model_validate(payload)
+
+
+# --- verification --------------------------------------------------------
+
+
+def test_challenge_is_echoed_for_the_right_token(webhook, monkeypatch):
+    monkeypatch.setattr(webhook, "STRAVA_WEBHOOK_VERIFY_TOKEN", "STRAVA")
+    challenge = "15f7d1a91c1f40f8a748fd134752feb3"
+    assert webhook.verify_subscription("subscribe", "STRAVA", challenge) == challenge
+
+
+@pytest.mark.parametrize(
+    "mode,token",
+    [("subscribe", "wrong"), ("unsubscribe", "STRAVA"), (None, None)],
+)
+def test_challenge_is_refused_otherwise(webhook, monkeypatch, mode, token):
+    monkeypatch.setattr(webhook, "STRAVA_WEBHOOK_VERIFY_TOKEN", "STRAVA")
+    assert webhook.verify_subscription(mode, token, "challenge") is None
+
+
+def test_no_configured_token_refuses_everything(webhook, monkeypatch):
+    """Otherwise a missing env var would let anyone subscribe us to anything."""
+    monkeypatch.setattr(webhook, "STRAVA_WEBHOOK_VERIFY_TOKEN", None)
+    assert webhook.verify_subscription("subscribe", None, "challenge") is None
+
+
+def test_events_for_another_subscription_are_not_ours(webhook, monkeypatch):
+    monkeypatch.setattr(webhook, "STRAVA_SUBSCRIPTION_ID", "120475")
+    assert webhook.is_our_subscription(event())
+    assert not webhook.is_our_subscription(event(subscription_id=1))
+
+
+def test_no_configured_subscription_refuses_every_event(webhook, monkeypatch, caplog):
+    monkeypatch.setattr(webhook, "STRAVA_SUBSCRIPTION_ID", None)
+    monkeypatch.setattr(webhook, "_warned_unconfigured", False)
+    assert not webhook.is_our_subscription(event())
+    assert not webhook.is_our_subscription(event())
+    assert caplog.text.count("STRAVA_SUBSCRIPTION_ID is not set") == 1
+
+
+# --- events --------------------------------------------------------------
+
+
+def test_only_new_activities_are_actionable(webhook):
+    """Our own description write arrives as an update and must not loop."""
+    assert webhook.is_actionable(event())
+    assert not webhook.is_actionable(event(aspect_type="update", updates={"title": "x"}))
+    assert not webhook.is_actionable(event(aspect_type="delete"))
+    assert not webhook.is_actionable(
+        event(object_type="athlete", aspect_type="update", updates={"authorized": "false"})
+    )
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [{"object_type": "route"}, {"aspect_type": "ping"}, {"object_id": "abc"}],
+)
+def test_malformed_events_are_rejected(overrides):
+    with pytest.raises(ValidationError):
+        event(**overrides)
+
+
+# --- processing ----------------------------------------------------------
+
+
+@pytest.fixture
+def db():
+    """A session holding one unprocessed event from a linked athlete."""
+    db = mock.Mock()
+    db.get.return_value = mock.Mock(processed_at=None, owner_id=134815, object_id=9)
+    db.query.return_value.filter.return_value.first.return_value = mock.Mock(
+        id=1, spotify_id="spotify-user"
+    )
+    db.execute.return_value.scalars.return_value.all.return_value = []
+    return db
+
+
+def test_a_spent_background_budget_defers_the_job(webhook, db):
+    from src.jobs import Deferred
+    from src.strava_quota import QuotaExhausted
+
+    with mock.patch.object(
+        webhook, "add_playlist_to_activity", side_effect=QuotaExhausted(120)
+    ):
+        with pytest.raises(Deferred) as deferred:
+            webhook.process_event({"event_id": 1}, db)
+    assert deferred.value.until > datetime.now() + timedelta(seconds=110)
+    db.commit.assert_not_called()
+
+
+def test_processing_spends_the_background_budget(webhook, db):
+    from src.strava_quota import Priority, _priority
+
+    seen = []
+    with mock.patch.object(
+        webhook,
+        "add_playlist_to_activity",
+        side_effect=lambda *args: seen.append(_priority.get()),
+    ):
+        webhook.process_event({"event_id": 1}, db)
+    assert seen == [Priority.BACKGROUND]
+    assert _priority.get() is Priority.INTERACTIVE
+
+
+def test_the_athletes_other_pending_activities_go_in_one_batch(webhook, db):
+    from src.strava_quota import QuotaExhausted
+
+    own = db.get.return_value
+    siblings = [mock.Mock(processed_at=None, object_id=i) for i in (10, 11, 12)]
+    db.execute.return_value.scalars.return_value.all.return_value = siblings
+    results = [
+        {"activity_id": 9, "playlist_url": "url-9"},
+        {"activity_id": 10, "status_code": 400, "detail": "No songs played"},
+        {"activity_id": 11, "status_code": 502, "detail": "Spotify returned 500"},
+        {"activity_id": 12, "playlist_url": "url-12"},
+    ]
+    with mock.patch.object(
+        webhook, "add_playlists_to_activities", return_value=results
+    ) as batch:
+        webhook.process_event({"event_id": 1}, db)
+    assert batch.call_args.args[2] == [9, 10, 11, 12]
+    assert own.processed_at is not None
+    assert siblings[0].error == "400: No songs played"
+    # Left for its own job to retry.
+    assert siblings[1].processed_at is None
+    assert siblings[2].processed_at is not None
+    db.commit.assert_called_once()
+
+    # The event's own activity failing is retried, its siblings' outcomes kept.
+    own.processed_at = None
+    results[0] = {"activity_id": 9, "status_code": 503, "detail": "x", "retry_after": 60}
+    with mock.patch.object(webhook, "add_playlists_to_activities", return_value=results):
+        with pytest.raises(webhook.Deferred):
+            webhook.process_event({"event_id": 1}, db)
+    assert own.processed_at is None
+    assert db.commit.call_count == 2
+
+    with mock.patch.object(
+        webhook, "add_playlists_to_activities", side_effect=QuotaExhausted(60)
+    ):
+        with pytest.raises(webhook.Deferred):
+            webhook.process_event({"event_id": 1}, db)
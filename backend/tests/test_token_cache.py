@@ -0,0 +1,252 @@
+"""Tests for the access token cache and its single-flight refresh.
+
+The database is never touched: the credentials read and the token row lookup
+are replaced with stubs that hand out plain objects, and the clock is
+injected where it matters.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def tc():
+    from src import token_cache
+
+    return token_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(tc):
+    tc.token_cache.clear()
+    yield
+    tc.token_cache.clear()
+
+
+def row(access_token, expires_in):
+    return SimpleNamespace(
+        access_token=access_token,
+        expires_at=datetime.now() + timedelta(seconds=expires_in),
+    )
+
+
+# --- TokenCache ----------------------------------------------------------
+
+
+def test_a_token_near_expiry_reads_as_missing(tc):
+    now = [1000.0]
+    cache = tc.TokenCache(margin=60, clock=lambda: now[0])
+    cache.put("k", "abc", expires_at=1100.0)
+    assert cache.get("k") == "abc"
+
+    now[0] = 1041.0  # inside the margin, though not yet expired
+    assert cache.get("k") is None
+    # And it stays gone once the clock is wound back: it was evicted.
+    now[0] = 1000.0
+    assert cache.get("k") is None
+
+
+def test_least_recently_used_entries_are_evicted_first(tc):
+    cache = tc.TokenCache(max_entries=2, margin=0)
+    far = time.time() + 3600
+    cache.put("a", "1", far)
+    cache.put("b", "2", far)
+    cache.get("a")
+    cache.put("c", "3", far)
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+
+
+def test_concurrent_misses_load_once(tc):
+    """Eight requests for the same expired token make one refresh, not eight."""
+    cache = tc.TokenCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return "fresh", time.time() + 3600
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_load("k", load)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ["fresh"] * 8
+
+
+def test_different_keys_do_not_wait_on_each_other(tc):
+    cache = tc.TokenCache()
+    release = threading.Event()
+
+    def blocked():
+        release.wait(2)
+        return "a", time.time() + 3600
+
+    thread = threading.Thread(target=cache.get_or_load, args=("a", blocked))
+    thread.start()
+    try:
+        started = time.perf_counter()
+        assert cache.get_or_load("b", lambda: ("b", time.time() + 3600)) == "b"
+        assert time.perf_counter() - started < 0.5
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_load_locks_are_dropped_once_nobody_holds_them(tc):
+    """Keys can come from a query string, so their locks mustn't pile up."""
+    cache = tc.TokenCache(max_entries=4)
+    for key in range(100):
+        cache.get_or_load(key, lambda: ("t", time.time() + 3600))
+        with cache.locked(("other", key), timeout=0):
+            pass
+    assert cache._locks == {}
+    assert len(cache._entries) == 4
+
+
+def test_a_lock_is_kept_while_someone_waits_on_it(tc):
+    cache = tc.TokenCache()
+    with cache.locked("k"):
+        with cache.locked("k", timeout=0) as acquired:
+            assert not acquired
+        # The second caller gave up, but the first still holds it.
+        assert "k" in cache._locks
+    assert cache._locks == {}
+
+
+# --- get_access_token ----------------------------------------------------
+
+
+def credentials(**tokens):
+    """What load_credentials reads: a user with these (access_token, expires_in)."""
+    from src.credentials import Credentials, ProviderToken
+    from src.user_cache import CurrentUser
+
+    return Credentials(
+        user=CurrentUser(1, None, None, None, None),
+        **{
+            provider: ProviderToken(access_token, time.time() + expires_in)
+            for provider, (access_token, expires_in) in tokens.items()
+        },
+    )
+
+
+def reading(*results):
+    from src import credentials as module
+
+    return mock.patch.object(module, "load_credentials", side_effect=list(results))
+
+
+def test_a_fresh_token_is_cached_and_not_refreshed(tc):
+    refresh = mock.Mock()
+    with reading(credentials(spotify=("from-db", 3600))) as reads, mock.patch.object(
+        tc, "_token_row"
+    ) as lookups:
+        assert tc.get_access_token(1, "spotify", db=None, refresh=refresh) == "from-db"
+        assert tc.get_access_token(1, "spotify", db=None, refresh=refresh) == "from-db"
+    refresh.assert_not_called()
+    lookups.assert_not_called()
+    assert reads.call_count == 1
+
+
+def test_a_token_about_to_expire_is_refreshed_early(tc):
+    """Inside the margin counts as expired, so no request races the clock."""
+    margin = tc.REFRESH_MARGIN_SECONDS - 10
+    expiring = row("old", expires_in=margin)
+    refresh = mock.Mock(return_value=row("new", expires_in=3600))
+    with reading(credentials(strava=("old", margin))), mock.patch.object(
+        tc, "_token_row", return_value=expiring
+    ) as lookups:
+        assert tc.get_access_token(1, "strava", db=None, refresh=refresh) == "new"
+    refresh.assert_called_once_with(expiring, None)
+    assert lookups.call_args.kwargs == {"for_update": True}
+
+
+def test_a_refresh_by_another_instance_is_picked_up_under_the_lock(tc):
+    """The token looked stale, but by the time we hold its lock it isn't."""
+    db = mock.Mock()
+    refresh = mock.Mock()
+    with reading(credentials(spotify=("old", 0))), mock.patch.object(
+        tc, "_token_row", return_value=row("theirs", expires_in=3600)
+    ) as lookups:
+        assert tc.get_access_token(1, "spotify", db=db, refresh=refresh) == "theirs"
+    refresh.assert_not_called()
+    assert lookups.call_args.kwargs == {"for_update": True}
+    db.commit.assert_called_once()
+
+
+@pytest.mark.parametrize("read", [None, credentials(strava=("s", 3600))])
+def test_an_unconnected_account_is_a_400(tc, read):
+    from fastapi import HTTPException
+
+    with reading(read), pytest.raises(HTTPException) as error:
+        tc.get_access_token(1, "spotify", db=None, refresh=mock.Mock())
+    assert error.value.status_code == 400
+    assert "Spotify account isn't connected" in error.value.detail
+
+
+# --- while someone else refreshes ----------------------------------------
+
+
+def test_a_refresh_under_way_doesnt_hold_up_a_token_that_still_works(tc):
+    margin = tc.REFRESH_MARGIN_SECONDS - 10
+    refresh = mock.Mock()
+    with tc.token_cache.locked((1, "spotify")), reading(
+        credentials(spotify=("old", margin))
+    ), mock.patch.object(tc, "_token_row") as lookups:
+        started = time.perf_counter()
+        assert tc.get_access_token(1, "spotify", db=None, refresh=refresh) == "old"
+        assert time.perf_counter() - started < 0.5
+    refresh.assert_not_called()
+    lookups.assert_not_called()
+
+
+def test_an_expired_token_waits_for_the_refresh_but_not_forever(tc, monkeypatch):
+    from fastapi import HTTPException
+
+    monkeypatch.setattr(tc, "REFRESH_LOCK_TIMEOUT_SECONDS", 0.1)
+    with tc.token_cache.locked((1, "strava")), reading(
+        credentials(strava=("old", -10))
+    ), pytest.raises(HTTPException) as error:
+        tc.get_access_token(1, "strava", db=None, refresh=mock.Mock())
+    assert error.value.status_code == 503
+
+
+def test_a_row_locked_past_lock_timeout_by_another_instance_is_given_up_on(tc):
+    from sqlalchemy.exc import OperationalError
+
+    db = mock.Mock()
+    timed_out = OperationalError("SELECT", {}, SimpleNamespace(sqlstate="55P03"))
+    margin = tc.REFRESH_MARGIN_SECONDS - 10
+    with reading(credentials(spotify=("old", margin))), mock.patch.object(
+        tc, "_token_row", side_effect=timed_out
+    ):
+        assert tc.get_access_token(1, "spotify", db=db, refresh=mock.Mock()) == "old"
+    db.rollback.assert_called_once()
+
+
+def test_the_row_lock_wait_is_bounded_on_postgres(tc):
+    db = mock.Mock()
+    db.get_bind.return_value.dialect.name = "postgresql"
+    tc._token_row(1, "spotify", db, for_update=True)
+    (statement,) = db.execute.call_args.args
+    assert str(statement) == (
+        f"SET LOCAL lock_timeout = {int(tc.REFRESH_LOCK_TIMEOUT_SECONDS * 1000)}"
+    )
+
+
+def test_the_refresh_call_gives_up_before_anyone_waiting_on_it_does(tc):
+    assert sum(tc.REFRESH_HTTP_TIMEOUT) < tc.REFRESH_LOCK_TIMEOUT_SECONDS
@@ -0,0 +1,121 @@
+"""Tests for the token sweeper, against a real Postgres (see `postgres`).
+
+The provider refresh calls are replaced; what's checked is which rows get
+claimed, that none is locked while the calls run, and what is written back.
+"""
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def sweeper(postgres):
+    from sqlalchemy.orm import Session
+
+    from src import token_sweeper
+    from src.db import Token, User
+
+    with Session(postgres) as db:
+        db.add_all([User(id=1, spotify_id="sp1"), User(id=2, spotify_id="sp2")])
+        now = datetime.now()
+        db.add_all(
+            [
+                Token(id=1, user_id=1, provider="spotify", access_token="a1",
+                      refresh_token="r1", expires_at=now + timedelta(minutes=5),
+                      updated_at=now - timedelta(hours=1)),
+                Token(id=2, user_id=2, provider="spotify", access_token="a2",
+                      refresh_token="r2", expires_at=now + timedelta(minutes=10),
+                      updated_at=now - timedelta(hours=1)),
+                # Not due.
+                Token(id=3, user_id=1, provider="strava", access_token="a3",
+                      refresh_token="r3", expires_at=now + timedelta(hours=5),
+                      updated_at=now - timedelta(hours=1)),
+            ]
+        )
+        db.commit()
+    with mock.patch.object(token_sweeper, "token_cache") as cache:
+        yield token_sweeper, cache
+
+
+def refreshed(token_id):
+    return {
+        "access_token": f"new-{token_id}",
+        "refresh_token": f"r{token_id}",
+        "expires_at": datetime(2030, 1, 1) + timedelta(minutes=token_id),
+    }
+
+
+def tokens(postgres):
+    from sqlalchemy import select
+
+    from src.db import Token
+
+    with postgres.connect() as conn:
+        return {
+            row.id: (row.access_token, row.expires_at)
+            for row in conn.execute(select(Token.id, Token.access_token, Token.expires_at))
+        }
+
+
+def test_due_tokens_are_refreshed_without_holding_their_rows(sweeper, postgres):
+    from sqlalchemy import text
+    from sqlalchemy.orm import Session
+
+    token_sweeper, cache = sweeper
+
+    def refresh(refresh_token):
+        token_id = int(refresh_token[1:])
+        # As a request refreshing the token itself would: no waiting.
+        with postgres.connect() as conn:
+            conn.execute(text("SET lock_timeout = 100"))
+            conn.execute(text(f"SELECT 1 FROM tokens WHERE id = {token_id} FOR UPDATE"))
+            conn.rollback()
+        return refreshed(token_id)
+
+    with mock.patch.dict(token_sweeper.REFRESHERS, spotify=refresh), Session(postgres) as db:
+        result = token_sweeper.sweep(db, batch_size=1)
+
+    assert (result.refreshed, result.failed) == (2, [])
+    stored = tokens(postgres)
+    assert stored[1] == ("new-1", datetime(2030, 1, 1, 0, 1))
+    assert stored[2] == ("new-2", datetime(2030, 1, 1, 0, 2))
+    assert stored[3][0] == "a3"
+    cache.put.assert_any_call((2, "spotify"), "new-2", datetime(2030, 1, 1, 0, 2).timestamp())
+
+
+def test_a_token_refreshed_meanwhile_is_left_as_it_was_stored(sweeper, postgres):
+    from sqlalchemy.orm import Session
+
+    from src import db_ops
+
+    token_sweeper, cache = sweeper
+
+    def refresh(refresh_token):
+        if refresh_token == "r1":
+            # A request got there first and stored its own refresh.
+            with Session(postgres) as other, mock.patch.object(db_ops, "token_cache"):
+                db_ops.store_token(other, 1, "spotify", "by-request", "r1b", datetime(2031, 1, 1))
+        return refreshed(int(refresh_token[1:]))
+
+    with mock.patch.dict(token_sweeper.REFRESHERS, spotify=refresh), Session(postgres) as db:
+        result = token_sweeper.sweep(db)
+
+    assert result.refreshed == 1
+    assert tokens(postgres)[1] == ("by-request", datetime(2031, 1, 1))
+    cache.put.assert_called_once()
+
+
+def test_claimed_tokens_are_skipped_by_another_sweep_and_failures_reported(sweeper, postgres):
+    from sqlalchemy.orm import Session
+
+    token_sweeper, _ = sweeper
+
+    def fail(refresh_token):
+        raise RuntimeError("provider down")
+
+    with mock.patch.dict(token_sweeper.REFRESHERS, spotify=fail), Session(postgres) as db:
+        assert sorted(token_sweeper.sweep(db).failed) == [1, 2]
+        # Still leased to the sweep that claimed them.
+        assert token_sweeper.sweep(db).failed == []
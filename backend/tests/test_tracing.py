@@ -0,0 +1,190 @@
+"""Tests for per-request traces: nesting, the request middleware, and export."""
+
+import asyncio
+import json
+import logging
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from src import tracing
+
+
+@pytest.fixture
+def trace():
+    opened = tracing.Trace(request_id="req-1")
+    token = tracing._trace.set(opened)
+    yield opened
+    tracing._trace.reset(token)
+
+
+def names(trace):
+    return [span.name for span in trace.spans]
+
+
+# --- spans ---------------------------------------------------------------
+
+
+def test_spans_cost_nothing_outside_a_request():
+    with tracing.span("stage") as opened:
+        assert opened is None
+    assert tracing.start_span("query") is None
+    tracing.annotate(ignored=True)
+
+
+def test_spans_nest_and_record_errors(trace):
+    @tracing.traced
+    def inner():
+        raise ValueError("boom")
+
+    with tracing.span("outer") as outer:
+        with pytest.raises(ValueError):
+            inner()
+    inner_span = trace.spans[1]
+    assert names(trace) == ["outer", "inner"]
+    assert inner_span.parent_id == outer.span_id
+    assert inner_span.error == "ValueError: boom"
+    assert outer.error is None  # caught inside it
+    assert inner_span.end_ns is not None
+
+
+def test_stages_on_worker_threads_nest_under_their_caller(trace):
+    @tracing.traced("on_a_thread")
+    def stage():
+        with tracing.span("inside"):
+            pass
+
+    async def pipeline():
+        with tracing.span("pipeline"):
+            await asyncio.gather(asyncio.to_thread(stage), asyncio.to_thread(stage))
+
+    asyncio.run(pipeline())
+    pipeline_span = trace.spans[0]
+    threads = [span for span in trace.spans if span.name == "on_a_thread"]
+    assert len(threads) == 2
+    assert all(span.parent_id == pipeline_span.span_id for span in threads)
+    insides = [span for span in trace.spans if span.name == "inside"]
+    assert {span.parent_id for span in insides} == {span.span_id for span in threads}
+
+
+def test_provider_calls_get_a_span_with_status_and_retries(trace):
+    from src import http_client
+
+    replies = [mock.Mock(status_code=503, headers={}), mock.Mock(status_code=200, headers={})]
+    session = http_client.get_session()
+    with mock.patch.object(session, "request", side_effect=replies), mock.patch.object(
+        http_client.time, "sleep"
+    ):
+        http_client.get("https://api.spotify.com/v1/me?x=1", name="spotify.me")
+    (call,) = trace.spans
+    assert call.name == "spotify.me"
+    assert call.kind == "client"
+    assert call.attributes["url.full"] == "https://api.spotify.com/v1/me"
+    assert call.attributes["http.response.status_code"] == 200
+    assert call.attributes["retries"] == 1
+
+
+def test_statements_get_a_span(trace):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine("sqlite://")
+    tracing.instrument_engine(engine)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER)"))
+        with pytest.raises(Exception):
+            conn.execute(text("SELECT id FROM missing"))
+        conn.execute(text("SELECT id FROM users"))
+    assert names(trace) == ["CREATE", "SELECT missing", "SELECT users"]
+    assert trace.spans[1].error.startswith("OperationalError")
+    assert trace.spans[2].error is None
+
+
+def test_log_records_carry_the_request(trace, caplog):
+    tracing.install_log_context()
+    tracing.install_log_context()
+    with caplog.at_level(logging.INFO):
+        with tracing.span("stage") as opened:
+            logging.getLogger("test").info("hello")
+    (record,) = [r for r in caplog.records if r.getMessage() == "hello"]
+    assert record.request_id == "req-1"
+    assert record.trace_id == trace.trace_id
+    assert record.span_id == opened.span_id
+
+
+# --- requests ------------------------------------------------------------
+
+
+def serve(app, headers=()):
+    scope = {"type": "http", "method": "POST", "path": "/api/latest", "headers": list(headers)}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(tracing.RequestTracer(app)(scope, receive, send))
+    return dict(sent[0]["headers"])
+
+
+async def routed_app(scope, receive, send):
+    scope["route"] = SimpleNamespace(path="/api/latest")
+    with tracing.span("stage"):
+        pass
+    await send({"type": "http.response.start", "status": 201, "headers": []})
+
+
+def test_each_request_gets_an_id():
+    first = serve(routed_app)[b"x-request-id"]
+    second = serve(routed_app)[b"x-request-id"]
+    assert first and first != second
+
+
+@pytest.mark.parametrize(
+    "incoming, kept", [(b"abc-123", True), (b"has spaces", False), (b"x" * 200, False)]
+)
+def test_a_sensible_incoming_id_is_kept(incoming, kept):
+    returned = serve(routed_app, [(b"x-request-id", incoming)])[b"x-request-id"]
+    assert (returned == incoming) is kept
+
+
+def test_slow_requests_are_logged_with_their_span_tree(monkeypatch, caplog):
+    monkeypatch.setenv("SLOW_REQUEST_MS", "0")
+    with caplog.at_level(logging.WARNING, logger="src.tracing"):
+        serve(routed_app, [(b"x-request-id", b"slow-1")])
+    (record,) = caplog.records
+    message = record.getMessage()
+    assert message.startswith("Slow request slow-1: POST /api/latest took")
+    assert "\n  stage " in message
+
+
+def test_fast_requests_are_not_logged(monkeypatch, caplog):
+    monkeypatch.setenv("SLOW_REQUEST_MS", "60000")
+    with caplog.at_level(logging.WARNING, logger="src.tracing"):
+        serve(routed_app)
+    assert caplog.records == []
+
+
+def test_traces_are_exported_as_otlp_json(monkeypatch, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setenv("TRACE_EXPORT_PATH", str(path))
+    serve(routed_app)
+    serve(routed_app)
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    (resource,) = json.loads(lines[0])["resourceSpans"]
+    assert resource["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": "rebeat"}}
+    ]
+    root, stage = resource["scopeSpans"][0]["spans"]
+    assert root["name"] == "POST /api/latest"
+    assert root["kind"] == 2
+    assert "parentSpanId" not in root
+    assert stage["parentSpanId"] == root["spanId"]
+    assert stage["traceId"] == root["traceId"] and len(root["traceId"]) == 32
+    assert int(root["endTimeUnixNano"]) >= int(root["startTimeUnixNano"])
+    attributes = {a["key"]: a["value"] for a in root["attributes"]}
+    assert attributes["http.response.status_code"] == {"intValue": "201"}
+    assert attributes["http.route"] == {"stringValue": "/api/latest"}
@@ -0,0 +1,50 @@
+"""Tests for the generic expiring LRU cache.
+
+Its locking and eviction are covered through TokenCache in test_token_cache.py;
+these cover what the other caches use it for.
+"""
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def ttl_cache():
+    from src import ttl_cache
+
+    return ttl_cache
+
+
+def test_entries_put_without_an_expiry_last_the_ttl_and_are_bounded(ttl_cache):
+    now = [0.0]
+    cache = ttl_cache.TTLCache(max_entries=2, ttl=30, clock=lambda: now[0])
+    for before in range(5):
+        cache.put((1, before, None, 10), [before])
+    assert len(cache._entries) == 2
+    assert cache.get((1, 4, None, 10)) == [4]
+    assert cache.get((1, 0, None, 10)) is None
+
+    now[0] = 30.0
+    assert cache.get((1, 4, None, 10)) is None
+
+
+def test_a_cache_without_a_ttl_needs_an_expiry(ttl_cache):
+    cache = ttl_cache.TTLCache()
+    with pytest.raises(TypeError):
+        cache.put("k", "v")
+
+
+def test_get_or_load_caches_any_value_type(ttl_cache):
+    now = [0.0]
+    cache = ttl_cache.TTLCache(clock=lambda: now[0])
+    loads = []
+
+    def load():
+        loads.append(1)
+        return {"id": 7}, 60.0
+
+    assert cache.get_or_load(7, load) == {"id": 7}
+    assert cache.get_or_load(7, load) == {"id": 7}
+    assert len(loads) == 1
+    now[0] = 60.0
+    cache.get_or_load(7, load)
+    assert len(loads) == 2
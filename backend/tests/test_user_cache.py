@@ -0,0 +1,139 @@
+"""Tests for resolving the current user without a query per request.
+
+The session is a mock, so what's asserted is how often the user row is read.
+"""
+
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture(scope="module")
+def auth():
+    from src import auth
+
+    return auth
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(auth, monkeypatch):
+    from src import user_cache
+
+    monkeypatch.setattr(auth, "SECRET_KEY", "a-test-secret-at-least-32-bytes-long")
+    user_cache.users.clear()
+    user_cache.decoded_tokens.clear()
+    yield
+    user_cache.users.clear()
+    user_cache.decoded_tokens.clear()
+
+
+def session_with(*rows):
+    db = mock.Mock()
+    db.execute.return_value.unique.return_value.scalar_one_or_none.side_effect = list(
+        rows
+    )
+    return db
+
+
+def row(user_id=1, name="Runner", spotify_id="sp"):
+    return SimpleNamespace(
+        id=user_id,
+        name=name,
+        strava_id="st",
+        spotify_id=spotify_id,
+        created_at=datetime(2024, 1, 1),
+        tokens=[],
+    )
+
+
+def test_the_user_row_is_read_once_across_requests(auth):
+    token = auth.create_access_token(1)
+    db = session_with(row())
+    first = auth.get_current_user(token, db)
+    second = auth.get_current_user(token, db)
+    assert first == second
+    assert first.spotify_id == "sp"
+    db.execute.assert_called_once()
+
+
+def test_the_cached_user_is_frozen(auth):
+    from dataclasses import FrozenInstanceError
+
+    user = auth.get_current_user(auth.create_access_token(1), session_with(row()))
+    with pytest.raises(FrozenInstanceError):
+        user.name = "Someone else"
+
+
+def test_invalidating_a_user_reads_them_again(auth):
+    from src.user_cache import invalidate_user
+
+    token = auth.create_access_token(1)
+    db = session_with(row(spotify_id=None), row(spotify_id="linked"))
+    assert auth.get_current_user(token, db).spotify_id is None
+    invalidate_user(1)
+    assert auth.get_current_user(token, db).spotify_id == "linked"
+
+
+def test_an_unknown_user_is_rejected_and_not_cached(auth):
+    token = auth.create_access_token(2)
+    db = session_with(None, None)
+    for _ in range(2):
+        with pytest.raises(HTTPException) as error:
+            auth.get_current_user(token, db)
+        assert error.value.status_code == 401
+    assert db.execute.call_count == 2
+
+
+def test_a_decoded_token_is_not_decoded_again(auth):
+    token = auth.create_access_token(3)
+    with mock.patch.object(auth.jwt, "decode", wraps=auth.jwt.decode) as decode:
+        assert auth.verify_token(token) == 3
+        assert auth.verify_token(token) == 3
+    decode.assert_called_once()
+
+
+def test_bad_tokens_are_still_refused(auth):
+    assert auth.verify_token("not-a-jwt") is None
+    with pytest.raises(HTTPException):
+        auth.get_current_user("not-a-jwt", mock.Mock())
+
+
+def test_a_cached_token_lapses_when_it_expires(auth):
+    from src.user_cache import decoded_tokens
+
+    decoded_tokens.put("expired", 4, expires_at=0)
+    assert decoded_tokens.get("expired") is None
+
+
+def async_session_with(*rows):
+    db = mock.AsyncMock()
+    db.execute.return_value = mock.Mock()
+    db.execute.return_value.unique.return_value.scalar_one_or_none.side_effect = list(
+        rows
+    )
+    return db
+
+
+def test_the_async_dependency_shares_the_cache(auth):
+    import asyncio
+
+    token = auth.create_access_token(1)
+    db = async_session_with(row())
+    first = asyncio.run(auth.get_current_user_async(token, db))
+    second = asyncio.run(auth.get_current_user_async(token, db))
+    assert first == second == auth.get_current_user(token, mock.Mock())
+    db.execute.assert_awaited_once()
+
+
+def test_the_async_dependency_rejects_unknown_users_and_bad_tokens(auth):
+    import asyncio
+
+    db = async_session_with(None)
+    for token in (auth.create_access_token(2), "not-a-jwt"):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(auth.get_current_user_async(token, db))
+        assert error.value.status_code == 401
+    db.execute.assert_awaited_once()